@@ -0,0 +1,523 @@
+"""
+Сквозной бенчмарк бота без внешней сети.
+
+Поднимает локальные заглушки Telegram Bot API (fake_telegram.py), REST Binance,
+exchangerate-api и Gemini (FakeGeminiModel из bot.py) с настраиваемой задержкой
+и долей ошибок, затем:
+
+  1. прогоняет синтетический трафик юзеров через настоящие хендлеры
+     (cb_ai, cb_stats, converter_handler, настройки) — dp.feed_update;
+  2. гоняет background_monitor на большом числе подписчиков.
+
+Отчёт: p50/p95/p99 по типам апдейтов, время цикла монитора, походы в БД на клик.
+Результат сохраняется в JSON, чтобы сравнивать прогоны между собой.
+
+    python benchmark.py --clicks 5000 --users 2000 --subscribers 50000 --out bench.json
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List, Optional
+
+from aiohttp import web
+
+from fake_telegram import FakeTelegramServer, UpdateGenerator
+
+# ==============================================================================
+# FAKE BINANCE & FIAT
+# ==============================================================================
+
+class FakeBinanceServer:
+    """
+    Те эндпоинты Binance REST, которые бот вызывает через ccxt: exchangeInfo, ticker/24hr,
+    klines, time. Цены случайно гуляют на каждом запросе тикеров, чтобы монитор видел движения.
+    """
+
+    def __init__(self, coins: List[str], port: int, latency: float = 0.02,
+                 error_rate: float = 0.0, volatility: float = 2.0):
+        self.coins = coins
+        self.port = port
+        self.latency = latency
+        self.error_rate = error_rate
+        self.volatility = volatility
+        self.prices = {coin: random.uniform(0.01, 50_000) for coin in coins}
+        self.calls: Dict[str, int] = {}
+        self.errors = 0
+        self._runner: Optional[web.AppRunner] = None
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.port}"
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get("/api/v3/exchangeInfo", self._exchange_info)
+        app.router.add_get("/api/v3/ticker/24hr", self._tickers)
+        app.router.add_get("/api/v3/klines", self._klines)
+        app.router.add_get("/api/v3/time", self._time)
+        app.middlewares.append(self._chaos)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, "127.0.0.1", self.port).start()
+
+    async def close(self):
+        if self._runner:
+            await self._runner.cleanup()
+
+    @web.middleware
+    async def _chaos(self, request: web.Request, handler):
+        name = request.path.rsplit("/", 1)[-1]
+        self.calls[name] = self.calls.get(name, 0) + 1
+        if self.latency:
+            await asyncio.sleep(random.uniform(0.5, 1.5) * self.latency)
+        # exchangeInfo не роняем: без рынков бенчмарк бессмыслен
+        if self.error_rate and name != "exchangeInfo" and random.random() < self.error_rate:
+            self.errors += 1
+            return web.json_response({"code": -1003, "msg": "Too much request weight used"}, status=429)
+        return await handler(request)
+
+    @staticmethod
+    def _market_id(coin: str) -> str:
+        return coin.replace("/", "")
+
+    async def _exchange_info(self, request: web.Request) -> web.Response:
+        symbols = []
+        for coin in self.coins:
+            base, quote = coin.split("/")
+            symbols.append({
+                "symbol": self._market_id(coin), "status": "TRADING",
+                "baseAsset": base, "baseAssetPrecision": 8,
+                "quoteAsset": quote, "quotePrecision": 8, "quoteAssetPrecision": 8,
+                "orderTypes": ["LIMIT", "MARKET"], "isSpotTradingAllowed": True,
+                "isMarginTradingAllowed": False, "permissions": ["SPOT"],
+                "filters": [
+                    {"filterType": "PRICE_FILTER", "minPrice": "0.00000001", "maxPrice": "1000000", "tickSize": "0.00000001"},
+                    {"filterType": "LOT_SIZE", "minQty": "0.00000001", "maxQty": "9000000", "stepSize": "0.00000001"},
+                ],
+            })
+        return web.json_response({"timezone": "UTC", "serverTime": int(time.time() * 1000), "symbols": symbols})
+
+    def _ticker(self, coin: str) -> Dict[str, Any]:
+        price = self.prices[coin]
+        now = int(time.time() * 1000)
+        return {
+            "symbol": self._market_id(coin), "priceChange": f"{price * 0.01:.8f}",
+            "priceChangePercent": "1.000", "weightedAvgPrice": f"{price:.8f}",
+            "prevClosePrice": f"{price:.8f}", "lastPrice": f"{price:.8f}", "lastQty": "1",
+            "bidPrice": f"{price * 0.999:.8f}", "bidQty": "1", "askPrice": f"{price * 1.001:.8f}", "askQty": "1",
+            "openPrice": f"{price * 0.99:.8f}", "highPrice": f"{price * 1.05:.8f}", "lowPrice": f"{price * 0.95:.8f}",
+            "volume": "100000", "quoteVolume": f"{price * 100000:.2f}",
+            "openTime": now - 86_400_000, "closeTime": now, "firstId": 1, "lastId": 2, "count": 2,
+        }
+
+    async def _tickers(self, request: web.Request) -> web.Response:
+        for coin in self.prices:
+            self.prices[coin] *= 1 + random.gauss(0, self.volatility) / 100
+        by_id = {self._market_id(c): c for c in self.coins}
+        if "symbol" in request.query:
+            return web.json_response(self._ticker(by_id[request.query["symbol"]]))
+        wanted = json.loads(request.query["symbols"]) if "symbols" in request.query else list(by_id)
+        return web.json_response([self._ticker(by_id[s]) for s in wanted if s in by_id])
+
+    async def _klines(self, request: web.Request) -> web.Response:
+        coin = {self._market_id(c): c for c in self.coins}[request.query["symbol"]]
+        limit = int(request.query.get("limit", 500))
+        step = 3_600_000
+        end = int(time.time() * 1000) // step * step
+        price = self.prices[coin]
+        candles = []
+        for i in range(limit):
+            ts = end - (limit - 1 - i) * step
+            close = price * (1 + random.gauss(0, 1) / 100)
+            candles.append([ts, f"{price:.8f}", f"{max(price, close) * 1.002:.8f}",
+                            f"{min(price, close) * 0.998:.8f}", f"{close:.8f}", "1000",
+                            ts + step - 1, "1000", 10, "500", "500", "0"])
+        return web.json_response(candles)
+
+    async def _time(self, request: web.Request) -> web.Response:
+        return web.json_response({"serverTime": int(time.time() * 1000)})
+
+class FakeBinanceStream:
+    """
+    Combined stream Binance по WebSocket: /stream?streams=btcusdt@ticker/btcusdt@kline_1h/...
+    Раз в interval шлёт 24hrTicker и kline по каждой подписанной паре, цены берёт из общего
+    с FakeBinanceServer словаря. drop() рвёт соединения, paused — соединение живо, но молчит:
+    так проверяются переподключение и уход в REST.
+    """
+
+    def __init__(self, prices: Dict[str, float], port: int, interval: float = 0.5, volatility: float = 0.1):
+        self.prices = prices
+        self.port = port
+        self.interval = interval
+        self.volatility = volatility
+        self.paused = False
+        self.connections = 0
+        self.subscriptions: List[List[str]] = []
+        self.sent = 0
+        self._sockets: set = set()
+        self._runner: Optional[web.AppRunner] = None
+
+    @property
+    def url(self) -> str:
+        return f"ws://127.0.0.1:{self.port}"
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get("/stream", self._stream)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, "127.0.0.1", self.port).start()
+
+    async def close(self):
+        await self.drop()
+        if self._runner:
+            await self._runner.cleanup()
+
+    async def drop(self):
+        """Сервер закрывает все текущие соединения."""
+        for ws in list(self._sockets):
+            await ws.close()
+
+    async def _stream(self, request: web.Request) -> web.WebSocketResponse:
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        streams = [s for s in request.query.get("streams", "").split("/") if s]
+        self.connections += 1
+        self.subscriptions.append(streams)
+        self._sockets.add(ws)
+        sender = asyncio.create_task(self._push(ws, streams))
+        try:
+            # Читаем входящие, чтобы заметить закрытие с той стороны
+            async for _ in ws:
+                pass
+        finally:
+            sender.cancel()
+            self._sockets.discard(ws)
+        return ws
+
+    async def _push(self, ws: web.WebSocketResponse, streams: List[str]):
+        by_id = {coin.replace("/", "").lower(): coin for coin in self.prices}
+        while not ws.closed:
+            if not self.paused:
+                for stream in streams:
+                    sid, kind = stream.split("@", 1)
+                    coin = by_id.get(sid)
+                    if coin is None:
+                        continue
+                    try:
+                        await ws.send_json({"stream": stream, "data": self._event(coin, kind)})
+                    except ConnectionError:
+                        return
+                    self.sent += 1
+            await asyncio.sleep(self.interval)
+
+    def _event(self, coin: str, kind: str) -> Dict[str, Any]:
+        self.prices[coin] *= 1 + random.gauss(0, self.volatility) / 100
+        price = self.prices[coin]
+        now = int(time.time() * 1000)
+        symbol = coin.replace("/", "")
+        if kind == "ticker":
+            return {
+                "e": "24hrTicker", "E": now, "s": symbol, "c": f"{price:.8f}", "o": f"{price * 0.99:.8f}",
+                "h": f"{price * 1.05:.8f}", "l": f"{price * 0.95:.8f}", "P": "1.000",
+                "q": f"{price * 100000:.2f}",
+            }
+        timeframe = kind.split("_", 1)[1]
+        step = 3_600_000
+        return {
+            "e": "kline", "E": now, "s": symbol,
+            "k": {
+                "t": now // step * step, "i": timeframe, "o": f"{price:.8f}", "h": f"{price * 1.002:.8f}",
+                "l": f"{price * 0.998:.8f}", "c": f"{price:.8f}", "v": "1000", "x": False,
+            },
+        }
+
+class FakeFiatServer:
+    """exchangerate-api: /v4/latest/USD."""
+
+    def __init__(self, port: int, latency: float = 0.05):
+        self.port = port
+        self.latency = latency
+        self.calls = 0
+        self._runner: Optional[web.AppRunner] = None
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.port}/v4/latest/USD"
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get("/v4/latest/USD", self._latest)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, "127.0.0.1", self.port).start()
+
+    async def close(self):
+        if self._runner:
+            await self._runner.cleanup()
+
+    async def _latest(self, request: web.Request) -> web.Response:
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        return web.json_response({
+            "base": "USD",
+            "rates": {"USD": 1, "RUB": 92.5, "EUR": 0.92, "UAH": 41.2, "KZT": 480.0},
+        })
+
+# ==============================================================================
+# HARNESS
+# ==============================================================================
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def percentiles(values: List[float]) -> Dict[str, float]:
+    if not values:
+        return {"count": 0}
+    values = sorted(values)
+
+    def _at(p: float) -> float:
+        return round(values[min(len(values) - 1, int(len(values) * p))] * 1000, 2)
+
+    return {
+        "count": len(values),
+        "p50_ms": _at(0.50),
+        "p95_ms": _at(0.95),
+        "p99_ms": _at(0.99),
+        "max_ms": round(values[-1] * 1000, 2),
+    }
+
+def update_kind(update: Dict[str, Any]) -> str:
+    """Имя хендлера, который обработает апдейт — для группировки задержек."""
+    if "message" in update:
+        text = update["message"]["text"]
+        if text == "/start":
+            return "cmd_start"
+        if text[0].isdigit():
+            return "converter_handler"
+        return {
+            "🧠 AI Прогноз": "menu_ai",
+            "📊 Статистика": "menu_stats",
+            "🔔 Подписки": "menu_subs",
+            "⚙️ Настройки": "cmd_settings",
+        }.get(text, "message")
+    data = update["callback_query"]["data"]
+    prefix = data.split("_")[0]
+    return {
+        "ai": "cb_ai", "st": "cb_stats", "sub": "cb_sub", "pg": "cb_page",
+        "set": "cb_set_curr", "cycle": "cb_cycle_alert", "toggle": "cb_toggle_mode",
+    }.get(prefix, "callback")
+
+async def seed_subscribers(bot_module, count: int, users: int, digest_share: float = 0.0):
+    """count подписок у users юзеров со случайными порогами; доля digest_share — в режиме сводки."""
+    rnd = random.Random(42)
+    storage = bot_module.storage
+    for user_id in range(1, users + 1):
+        storage.write(
+            "INSERT OR REPLACE INTO users (user_id, currency, analysis_mode, alert_percent, alert_digest) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (
+                user_id, rnd.choice(["USD", "RUB", "EUR"]), rnd.choice(["AI", "ALG"]),
+                rnd.choice([1.0, 3.0, 5.0]), int(rnd.random() < digest_share),
+            ),
+        )
+    seen = set()
+    while len(seen) < count:
+        pair = (rnd.randint(1, users), rnd.choice(bot_module.COINS))
+        if pair not in seen:
+            seen.add(pair)
+            storage.write("INSERT OR IGNORE INTO subs (user_id, coin) VALUES (?, ?)", pair)
+    await storage.flush()
+    await bot_module.subscription_index.rebuild()
+
+async def replay_traffic(bot_module, clicks: int, users: int, concurrency: int) -> Dict[str, Any]:
+    from aiogram.types import Update
+
+    gen = UpdateGenerator(users, seed=7)
+    updates = [gen.next() for _ in range(clicks)]
+    latencies: Dict[str, List[float]] = {}
+    errors: Dict[str, int] = {}
+    queue: asyncio.Queue = asyncio.Queue()
+    for u in updates:
+        queue.put_nowait(u)
+
+    async def _worker():
+        while not queue.empty():
+            raw = queue.get_nowait()
+            kind = update_kind(raw)
+            update = Update.model_validate(raw, context={"bot": bot_module.bot})
+            started = time.perf_counter()
+            try:
+                await bot_module.dp.feed_update(bot_module.bot, update)
+            except Exception:
+                errors[kind] = errors.get(kind, 0) + 1
+            latencies.setdefault(kind, []).append(time.perf_counter() - started)
+
+    db_before = dict(bot_module.storage.stats)
+    started = time.perf_counter()
+    await asyncio.gather(*(_worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    db = {k: bot_module.storage.stats[k] - db_before[k] for k in db_before}
+
+    all_latencies = [v for values in latencies.values() for v in values]
+    return {
+        "clicks": clicks,
+        "elapsed_s": round(elapsed, 3),
+        "throughput_rps": round(clicks / elapsed, 1),
+        "overall": percentiles(all_latencies),
+        "handlers": {
+            kind: {**percentiles(values), "errors": errors.get(kind, 0)}
+            for kind, values in sorted(latencies.items())
+        },
+        "db_per_click": {k: round(v / clicks, 3) for k, v in db.items()},
+    }
+
+async def run_monitor(bot_module, cycles: int, timeout: float) -> Dict[str, Any]:
+    stats = bot_module.monitor_stats
+    start_cycles, start_alerts = stats["cycles"], stats["alerts"]
+    bot_module.alert_delivery.start()
+    task = asyncio.create_task(bot_module.background_monitor())
+    deadline = time.monotonic() + timeout
+    while stats["cycles"] - start_cycles < cycles and time.monotonic() < deadline:
+        await asyncio.sleep(0.05)
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+    # Недокопившиеся сводки отправляем сразу, чтобы они попали в статистику доставки
+    await bot_module.alert_digest.flush_due(force=True)
+    # Даём очереди доотправить то, что успело накопиться
+    await bot_module.alert_delivery.stop(drain=5)
+
+    done = stats["cycles"] - start_cycles
+    cycle_times = list(stats["cycle_times"])[-done:] if done else []
+    return {
+        "cycles": done,
+        "cycle": percentiles(cycle_times),
+        "alerts": stats["alerts"] - start_alerts,
+        "digest": dict(bot_module.alert_digest.stats),
+        "delivery": dict(bot_module.alert_delivery.stats),
+    }
+
+async def run(args: argparse.Namespace) -> Dict[str, Any]:
+    workdir = tempfile.mkdtemp(prefix="bot-bench-")
+    tg = FakeTelegramServer(port=free_port(), latency=args.tg_latency, error_rate=args.tg_error_rate)
+    fiat = FakeFiatServer(free_port(), latency=args.fiat_latency)
+
+    # Конфиг бота читается при импорте — окружение выставляем до него
+    os.environ.update({
+        "BOT_TOKEN": "123456:BENCHMARK",
+        "TELEGRAM_API_URL": tg.url,
+        "FIAT_RATES_URL": fiat.url,
+        "FIAT_RATES_FILE": os.path.join(workdir, "fiat_rates.json"),
+        "DB_FILE": os.path.join(workdir, "bench.db"),
+        "WARM_STATE_FILE": os.path.join(workdir, "warm_state.json"),
+        "MARKET_STREAM_ENABLED": "1" if args.market_stream else "0",
+        "GEMINI_FAKE": "1",
+        "GEMINI_FAKE_LATENCY": str(args.gemini_latency),
+        "GEMINI_FAKE_ERROR_RATE": str(args.gemini_error_rate),
+    })
+    binance_port, fallback_port, stream_port = free_port(), free_port(), free_port()
+    os.environ["MARKET_STREAM_URL"] = f"ws://127.0.0.1:{stream_port}"
+    os.environ["EXCHANGE_API_URL"] = f"http://127.0.0.1:{binance_port}"
+    # Резервная биржа — тоже фейк (binanceus говорит на том же API), иначе никаких резервных:
+    # бенчмарк не должен ходить в настоящую сеть
+    os.environ["EXCHANGE_FALLBACKS"] = "binanceus" if args.fallback_exchange else ""
+    os.environ["EXCHANGE_FALLBACK_URLS"] = f"binanceus=http://127.0.0.1:{fallback_port}"
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import bot as bot_module
+
+    binance = FakeBinanceServer(
+        bot_module.COINS, binance_port, latency=args.exchange_latency,
+        error_rate=args.exchange_error_rate, volatility=args.volatility,
+    )
+    servers = [tg, fiat, binance]
+    if args.fallback_exchange:
+        servers.append(FakeBinanceServer(bot_module.COINS, fallback_port, latency=0.02, volatility=args.volatility))
+    stream = FakeBinanceStream(binance.prices, stream_port) if args.market_stream else None
+    if stream is not None:
+        servers.append(stream)
+    for server in servers:
+        await server.start()
+    # Цикл монитора — тик планировщика опроса; при большом бюджете каждый тик опрашивает все пары
+    bot_module.POLL_TICK = bot_module.POLL_MIN_INTERVAL = args.monitor_interval
+    bot_module.POLL_BUDGET = args.poll_budget
+
+    try:
+        await bot_module.start_services()
+        # Биржи поднимаются фоном; трафик меряем уже на тёплом боте
+        await bot_module.market_services_task
+        await seed_subscribers(bot_module, args.subscribers, args.users, args.digest_share)
+        traffic = await replay_traffic(bot_module, args.clicks, args.users, args.concurrency)
+        monitor = await run_monitor(bot_module, args.monitor_cycles, args.monitor_timeout)
+    finally:
+        await bot_module.stop_services()
+        for server in servers:
+            await server.close()
+
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": vars(args),
+        "traffic": traffic,
+        "monitor": monitor,
+        "fakes": {
+            "telegram": {"calls": tg.calls, "errors": tg.errors},
+            "binance": {"calls": binance.calls, "errors": binance.errors},
+            "fallback": {"calls": servers[3].calls} if args.fallback_exchange else None,
+            "fiat": {"calls": fiat.calls},
+            "stream": {"connections": stream.connections, "sent": stream.sent} if stream else None,
+            "gemini": {"calls": getattr(bot_module.gemini_model, "calls", None)},
+        },
+        "caches": {
+            "ai": dict(bot_module.ai_cache.stats),
+            "user": dict(bot_module.user_cache.stats),
+            "single_flight": {sf.name: dict(sf.stats) for sf in bot_module.single_flights},
+        },
+        "price_source": {
+            **bot_module.price_source.stats,
+            "health": {p.exchange_id: dict(p.health.stats) for p in bot_module.price_source.pools},
+        },
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Сквозной бенчмарк бота на локальных заглушках")
+    parser.add_argument("--clicks", type=int, default=2000, help="апдейтов в прогоне трафика")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=50, help="одновременных апдейтов")
+    parser.add_argument("--subscribers", type=int, default=20000, help="подписок для монитора")
+    parser.add_argument("--monitor-cycles", type=int, default=5)
+    parser.add_argument("--monitor-interval", type=float, default=1.0, help="период цикла монитора, сек")
+    parser.add_argument("--monitor-timeout", type=float, default=120.0)
+    parser.add_argument("--digest-share", type=float, default=0.0, help="доля юзеров в режиме сводки алертов")
+    parser.add_argument("--poll-budget", type=float, default=1000.0, help="бюджет опроса монитора, пар в секунду")
+    parser.add_argument("--volatility", type=float, default=2.0, help="σ движения цены за запрос, %%")
+    parser.add_argument("--tg-latency", type=float, default=0.03)
+    parser.add_argument("--tg-error-rate", type=float, default=0.0)
+    parser.add_argument("--exchange-latency", type=float, default=0.02)
+    parser.add_argument("--exchange-error-rate", type=float, default=0.0)
+    parser.add_argument("--fallback-exchange", action="store_true", help="поднять резервную фейковую биржу (binanceus)")
+    parser.add_argument("--market-stream", action="store_true", help="цены через фейковый WebSocket-поток вместо REST-опроса")
+    parser.add_argument("--fiat-latency", type=float, default=0.05)
+    parser.add_argument("--gemini-latency", type=float, default=1.5)
+    parser.add_argument("--gemini-error-rate", type=float, default=0.0)
+    parser.add_argument("--out", default="benchmark_results.json", help="куда сохранить JSON-отчёт")
+    args = parser.parse_args()
+
+    result = asyncio.run(run(args))
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    print(json.dumps({
+        "overall": result["traffic"]["overall"],
+        "db_per_click": result["traffic"]["db_per_click"],
+        "monitor_cycle": result["monitor"]["cycle"],
+        "alerts": result["monitor"]["alerts"],
+        "digest": result["monitor"]["digest"],
+    }, ensure_ascii=False, indent=2))
+    print(f"Full report: {args.out}")
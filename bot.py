@@ -1,16 +1,44 @@
 import os
+import abc
 import asyncio
+import bisect
+import difflib
+import hashlib
+import importlib
+import itertools
 import logging
+import math
+import multiprocessing
+import signal
 import sqlite3
+import tempfile
+import threading
 import time
 import re
-from typing import List, Dict, Optional, Tuple, Any
+import json
+import random
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from types import SimpleNamespace
+from typing import List, Dict, Optional, Tuple, Any, AsyncIterator, Awaitable, Callable
+
+PROCESS_STARTED = time.monotonic()  # до тяжёлых импортов: от этой точки меряем холодный старт
+
+try:
+    import fcntl  # блокировка лидера; на Windows её нет
+except ImportError:
+    fcntl = None
 
 import aiohttp # Используем для парсинга курсов валют
-import ccxt.async_support as ccxt
-import google.generativeai as genai
+from aiohttp import web
+import numpy as np
 from aiogram.exceptions import TelegramRetryAfter, TelegramForbiddenError, TelegramBadRequest
 from aiogram import Bot, Dispatcher, F, types
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler
 from aiogram.filters import Command
 from aiogram.types import (
     InlineKeyboardButton,
@@ -21,34 +49,192 @@ from aiogram.types import (
 )
 from aiogram.exceptions import TelegramRetryAfter, TelegramForbiddenError
 
+class LazyModule:
+    """
+    Модуль, который импортируется при первом обращении к атрибуту. load() можно
+    заранее позвать в потоке (asyncio.to_thread), чтобы импорт не занимал event loop.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._module: Optional[Any] = None
+        self._lock = threading.Lock()
+
+    @property
+    def loaded(self) -> bool:
+        return self._module is not None
+
+    def load(self) -> Any:
+        with self._lock:
+            if self._module is None:
+                started = time.perf_counter()
+                self._module = importlib.import_module(self.name)
+                logging.getLogger("CryptoAIAnalyst").info(f"Imported {self.name} in {time.perf_counter() - started:.2f}s")
+        return self._module
+
+    def __getattr__(self, attr: str) -> Any:
+        return getattr(self.load(), attr)
+
+# ccxt тянет классы всех бирж, genai — grpc и protobuf: вместе это секунды на каждом старте
+ccxt = LazyModule("ccxt.async_support")
+genai = LazyModule("google.generativeai")
+
 # ==============================================================================
 # CONFIGURATION
 # ==============================================================================
 
 BOT_TOKEN = os.getenv("BOT_TOKEN", "YOUR_TELEGRAM_BOT_TOKEN") # ← ВСТАВЬ СВОЙ TOKEN
 GEMINI_KEY = os.getenv("GEMINI_API_KEY", "YOUR_GOOGLE_GEMINI_API_KEY")
-DB_FILE = "crypto_ai_analyst.db"
+GEMINI_FAKE = os.getenv("GEMINI_FAKE") == "1"  # локальная заглушка вместо Gemini (офлайн-тесты)
+GEMINI_FAKE_LATENCY = float(os.getenv("GEMINI_FAKE_LATENCY", "1.5"))
+GEMINI_FAKE_ERROR_RATE = float(os.getenv("GEMINI_FAKE_ERROR_RATE", "0"))
+DB_FILE = os.getenv("DB_FILE", "crypto_ai_analyst.db")
+STORAGE_BATCH_SIZE = 100  # столько отложенных записей сбрасываем сразу
+STORAGE_FLUSH_INTERVAL = 0.2  # максимальная задержка отложенной записи, сек
+STORAGE_STATEMENT_CACHE = 256  # размер кэша подготовленных выражений sqlite3
+STORAGE_RETRY_DELAY = (0.2, 5.0)  # пауза перед повтором пачки, упёршейся в блокировку базы: от и до, сек
+STORAGE_CLOSE_ATTEMPTS = 5  # попыток дописать очередь при остановке
+USER_CACHE_SIZE = 20_000  # профилей юзеров в памяти (LRU)
+USER_CACHE_SHARED_TTL = 5  # при нескольких воркерах профиль перечитываем не реже, сек
 
 RSI_PERIOD = 14
 SMA_PERIOD = 20
 AI_CACHE_TTL = 60  # кэш AI-ответов на 60 секунд
+AI_CACHE_STALE_TTL = 240  # ещё столько отдаём устаревший ответ, обновляя его в фоне, сек
+AI_CACHE_MAX_SIZE = 500  # максимум монет в кэше анализа
+GEMINI_CONCURRENCY = 4  # одновременных запросов к Gemini
+GEMINI_TIMEOUT = 30  # жёсткий таймаут одного запроса, сек
+GEMINI_LATENCY_BUDGET = 6  # сколько хендлер ждёт AI, потом отвечает алгоритмом, сек
+GEMINI_BACKOFF_MIN = 15  # пауза после исчерпания квоты, растёт вдвое до максимума, сек
+GEMINI_BACKOFF_MAX = 600
+GEMINI_BATCH_SIZE = 5  # монет в одном батч-промпте
+GEMINI_BATCH_MARKER = "[BATCH]"
+AI_PREFETCH_INTERVAL = 45  # период фонового обновления AI-текстов, сек
+AI_PREFETCH_DEMAND_WINDOW = 900  # монету обновляем, если её спрашивали за это время, сек
+STREAM_EDIT_INTERVAL = 1.5  # минимальный интервал правок сообщения при стриминге AI, сек
 FIAT_CACHE_TTL = 3600  # кэш курсов валют на 1 час (обновляем реже, они стабильнее крипты)
+FIAT_RETRY_INTERVAL = 60  # повтор после неудачного обновления курсов, сек
+FIAT_RATES_URL = os.getenv("FIAT_RATES_URL", "https://api.exchangerate-api.com/v4/latest/USD")
+FIAT_RATES_FILE = os.getenv("FIAT_RATES_FILE", "fiat_rates.json")  # последние известные курсы
+WARM_STATE_FILE = os.getenv("WARM_STATE_FILE", "warm_state.json")  # тёплое состояние для быстрого рестарта
+WARM_STATE_INTERVAL = 60  # как часто лидер сохраняет тёплое состояние, сек
+WARM_STATE_STALE_MAX_AGE = 600  # снимки и анализы моложе этого после рестарта отдаём как устаревшие (снимки — с возрастом данных), обновляя фоном, сек
+WARM_STATE_MAX_AGE = 6 * 3600  # файл старше этого при старте игнорируем, сек
+WARM_STATE_CANDLES = 100  # последних свечей на монету и таймфрейм в файле
 ALERT_CHECK_DELAY = 60  # интервал фонового сканера, сек
+MONITOR_BATCH_MODE = True  # все цены одним запросом fetch_tickers вместо опроса по одной монете
+POLL_BUDGET = 8.0  # бюджет REST-опроса: обновлений пар в секунду на все монеты сразу
+POLL_TICK = 1.0  # как часто планировщик собирает созревшие пары в один запрос, сек
+POLL_MIN_INTERVAL = 2.0  # чаще этого одну пару не опрашиваем, сек
+POLL_MAX_INTERVAL = 60.0  # и реже этого тоже, сек
+POLL_VOL_REF = 0.02  # «обычная» волатильность, % за √сек (~3% в сутки)
+POLL_VOL_ALPHA = 0.2  # вес нового наблюдения в EWMA волатильности
+MONITOR_HEARTBEAT_INTERVAL = 5  # heartbeat сканера-партиции, сек
+MONITOR_LOG_EVERY = 30  # сводка монитора в лог раз в столько циклов (и всегда при алертах)
+ALERT_QUEUE_SIZE = 50_000  # максимум алертов в очереди на отправку
+ALERT_WORKERS = 8  # параллельные отправщики
+ALERT_MAX_AGE = 300  # алерт старше этого уже не отправляем, сек
+ALERT_MAX_ATTEMPTS = 3  # попыток при сетевых ошибках
+ALERT_DRAIN_TIMEOUT = 5  # при остановке столько ждём, пока воркеры дошлют очередь, сек
+ALERT_DIGEST_WINDOW = 60  # сколько копим алерты юзера в режиме сводки, прежде чем отправить одним сообщением, сек
+TELEGRAM_GLOBAL_RATE = 25  # сообщений в секунду на бота (лимит Telegram ~30)
+TELEGRAM_CHAT_INTERVAL = 1.0  # минимальный интервал между сообщениями в один чат, сек
+
+EXCHANGE_ID = "binance"
+EXCHANGE_API_URL = os.getenv("EXCHANGE_API_URL", "")  # подмена REST-адреса биржи (локальный фейк)
+EXCHANGE_CONCURRENCY = 10  # максимум одновременных запросов к бирже
+EXCHANGE_KEEPALIVE = 10  # пинг биржи при простое, чтобы соединения оставались тёплыми, сек
+MARKETS_REFRESH_INTERVAL = 6 * 3600  # перезагрузка списка рынков, сек
+# Резервные биржи по порядку: на них уходят запросы, если основная тормозит или лежит
+EXCHANGE_FALLBACKS = [x.strip() for x in os.getenv("EXCHANGE_FALLBACKS", "okx,bybit").split(",") if x.strip()]
+# Подмена REST-адресов резервных бирж: "okx=http://127.0.0.1:9001,bybit=http://127.0.0.1:9002"
+EXCHANGE_FALLBACK_URLS = dict(
+    item.strip().split("=", 1) for item in os.getenv("EXCHANGE_FALLBACK_URLS", "").split(",") if "=" in item
+)
+EXCHANGE_QUOTE_SUBSTITUTES = ("USDT", "USDC", "USD")  # нет пары к USDT — берём ту же монету к другому доллару
+EXCHANGE_PRIMARY_BONUS = 2.0  # во сколько раз основная биржа «лучше» при равном здоровье
+EXCHANGE_BREAKER_FAILURES = 5  # ошибок подряд до размыкания автомата биржи
+EXCHANGE_BREAKER_COOLDOWN = 30  # сколько разомкнутая биржа отдыхает до пробного запроса, сек
+EXCHANGE_LATENCY_WINDOW = 200  # последних задержек в окне здоровья биржи
+EXCHANGE_HEDGE_PERCENTILE = 0.9  # ответа нет дольше этого перцентиля — дублируем запрос на другую биржу
+EXCHANGE_HEDGE_DELAY = (0.1, 2.0)  # границы задержки перед дублем, сек
+EXCHANGE_HEDGE_DEFAULT_DELAY = 0.5  # пока задержек мало для перцентиля, сек
+EXCHANGE_HEDGE_MAX = 1  # максимум дублей на запрос (переход после ошибки не считается)
 
-# Список монет
+MARKET_STREAM_ENABLED = os.getenv("MARKET_STREAM_ENABLED", "1") == "1"  # цены и свечи из WebSocket-потока вместо REST-опроса
+MARKET_STREAM_URL = os.getenv("MARKET_STREAM_URL", "wss://stream.binance.com:9443")
+MARKET_STREAM_STALE = 30  # без сообщений дольше этого поток считается мёртвым, сек
+MARKET_STREAM_BACKOFF = (1.0, 60.0)  # пауза перед переподключением потока: от и до, сек
+MONITOR_STREAM_INTERVAL = 2  # период проверки алертов при живом потоке, сек
+KLINE_TIMEFRAME = "1h"
+ANALYSIS_CANDLES = 50  # свечей в окне индикаторов прогноза и снимков (последняя — текущая)
+CANDLE_STORE_CAPACITY = 500  # свечей в кольцевом буфере на монету и таймфрейм
+CANDLE_STORE_DIR = os.getenv("CANDLE_STORE_DIR", "")  # если задан — буферы в memory-mapped файлах
+SNAPSHOT_INTERVAL = 1  # пересчёт снимков по обновлениям потока, сек
+SNAPSHOT_REST_INTERVAL = 15  # пересчёт снимков при опросе REST, сек
+SNAPSHOT_MAX_AGE = 30  # снимок старше этого не используем, сек
+SNAPSHOT_RSI_MAX_AGE = 3600  # не удалось взять свечи — столько ещё живёт RSI прошлого снимка, сек
+
+BOT_MODE = os.getenv("BOT_MODE", "polling")  # polling | webhook
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "")  # свой Bot API сервер вместо api.telegram.org
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")  # публичный адрес бота; пусто — вебхук настроен снаружи
+WEBHOOK_PATH = "/webhook"
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEB_HOST = os.getenv("WEB_HOST", "0.0.0.0")
+WEB_PORT = int(os.getenv("WEB_PORT", "8080"))
+WEB_WORKERS = int(os.getenv("WEB_WORKERS", "1"))  # процессов на одном порту (SO_REUSEPORT)
+SHARED_WORKERS = BOT_MODE == "webhook" and WEB_WORKERS > 1  # несколько процессов делят одну базу
+LEADER_LOCK_FILE = os.getenv("LEADER_LOCK_FILE", DB_FILE + ".leader")
+LEADER_RETRY_INTERVAL = 5  # как часто не-лидер пробует захватить блокировку, сек
+SHARED_RESYNC_INTERVAL = 30  # перечитывание индекса подписок при нескольких воркерах, сек
+MONITOR_PARTITIONS = int(os.getenv("MONITOR_PARTITIONS", "0"))  # процессов-сканеров; 0 — монитор в лидере
+MONITOR_MEMBER_TTL = 45  # сканер без heartbeat дольше этого считается выбывшим, сек
+HASH_RING_REPLICAS = 64  # виртуальных узлов на сканер в кольце
+OUTBOX_DRAIN_INTERVAL = 0.5  # как часто координатор забирает алерты сканеров, сек
+OUTBOX_BATCH = 500
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))  # 0 — метрики выключены; у воркера N порт METRICS_PORT+N
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Стартовый список монет: пока биржа не ответила, и запасной, если она недоступна.
+# Рабочий список собирает CoinUniverse — топ по объёму плюс всё, на что есть подписки.
 COINS = [
     "BTC/USDT", "ETH/USDT", "BNB/USDT", "SOL/USDT",
     "TON/USDT", "NOT/USDT", "TRX/USDT", "XRP/USDT",
     "DOGE/USDT", "SHIB/USDT", "PEPE/USDT", "HMSTR/USDT",
     "LTC/USDT", "ADA/USDT", "AVAX/USDT", "DOT/USDT",
-    "LINK/USDT", "ATOM/USDT", "NEAR/USDT", "MATIC/USDT",
+    "LINK/USDT", "ATOM/USDT", "NEAR/USDT", "POL/USDT",
     "UNI/USDT", "APT/USDT", "ARB/USDT", "OP/USDT",
-    "VET/USDT", "RNDR/USDT", "IMX/USDT", "STX/USDT",
-    "SUI/USDT", "TIA/USDT", "SEI/USDT", "FTM/USDT",
+    "VET/USDT", "RENDER/USDT", "IMX/USDT", "STX/USDT",
+    "SUI/USDT", "TIA/USDT", "SEI/USDT", "S/USDT",
     "INJ/USDT", "LDO/USDT", "RUNE/USDT", "AR/USDT"
 ]
 
-CURRENCY_SYMBOLS = {"USD": "$", "RUB": "₽", "EUR": "€"}
+QUOTE_ASSET = "USDT"
+UNIVERSE_TOP_N = int(os.getenv("UNIVERSE_TOP_N", "60"))  # пар из топа по объёму за 24ч
+UNIVERSE_REFRESH_INTERVAL = 3600  # пересборка списка монет, сек
+UNIVERSE_RETRY_INTERVAL = 60  # повтор после неудачной пересборки, сек
+# Стейблкоины и плечевые токены (BTCUP, ETHBEAR, ...) в топ не берём: следить там не за чем
+UNIVERSE_EXCLUDE = {"USDC", "FDUSD", "TUSD", "BUSD", "USDP", "DAI", "USDE", "PYUSD", "USD1", "EUR", "AEUR", "EURI"}
+UNIVERSE_LEVERAGED_RE = re.compile(r"^[A-Z0-9]{2,}(UP|DOWN|BULL|BEAR)$")
+SYMBOL_ALIASES = {
+    "BITCOIN": "BTC", "БИТКОИН": "BTC", "БИТОК": "BTC", "XBT": "BTC",
+    "ETHER": "ETH", "ETHEREUM": "ETH", "ЭФИР": "ETH", "ЭФИРИУМ": "ETH",
+    "TONCOIN": "TON", "ТОН": "TON", "SOLANA": "SOL", "СОЛАНА": "SOL",
+    "DOGECOIN": "DOGE", "ДОГ": "DOGE", "RIPPLE": "XRP", "TETHER": "USDT",
+    "MATIC": "POL", "POLYGON": "POL", "CARDANO": "ADA", "LITECOIN": "LTC",
+    "RNDR": "RENDER", "FTM": "S", "FANTOM": "S",
+}
+CONVERTER_MAX_ASSETS = 20  # позиций в одном сообщении конвертера
+CONVERTER_MARKETS_WAIT = 5  # на холодном старте столько ждём список рынков, прежде чем сказать «не нашёл», сек
+
+CURRENCY_SYMBOLS = {"USD": "$", "RUB": "₽", "EUR": "€", "UAH": "₴", "KZT": "₸"}
+CURRENCY_FLAGS = {"USD": "🇺🇸", "RUB": "🇷🇺", "EUR": "🇪🇺", "UAH": "🇺🇦", "KZT": "🇰🇿"}
+FIAT_ALIASES = {
+    "ДОЛЛАР": "USD", "ДОЛЛАРА": "USD", "ДОЛЛАРОВ": "USD", "БАКС": "USD", "БАКСА": "USD", "БАКСОВ": "USD",
+    "РУБ": "RUB", "РУБЛЬ": "RUB", "РУБЛЯ": "RUB", "РУБЛЕЙ": "RUB", "ЕВРО": "EUR",
+    "ГРН": "UAH", "ГРИВНА": "UAH", "ГРИВНЫ": "UAH", "ГРИВЕН": "UAH", "ТЕНГЕ": "KZT",
+}
 
 logging.basicConfig(
     level=logging.INFO,
@@ -56,667 +242,4094 @@ logging.basicConfig(
 )
 logger = logging.getLogger("CryptoAIAnalyst")
 
-bot = Bot(BOT_TOKEN)
-dp = Dispatcher()
-
-# Кэш для курсов фиата и AI-ответов
-# По умолчанию ставим заглушки, они обновятся при первом запросе
-fiat_cache: Dict[str, Any] = {"RUB": 100.0, "EUR": 0.95, "ts": 0.0}
-ai_cache: Dict[Tuple[str, str], Dict[str, Any]] = {}
-
-# Конфигурация Gemini
-if GEMINI_KEY and not GEMINI_KEY.startswith("ВАШ_"):
-    genai.configure(api_key=GEMINI_KEY)
-    gemini_model = genai.GenerativeModel("gemini-2.5-flash")
+if TELEGRAM_API_URL:
+    # Свой Bot API сервер (или локальный фейк для нагрузочных прогонов)
+    bot = Bot(BOT_TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)))
 else:
-    gemini_model = None
+    bot = Bot(BOT_TOKEN)
+dp = Dispatcher()
 
 # ==============================================================================
-# DATABASE (sqlite3)
+# METRICS (Prometheus text format)
 # ==============================================================================
 
-def init_db():
-    conn = sqlite3.connect(DB_FILE)
-    with conn:
-        conn.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY,
-                currency TEXT DEFAULT 'USD',
-                analysis_mode TEXT DEFAULT 'AI',
-                alert_percent REAL DEFAULT 3.0
-            )
-        """)
-        conn.execute("""
-            CREATE TABLE IF NOT EXISTS subs (
-                user_id INTEGER,
-                coin TEXT,
-                PRIMARY KEY (user_id, coin)
-            )
-        """)
-    conn.close()
-
-def get_user(user_id: int) -> dict:
-    conn = sqlite3.connect(DB_FILE)
-    conn.row_factory = sqlite3.Row
-    cur = conn.cursor()
-    cur.execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
-    row = cur.fetchone()
-    if not row:
-        with conn:
-            conn.execute("INSERT INTO users (user_id) VALUES (?)", (user_id,))
-        conn.close()
-        return {"user_id": user_id, "currency": "USD", "analysis_mode": "AI", "alert_percent": 3.0}
-    data = dict(row)
-    conn.close()
-    return data
-
-def update_user(user_id: int, column: str, value: Any):
-    conn = sqlite3.connect(DB_FILE)
-    with conn:
-        conn.execute(f"UPDATE users SET {column} = ? WHERE user_id = ?", (value, user_id))
-    conn.close()
-
-def toggle_sub(user_id: int, coin: str) -> bool:
-    conn = sqlite3.connect(DB_FILE)
-    cur = conn.cursor()
-    cur.execute("SELECT 1 FROM subs WHERE user_id = ? AND coin = ?", (user_id, coin))
-    exists = cur.fetchone()
-    with conn:
-        if exists:
-            conn.execute("DELETE FROM subs WHERE user_id = ? AND coin = ?", (user_id, coin))
-            conn.close()
-            return False
-        conn.execute("INSERT INTO subs (user_id, coin) VALUES (?, ?)", (user_id, coin))
-    conn.close()
-    return True
+class _NullTimer:
+    """Таймер-пустышка: при выключенных метриках замер стоит один вызов функции."""
 
-def get_subs(user_id: int) -> List[str]:
-    conn = sqlite3.connect(DB_FILE)
-    cur = conn.cursor()
-    cur.execute("SELECT coin FROM subs WHERE user_id = ?", (user_id,))
-    res = [r[0] for r in cur.fetchall()]
-    conn.close()
-    return res
-
-def get_subscribers(coin: str) -> List[dict]:
-    conn = sqlite3.connect(DB_FILE)
-    conn.row_factory = sqlite3.Row
-    cur = conn.cursor()
-    cur.execute("""
-        SELECT u.user_id, u.currency, u.alert_percent
-        FROM subs s
-        JOIN users u ON u.user_id = s.user_id
-        WHERE s.coin = ?
-    """, (coin,))
-    res = [dict(r) for r in cur.fetchall()]
-    conn.close()
-    return res
+    def __enter__(self):
+        return self
 
-# ==============================================================================
-# MARKET DATA & TECH ANALYSIS
-# ==============================================================================
+    def __exit__(self, *exc):
+        return False
 
-async def get_fiat_rates() -> Dict[str, float]:
+_NULL_TIMER = _NullTimer()
+
+class _Timer:
+    __slots__ = ("_metrics", "_name", "_labels", "_start")
+
+    def __init__(self, metrics: "Metrics", name: str, labels: Tuple[Tuple[str, str], ...]):
+        self._metrics = metrics
+        self._name = name
+        self._labels = labels
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        labels = self._labels + (("status", "error" if exc_type else "ok"),)
+        self._metrics._observe(self._name, time.perf_counter() - self._start, labels)
+        return False
+
+class Metrics:
     """
-    Парсит актуальные курсы валют с открытого API.
+    Гистограммы задержек, счётчики и гауджи в памяти процесса, отдаются по HTTP
+    в текстовом формате Prometheus. Счётчики, которые модули и так ведут в своих
+    stats-словарях (кэши, очередь алертов), не дублируются: их читают коллекторы
+    в момент скрейпа. Выключенные метрики — ранний return во всех методах.
     """
-    now = time.time()
-    # Если кэш свежий, возвращаем его
-    if now - fiat_cache["ts"] < FIAT_CACHE_TTL:
-        return fiat_cache
 
-    try:
-        async with aiohttp.ClientSession() as session:
-            # Используем бесплатный и надежный API для курсов относительно USD
-            async with session.get('https://api.exchangerate-api.com/v4/latest/USD') as resp:
-                if resp.status == 200:
-                    data = await resp.json()
-                    rates = data.get('rates', {})
-                    # Обновляем кэш (USD -> RUB, USD -> EUR)
-                    if 'RUB' in rates:
-                        fiat_cache["RUB"] = rates['RUB']
-                    if 'EUR' in rates:
-                        fiat_cache["EUR"] = rates['EUR']
-                    fiat_cache["ts"] = now
-                    logger.info(f"Fiat rates updated: USD/RUB={fiat_cache['RUB']}, USD/EUR={fiat_cache['EUR']}")
-                else:
-                    logger.error("Failed to fetch fiat rates: Status not 200")
-    except Exception as e:
-        logger.error(f"Fiat update error: {e}")
+    def __init__(self, buckets: Tuple[float, ...] = METRICS_BUCKETS):
+        self.enabled = False
+        self.buckets = buckets
+        self._help: Dict[str, Tuple[str, str]] = {}
+        self._counters: Dict[Tuple[str, tuple], float] = {}
+        self._gauges: Dict[Tuple[str, tuple], float] = {}
+        self._histograms: Dict[Tuple[str, tuple], List[float]] = {}
+        self._collectors: List[Callable[[], List[Tuple[str, str, str, Dict[str, str], float]]]] = []
+        self._runner: Optional[web.AppRunner] = None
 
-    return fiat_cache
+    def describe(self, name: str, kind: str, help_text: str):
+        self._help[name] = (kind, help_text)
 
-def convert_price_usd(price_usd: float, currency: str, rates: Dict[str, float]) -> str:
-    symbol = CURRENCY_SYMBOLS.get(currency, "$")
-    if currency == "USD":
-        value = price_usd
-    elif currency == "RUB":
-        value = price_usd * rates["RUB"]
-    elif currency == "EUR":
-        value = price_usd * rates["EUR"]
-    else:
-        value = price_usd
+    def inc(self, name: str, value: float = 1.0, **labels: str):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        self._counters[key] = self._counters.get(key, 0.0) + value
 
-    if value < 1:
-        return f"{symbol}{value:.4f}"
-    if value < 100:
-        return f"{symbol}{value:.2f}"
-    return f"{symbol}{value:,.0f}".replace(",", " ")
+    def set(self, name: str, value: float, **labels: str):
+        if not self.enabled:
+            return
+        self._gauges[(name, tuple(sorted(labels.items())))] = value
 
-def calc_rsi(prices: List[float], period: int = RSI_PERIOD) -> Optional[float]:
-    if len(prices) < period + 1:
-        return None
-    deltas = [prices[i] - prices[i - 1] for i in range(1, len(prices))]
-    gains = [d if d > 0 else 0 for d in deltas]
-    losses = [abs(d) if d < 0 else 0 for d in deltas]
+    def observe(self, name: str, seconds: float, **labels: str):
+        if self.enabled:
+            self._observe(name, seconds, tuple(sorted(labels.items())))
 
-    avg_gain = sum(gains[:period]) / period
-    avg_loss = sum(losses[:period]) / period
+    def _observe(self, name: str, seconds: float, labels: tuple):
+        hist = self._histograms.get((name, labels))
+        if hist is None:
+            # Счётчики по корзинам, затем сумма и количество
+            hist = self._histograms[(name, labels)] = [0.0] * (len(self.buckets) + 3)
+        hist[bisect.bisect_left(self.buckets, seconds)] += 1
+        hist[-2] += seconds
+        hist[-1] += 1
 
-    for i in range(period, len(prices) - 1):
-        avg_gain = (avg_gain * (period - 1) + gains[i]) / period
-        avg_loss = (avg_loss * (period - 1) + losses[i]) / period
+    def timer(self, name: str, **labels: str):
+        """with metrics.timer("x_seconds", method="y"): ... — метка status=ok|error добавляется сама."""
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self, name, tuple(sorted(labels.items())))
 
-    if avg_loss == 0:
-        return 100.0 if avg_gain > 0 else 50.0
-    rs = avg_gain / avg_loss
-    return 100 - (100 / (1 + rs))
+    def add_collector(self, fn: Callable[[], List[Tuple[str, str, str, Dict[str, str], float]]]):
+        """fn() -> [(name, kind, help, labels, value), ...], вызывается на каждом скрейпе."""
+        self._collectors.append(fn)
 
-def calc_sma(prices: List[float], period: int = SMA_PERIOD) -> Optional[float]:
-    if len(prices) < period:
-        return None
-    return sum(prices[-period:]) / period
+    @staticmethod
+    def _fmt_labels(labels: Any) -> str:
+        items = labels.items() if isinstance(labels, dict) else labels
+        if not items:
+            return ""
+        return "{" + ",".join(f'{k}="{v}"' for k, v in items) + "}"
 
-# ==============================================================================
-# GEMINI AI INTEGRATION
-# ==============================================================================
+    def render(self) -> str:
+        lines: List[str] = []
+        seen: set = set()
 
-async def get_ai_analysis(
-    coin: str,
-    price_usd: float,
-    rsi: Optional[float],
-    change_24h: float,
-    volume_usdt: float,
-    distance_from_high_pct: float,
-    mode_label: str,
-) -> Optional[str]:
-    if gemini_model is None:
-        return None
+        def _header(name: str, kind: str, help_text: str = ""):
+            if name in seen:
+                return
+            seen.add(name)
+            kind, help_text = self._help.get(name, (kind, help_text))
+            lines.append(f"# HELP {name} {help_text or name}")
+            lines.append(f"# TYPE {name} {kind}")
 
-    try:
-        # Подготовка строки RSI заранее
-        rsi_str = f"{rsi:.2f}" if rsi is not None else "нет данных"
-        
-        base_prompt = (
-            f"Монета: {coin}\n"
-            f"Текущая цена (USDT): {price_usd:.4f}\n"
-            f"RSI(14): {rsi_str}\n"
-            f"Изменение за 24ч (%): {change_24h:.2f}\n"
-            f"Объем за 24ч (USDT): {volume_usdt:.0f}\n"
-            f"Отдаление от локального максимума 24ч (%): {distance_from_high_pct:.2f}\n"
-            f"Режим анализа: {mode_label}\n\n"
-            "Сформируй короткий вывод в 3-6 предложениях."
-        )
+        for (name, labels), value in sorted(self._counters.items()):
+            _header(name, "counter")
+            lines.append(f"{name}{self._fmt_labels(labels)} {value}")
+        for (name, labels), value in sorted(self._gauges.items()):
+            _header(name, "gauge")
+            lines.append(f"{name}{self._fmt_labels(labels)} {value}")
+        for (name, labels), hist in sorted(self._histograms.items()):
+            _header(name, "histogram")
+            cumulative = 0.0
+            for bound, count in zip(self.buckets + (float("inf"),), hist):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"{name}_bucket{self._fmt_labels(labels + (('le', le),))} {cumulative}")
+            lines.append(f"{name}_sum{self._fmt_labels(labels)} {hist[-2]}")
+            lines.append(f"{name}_count{self._fmt_labels(labels)} {hist[-1]}")
+        for collect in self._collectors:
+            try:
+                samples = collect()
+            except Exception as e:
+                logger.error(f"Metrics collector error: {e}")
+                continue
+            for name, kind, help_text, labels, value in samples:
+                _header(name, kind, help_text)
+                lines.append(f"{name}{self._fmt_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
 
-        system_prompt = (
-            "Ты — опытный крипто-трейдер с циничным, но профессиональным стилем речи. "
-            "Твоя задача — проанализировать технические данные монеты и дать краткий, "
-            "жесткий и понятный вердикт на русском языке. Не используй сложные термины "
-            "без объяснения. Скажи прямо: покупать, продавать или ждать. Используй эмодзи."
-        )
+    async def start(self, host: str, port: int):
+        self.enabled = True
+        app = web.Application()
+        app.router.add_get("/metrics", self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        logger.info(f"Metrics on http://{host}:{port}/metrics")
 
-        # ИСПРАВЛЕНО: Убраны артефакты
-        # Мы просто склеиваем инструкции в один текст
-        full_prompt = f"{system_prompt}\n\n{base_prompt}"
-        
-        # И отправляем как простую строку
-        response = await gemini_model.generate_content_async(full_prompt)
-        if hasattr(response, "text") and response.text:
-            return response.text.strip()
-        return None
-    except Exception as e:
-        logger.error(f"Gemini error: {e}")
-        return None
+    async def _handle(self, request: web.Request) -> web.Response:
+        return web.Response(text=self.render(), content_type="text/plain", charset="utf-8")
+
+    async def close(self):
+        if self._runner:
+            await self._runner.cleanup()
+            self._runner = None
+
+metrics = Metrics()
 
 # ==============================================================================
-# KEYBOARDS
+# DATABASE (sqlite3)
 # ==============================================================================
 
-def main_menu_kb() -> ReplyKeyboardMarkup:
-    kb = [
-        [KeyboardButton(text="🧠 AI Прогноз"), KeyboardButton(text="📊 Статистика")],
-        [KeyboardButton(text="🔔 Подписки"), KeyboardButton(text="⚙️ Настройки")],
-    ]
-    return ReplyKeyboardMarkup(keyboard=kb, resize_keyboard=True)
+# Каждая миграция — список SQL, применяется один раз по PRAGMA user_version.
+# v1 совпадает со старой схемой, поэтому существующие crypto_ai_analyst.db подхватываются как есть.
+MIGRATIONS: List[List[str]] = [
+    [
+        """
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            currency TEXT DEFAULT 'USD',
+            analysis_mode TEXT DEFAULT 'AI',
+            alert_percent REAL DEFAULT 3.0
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS subs (
+            user_id INTEGER,
+            coin TEXT,
+            PRIMARY KEY (user_id, coin)
+        )
+        """,
+    ],
+    [
+        "CREATE INDEX IF NOT EXISTS idx_subs_coin ON subs (coin)",
+    ],
+    [
+        """
+        CREATE TABLE IF NOT EXISTS blocked_users (
+            user_id INTEGER PRIMARY KEY,
+            blocked_at REAL
+        )
+        """,
+    ],
+    [
+        "ALTER TABLE users ADD COLUMN ai_stream INTEGER DEFAULT 0",
+    ],
+    [
+        """
+        CREATE TABLE IF NOT EXISTS monitor_members (
+            member_id TEXT PRIMARY KEY,
+            heartbeat REAL
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS coin_anchors (
+            coin TEXT PRIMARY KEY,
+            price REAL,
+            updated_at REAL
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS alert_outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            coin TEXT,
+            text TEXT,
+            created REAL
+        )
+        """,
+    ],
+    [
+        # Якорь на каждую пару (юзер, монета) вместо общего на монету
+        """
+        CREATE TABLE IF NOT EXISTS alert_anchors (
+            user_id INTEGER,
+            coin TEXT,
+            anchor REAL,
+            updated_at REAL,
+            PRIMARY KEY (user_id, coin)
+        )
+        """,
+        "DROP TABLE IF EXISTS coin_anchors",
+    ],
+    [
+        # Список отслеживаемых монет, собранный лидером: остальные процессы читают его отсюда
+        """
+        CREATE TABLE IF NOT EXISTS market_universe (
+            coin TEXT PRIMARY KEY,
+            rank INTEGER
+        )
+        """,
+        # Переименованные на бирже пары: подписки переезжают, якоря считаем заново
+        "UPDATE OR IGNORE subs SET coin = 'POL/USDT' WHERE coin = 'MATIC/USDT'",
+        "UPDATE OR IGNORE subs SET coin = 'S/USDT' WHERE coin = 'FTM/USDT'",
+        "UPDATE OR IGNORE subs SET coin = 'RENDER/USDT' WHERE coin = 'RNDR/USDT'",
+        "DELETE FROM subs WHERE coin IN ('MATIC/USDT', 'FTM/USDT', 'RNDR/USDT')",
+        "DELETE FROM alert_anchors WHERE coin IN ('MATIC/USDT', 'FTM/USDT', 'RNDR/USDT')",
+    ],
+    [
+        "ALTER TABLE users ADD COLUMN alert_digest INTEGER DEFAULT 0",
+    ],
+]
 
-def settings_kb(user: dict) -> InlineKeyboardMarkup:
-    curr = user["currency"]
-    mode = user["analysis_mode"]
-    alert = user["alert_percent"]
-    
-    kb = [
-        [
-            InlineKeyboardButton(
-                text=f"{'✅ ' if curr=='USD' else ''}🇺🇸 USD", callback_data="set_curr_USD"
-            ),
-            InlineKeyboardButton(
-                text=f"{'✅ ' if curr=='RUB' else ''}🇷🇺 RUB", callback_data="set_curr_RUB"
-            ),
-            InlineKeyboardButton(
-                text=f"{'✅ ' if curr=='EUR' else ''}🇪🇺 EUR", callback_data="set_curr_EUR"
-            ),
-        ],
-        [
-            InlineKeyboardButton(
-                text=f"Чувствительность: {alert:.1f}%", callback_data="cycle_alert"
-            )
-        ],
-        [
-            InlineKeyboardButton(
-                text=f"Режим: {'🧊 Алгоритм' if mode=='ALG' else '🧠 AI'}",
-                callback_data="toggle_mode",
-            )
-        ],
-    ]
-    return InlineKeyboardMarkup(inline_keyboard=kb)
+USER_DEFAULTS = {"currency": "USD", "analysis_mode": "AI", "alert_percent": 3.0, "ai_stream": 0, "alert_digest": 0}
+# Заранее собранные UPDATE по белому списку колонок: и без SQL-инъекций, и попадают в кэш выражений
+USER_UPDATE_SQL = {
+    column: f"UPDATE users SET {column} = ? WHERE user_id = ?" for column in USER_DEFAULTS
+}
 
-def coins_kb(page: int, mode: str, user_id: Optional[int] = None) -> InlineKeyboardMarkup:
-    per_page = 10
-    start = page * per_page
-    end = start + per_page
-    coins_page = COINS[start:end]
-    subs = get_subs(user_id) if (user_id and mode == "subs") else []
+def _is_db_busy(e: Exception) -> bool:
+    """Базу держит другой процесс дольше busy_timeout — повторим позже, а не выбросим запись."""
+    return isinstance(e, sqlite3.OperationalError) and ("locked" in str(e) or "busy" in str(e))
 
-    rows: List[List[InlineKeyboardButton]] = []
-    row: List[InlineKeyboardButton] = []
+class Storage:
+    """
+    Одно долгоживущее соединение sqlite3 в выделенном потоке, чтобы диск не блокировал event loop.
+    WAL, кэш подготовленных выражений, записи копятся и сбрасываются одной транзакцией.
+    """
 
-    for coin in coins_page:
-        ticker = coin.split("/")[0]
-        if mode == "ai":
-            text = f"🧠 {ticker}"
-            cb = f"ai_{coin}_{page}"
-        elif mode == "stats":
-            text = f"📊 {ticker}"
-            cb = f"st_{coin}_{page}"
-        else:  # subs
-            sub_mark = "✅" if coin in subs else "☑️"
-            text = f"{sub_mark} {ticker}"
-            cb = f"sub_{coin}_{page}"
+    def __init__(self, path: str = DB_FILE):
+        self.path = path
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="storage")
+        self._conn: Optional[sqlite3.Connection] = None
+        self._pending: List[Tuple[str, Any]] = []
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self._flush_tasks: set = set()
+        # Сбросы идут строго по очереди: пачка, вернувшаяся на повтор, не обгонит более свежие записи
+        self._flush_lock = asyncio.Lock()
+        self._retry_delay = 0.0
+        # reads — синхронные походы в базу, writes — поставленные в очередь выражения,
+        # retries — пачки, отложенные из-за блокировки, dropped — выражения, которые база отвергла
+        self.stats = {"reads": 0, "writes": 0, "transactions": 0, "retries": 0, "dropped": 0}
 
-        row.append(InlineKeyboardButton(text=text, callback_data=cb))
-        if len(row) == 2:
-            rows.append(row)
-            row = []
+    async def _call(self, fn: Callable, *args) -> Any:
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
 
-    if row:
-        rows.append(row)
+    async def open(self):
+        await self._call(self._open_sync)
 
-    nav_row: List[InlineKeyboardButton] = []
-    if page > 0:
-        nav_row.append(InlineKeyboardButton(text="⬅️", callback_data=f"pg_{mode}_{page-1}"))
-    if end < len(COINS):
-        nav_row.append(InlineKeyboardButton(text="➡️", callback_data=f"pg_{mode}_{page+1}"))
-    if nav_row:
-        rows.append(nav_row)
+    def _open_sync(self):
+        self._conn = sqlite3.connect(
+            self.path, check_same_thread=False, cached_statements=STORAGE_STATEMENT_CACHE
+        )
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("PRAGMA busy_timeout=5000")
+        self._migrate()
 
-    return InlineKeyboardMarkup(inline_keyboard=rows)
+    def _migrate(self):
+        version = self._conn.execute("PRAGMA user_version").fetchone()[0]
+        for target, statements in enumerate(MIGRATIONS[version:], start=version + 1):
+            with self._conn:
+                for sql in statements:
+                    self._conn.execute(sql)
+                self._conn.execute(f"PRAGMA user_version = {target}")
+            logger.info(f"DB migrated to schema v{target}")
 
-# ==============================================================================
-# HANDLERS
-# ==============================================================================
+    def _apply(self, batch: List[Tuple[str, Any]], fn: Optional[Callable] = None) -> Any:
+        self.stats["transactions"] += 1
+        with self._conn:
+            for sql, params in batch:
+                if isinstance(params, list):
+                    self._conn.executemany(sql, params)
+                else:
+                    self._conn.execute(sql, params)
+            if fn is not None:
+                return fn(self._conn)
+        return None
 
-@dp.message(Command("start"))
-async def cmd_start(message: types.Message):
-    get_user(message.from_user.id)
-    await message.answer(
-        "🧠 Crypto AI Analyst\n\n"
-        "Я анализирую рынок, зову на помощь Gemini и говорю простым языком.\n"
-        "Нажми кнопку AI Прогноз или напиши сумму, например: 100 TON",
-        reply_markup=main_menu_kb(),
-        parse_mode="HTML",
-    )
+    def _apply_each(self, batch: List[Tuple[str, Any]]) -> List[Tuple[str, Any]]:
+        """
+        Пачку отвергли не из-за блокировки: применяем выражения по одному, чтобы потерять
+        только сломанное. Если по дороге база всё же оказалась занята — возвращаем остаток.
+        """
+        for i, item in enumerate(batch):
+            try:
+                self._apply([item])
+            except sqlite3.Error as e:
+                if _is_db_busy(e):
+                    return batch[i:]
+                self.stats["dropped"] += 1
+                logger.error(f"DB write dropped ({item[0].split()[0]}): {e}")
+        return []
 
-@dp.message(F.text == "⚙️ Настройки")
-async def cmd_settings(message: types.Message):
-    user = get_user(message.from_user.id)
-    await message.answer(
-        "⚙️ Настройки профиля:", parse_mode="HTML", reply_markup=settings_kb(user)
-    )
+    def _take_pending(self) -> List[Tuple[str, Any]]:
+        batch, self._pending = self._pending, []
+        if self._flush_handle:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        return batch
 
-@dp.callback_query(F.data.startswith("set_curr_"))
-async def cb_set_curr(call: CallbackQuery):
-    _, _, code = call.data.split("_")
-    update_user(call.from_user.id, "currency", code)
-    await call.message.edit_reply_markup(reply_markup=settings_kb(get_user(call.from_user.id)))
-    await call.answer(f"Валюта отображения: {code}")
+    async def run(self, fn: Callable[[sqlite3.Connection], Any]) -> Any:
+        """
+        Выполняет fn(conn) в потоке БД одной транзакцией.
+        Накопленные записи сбрасываются перед ней отдельной транзакцией: чтение видит
+        свои же записи, а ошибка чтения их не откатывает.
+        """
+        self.stats["reads"] += 1
+        await self.flush()
+        with metrics.timer("db_operation_seconds", op="read"):
+            return await self._call(self._apply, [], fn)
 
-@dp.callback_query(F.data == "cycle_alert")
-async def cb_cycle_alert(call: CallbackQuery):
-    user = get_user(call.from_user.id)
-    options = [1.0, 3.0, 5.0]
-    try:
-        idx = options.index(float(user["alert_percent"]))
-        new_val = options[(idx + 1) % len(options)]
-    except ValueError:
-        new_val = 3.0
-    update_user(call.from_user.id, "alert_percent", new_val)
-    await call.message.edit_reply_markup(reply_markup=settings_kb(get_user(call.from_user.id)))
-    await call.answer(f"Чувствительность: {new_val:.1f}%")
+    async def fetchone(self, sql: str, params: tuple = ()) -> Optional[sqlite3.Row]:
+        return await self.run(lambda conn: conn.execute(sql, params).fetchone())
 
-@dp.callback_query(F.data == "toggle_mode")
-async def cb_toggle_mode(call: CallbackQuery):
-    user = get_user(call.from_user.id)
-    new_mode = "ALG" if user["analysis_mode"] == "AI" else "AI"
-    update_user(call.from_user.id, "analysis_mode", new_mode)
-    await call.message.edit_reply_markup(reply_markup=settings_kb(get_user(call.from_user.id)))
-    await call.answer(f"Режим: {'AI' if new_mode=='AI' else 'Алгоритмический'}")
+    async def fetchall(self, sql: str, params: tuple = ()) -> List[sqlite3.Row]:
+        return await self.run(lambda conn: conn.execute(sql, params).fetchall())
 
-# --- Меню выбора монет ---
+    def write(self, sql: str, params: tuple = ()):
+        """Ставит запись в очередь без ожидания. Сброс — по таймеру или по размеру пачки."""
+        self.stats["writes"] += 1
+        self._enqueue(sql, params)
 
-@dp.message(F.text == "🧠 AI Прогноз")
-async def menu_ai(message: types.Message):
-    await message.answer(
-        "Выбери монету для анализа:", reply_markup=coins_kb(0, "ai"), parse_mode="HTML"
-    )
+    def write_many(self, sql: str, rows: List[tuple]):
+        """Одно выражение на много строк (executemany) — та же очередь, что и у write."""
+        self.stats["writes"] += len(rows)
+        self._enqueue(sql, rows)
 
-@dp.message(F.text == "📊 Статистика")
-async def menu_stats(message: types.Message):
-    await message.answer(
-        "Выбери монету для статистики за 24ч:",
-        reply_markup=coins_kb(0, "stats"),
-        parse_mode="HTML",
-    )
+    def _enqueue(self, sql: str, params: Any):
+        self._pending.append((sql, params))
+        if len(self._pending) >= STORAGE_BATCH_SIZE:
+            self._schedule_flush(0)
+        elif self._flush_handle is None:
+            self._schedule_flush(STORAGE_FLUSH_INTERVAL)
 
-@dp.message(F.text == "🔔 Подписки")
-async def menu_subs(message: types.Message):
-    await message.answer(
-        "Нажми на монету, чтобы подписаться/отписаться от сигналов:",
-        reply_markup=coins_kb(0, "subs", message.from_user.id),
-        parse_mode="HTML",
-    )
+    def _schedule_flush(self, delay: float):
+        if self._flush_handle:
+            self._flush_handle.cancel()
+        loop = asyncio.get_running_loop()
+        self._flush_handle = loop.call_later(delay, self._spawn_flush)
 
-@dp.callback_query(F.data.startswith("pg_"))
-async def cb_page(call: CallbackQuery):
-    _, mode, page = call.data.split("_")
-    page_i = int(page)
-    uid = call.from_user.id
-    await call.message.edit_reply_markup(
-        reply_markup=coins_kb(page_i, mode, uid if mode == "subs" else None)
-    )
-    await call.answer()
+    def _spawn_flush(self):
+        self._flush_handle = None
+        task = asyncio.create_task(self.flush())
+        self._flush_tasks.add(task)
+        task.add_done_callback(self._flush_tasks.discard)
 
-@dp.callback_query(F.data.startswith("sub_"))
-async def cb_sub(call: CallbackQuery):
-    _, coin, page = call.data.split("_")
-    added = toggle_sub(call.from_user.id, coin)
-    text = "Подписка включена" if added else "Подписка отключена"
-    await call.message.edit_reply_markup(
-        reply_markup=coins_kb(int(page), "subs", call.from_user.id)
-    )
-    await call.answer(text)
+    async def flush(self):
+        async with self._flush_lock:
+            batch = self._take_pending()
+            if not batch:
+                return
+            try:
+                with metrics.timer("db_operation_seconds", op="flush"):
+                    await self._call(self._apply, batch)
+                self._retry_delay = 0.0
+                return
+            except sqlite3.Error as e:
+                if _is_db_busy(e):
+                    left = batch
+                else:
+                    logger.error(f"DB batch write error ({len(batch)} statements), applying one by one: {e}")
+                    left = await self._call(self._apply_each, batch)
+                if left:
+                    self._requeue(left, e)
 
-# --- Статистика ---
+    def _requeue(self, batch: List[Tuple[str, Any]], error: Exception):
+        """База занята другим процессом: возвращаем пачку в начало очереди и повторяем с растущей паузой."""
+        self._pending = batch + self._pending
+        lo, hi = STORAGE_RETRY_DELAY
+        self._retry_delay = min(max(self._retry_delay * 2, lo), hi)
+        self.stats["retries"] += 1
+        logger.warning(f"DB busy ({error}), retrying {len(batch)} statements in {self._retry_delay:.1f}s")
+        self._schedule_flush(self._retry_delay)
 
-@dp.callback_query(F.data.startswith("st_"))
-async def cb_stats(call: CallbackQuery):
-    coin = call.data.split("_")[1]
-    user = get_user(call.from_user.id)
-    await call.message.edit_text(f"📊 Собираю статистику по {coin}...", parse_mode="HTML")
+    async def close(self):
+        for _ in range(STORAGE_CLOSE_ATTEMPTS):
+            await self.flush()
+            if not self._pending:
+                break
+            await asyncio.sleep(self._retry_delay)
+        if self._pending:
+            logger.error(f"DB closed with {len(self._take_pending())} unwritten statements")
+        if self._conn is not None:
+            await self._call(self._conn.close)
+            self._conn = None
+        self._executor.shutdown(wait=True)
 
-    exchange = ccxt.binance()
-    try:
-        ticker = await exchange.fetch_ticker(coin)
-        price = ticker["last"]
-        change_pct = ticker.get("percentage", 0.0) or 0.0
-        open_price = ticker.get("open", price - 1e-8)
-        abs_change = price - open_price
-        high = ticker.get("high", price)
-        low = ticker.get("low", price)
-        vol = ticker.get("quoteVolume", 0.0)
+storage = Storage()
 
-        rates = await get_fiat_rates()
-        price_str = convert_price_usd(price, user["currency"], rates)
-
-        liq_warning = ""
-        if vol < 1_000_000:
-            liq_warning = "\n⚠️ Мало ликвидности. Спреды могут быть высокими."
-
-        sign = "+" if change_pct >= 0 else ""
-        msg = (
-            f"📊 Статистика за 24ч: {coin}\n\n"
-            f"💰 Цена: {price_str}\n"
-            f"📈 Изменение: {sign}{change_pct:.2f}% ({abs_change:+.4f} USDT)\n\n"
-            f"🔝 High 24h: {high:.4f}\n"
-            f"🔻 Low 24h: {low:.4f}\n"
-            f"💸 Объем: {vol:,.0f} USDT{liq_warning}"
-        )
-        await call.message.edit_text(msg, parse_mode="HTML")
-    except Exception as e:
-        logger.error(f"Stats error {coin}: {e}")
-        await call.message.edit_text("⚠️ Не удалось получить статистику, попробуйте позже.")
-    finally:
-        await exchange.close()
+async def init_db():
+    await storage.open()
 
-# --- AI ПРОГНОЗ (Gemini + кэш) ---
+class UserCache:
+    """
+    Горячие строки users в памяти, LRU с ограничением размера.
+    Запись сквозная: кэш меняется сразу, а UPDATE уходит в очередь Storage
+    и пишется фоном пачкой — клик по кнопке не ждёт базу.
+    """
 
-@dp.callback_query(F.data.startswith("ai_"))
-async def cb_ai(call: CallbackQuery):
-    coin = call.data.split("_")[1]
-    user = get_user(call.from_user.id)
-    currency = user["currency"]
-    mode = user["analysis_mode"]
+    def __init__(self, max_size: int, ttl: Optional[float] = None):
+        self.max_size = max_size
+        self.ttl = ttl  # None — строки живут, пока их не вытеснит LRU
+        self._rows: "OrderedDict[int, Dict[str, Any]]" = OrderedDict()
+        self._loaded: Dict[int, float] = {}
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
 
-    await call.message.edit_text(f"🧠 Анализирую {coin}...", parse_mode="HTML")
+    def __len__(self) -> int:
+        return len(self._rows)
 
-    # Проверяем кэш
-    cache_key = (coin, currency)
-    now = time.time()
-    if cache_key in ai_cache and now - ai_cache[cache_key]["ts"] < AI_CACHE_TTL:
-        cached = ai_cache[cache_key]["text"]
-        await call.message.edit_text(cached, parse_mode="HTML")
-        await call.answer("Ответ из кэша")
-        return
+    def peek(self, user_id: int) -> Optional[Dict[str, Any]]:
+        return self._rows.get(user_id)
 
-    exchange = ccxt.binance()
-    try:
-        ticker = await exchange.fetch_ticker(coin)
-        ohlcv = await exchange.fetch_ohlcv(coin, timeframe="1h", limit=50)
-        closes = [c[4] for c in ohlcv]
+    def _put(self, user_id: int, row: Dict[str, Any]) -> Dict[str, Any]:
+        self._rows[user_id] = row
+        self._rows.move_to_end(user_id)
+        self._loaded[user_id] = time.monotonic()
+        while len(self._rows) > self.max_size:
+            evicted, _ = self._rows.popitem(last=False)
+            self._loaded.pop(evicted, None)
+            self.stats["evictions"] += 1
+        return row
 
-        price = ticker["last"]
-        rsi = calc_rsi(closes)
-        change_24 = ticker.get("percentage", 0.0) or 0.0
-        high24 = ticker.get("high", price)
-        dist_from_high = ((high24 - price) / high24 * 100) if high24 else 0.0
-        vol = ticker.get("quoteVolume", 0.0)
+    async def get(self, user_id: int) -> Dict[str, Any]:
+        row = self._rows.get(user_id)
+        if row is not None and self.ttl is not None and time.monotonic() - self._loaded[user_id] > self.ttl:
+            row = None
+        if row is not None:
+            self.stats["hits"] += 1
+            self._rows.move_to_end(user_id)
+            return row
+        self.stats["misses"] += 1
+        db_row = await storage.fetchone("SELECT * FROM users WHERE user_id = ?", (user_id,))
+        if db_row is None:
+            storage.write("INSERT OR IGNORE INTO users (user_id) VALUES (?)", (user_id,))
+            loaded = {"user_id": user_id, **USER_DEFAULTS}
+        else:
+            loaded = dict(db_row)
+        # Индекс подписок держит ссылку на профиль — используем тот же объект,
+        # чтобы настройки и алерты видели одни и те же значения
+        row = subscription_index.profile(user_id)
+        if row is not None:
+            row.update(loaded)
+        else:
+            row = loaded
+        return self._put(user_id, row)
 
-        rates = await get_fiat_rates()
-        price_str = convert_price_usd(price, currency, rates)
-
-        # Попытка AI-анализа
-        ai_text = None
-        if mode == "AI":
-            ai_text_raw = await get_ai_analysis(
-                coin=coin,
-                price_usd=price,
-                rsi=rsi,
-                change_24h=change_24,
-                volume_usdt=vol,
-                distance_from_high_pct=dist_from_high,
-                mode_label="AI",
-            )
-            if ai_text_raw:
-                ai_text = (
-                    f"🧠 AI-прогноз по {coin}\n\n"
-                    f"💰 Цена: {price_str}\n"
-                    f"RSI(14): {int(rsi) if rsi else '-'} | Изм.24ч: {change_24:.2f}%\n\n"
-                    f"{ai_text_raw}"
+    def update(self, user_id: int, column: str, value: Any):
+        storage.write(USER_UPDATE_SQL[column], (value, user_id))
+        # Индекс первым: ему нужен старый порог, чтобы переставить юзера
+        subscription_index.update_user(user_id, column, value)
+        row = self._rows.get(user_id)
+        if row is not None:
+            row[column] = value
+
+user_cache = UserCache(USER_CACHE_SIZE)
+
+async def get_user(user_id: int) -> dict:
+    return dict(await user_cache.get(user_id))
+
+async def update_user(user_id: int, column: str, value: Any):
+    user_cache.update(user_id, column, value)
+
+def _toggle_sub_sync(conn: sqlite3.Connection, user_id: int, coin: str) -> bool:
+    # Начинаем с DELETE: он сразу берёт блокировку записи, так что два воркера
+    # не могут одновременно решить «подписать» по устаревшему чтению
+    if conn.execute("DELETE FROM subs WHERE user_id = ? AND coin = ?", (user_id, coin)).rowcount:
+        conn.execute("DELETE FROM alert_anchors WHERE user_id = ? AND coin = ?", (user_id, coin))
+        return False
+    conn.execute("INSERT INTO subs (user_id, coin) VALUES (?, ?)", (user_id, coin))
+    return True
+
+async def toggle_sub(user_id: int, coin: str) -> bool:
+    if SHARED_WORKERS:
+        # Индекс соседних воркеров отстаёт до SHARED_RESYNC_INTERVAL — решает база,
+        # а свой индекс правим уже по её ответу
+        added = await storage.run(lambda conn: _toggle_sub_sync(conn, user_id, coin))
+    else:
+        # Один процесс: индекс содержит все подписки, решение принимаем без чтения из базы
+        added = coin not in subscription_index.coins(user_id)
+        if added:
+            storage.write("INSERT OR IGNORE INTO subs (user_id, coin) VALUES (?, ?)", (user_id, coin))
+        else:
+            storage.write("DELETE FROM subs WHERE user_id = ? AND coin = ?", (user_id, coin))
+            storage.write("DELETE FROM alert_anchors WHERE user_id = ? AND coin = ?", (user_id, coin))
+    if not added:
+        subscription_index.remove(user_id, coin)
+        return False
+    user = await user_cache.get(user_id)
+    subscription_index.add(user_id, coin, user["currency"], user["alert_percent"], alert_digest=user["alert_digest"])
+    return True
+
+async def get_subs(user_id: int) -> List[str]:
+    if SHARED_WORKERS:
+        # Подписку могли поменять через другой воркер: галочки рисуем по базе
+        rows = await storage.fetchall("""
+            SELECT s.coin, a.anchor
+            FROM subs s
+            LEFT JOIN alert_anchors a ON a.user_id = s.user_id AND a.coin = s.coin
+            WHERE s.user_id = ?
+        """, (user_id,))
+        coins = {r["coin"]: r["anchor"] for r in rows}
+        if coins.keys() != subscription_index.coins(user_id):
+            subscription_index.sync_user(await user_cache.get(user_id), coins)
+    return sorted(subscription_index.coins(user_id))
+
+async def mark_user_blocked(user_id: int):
+    """Юзер заблокировал бота: запоминаем это и снимаем все его подписки."""
+    storage.write(
+        "INSERT OR REPLACE INTO blocked_users (user_id, blocked_at) VALUES (?, ?)",
+        (user_id, time.time()),
+    )
+    storage.write("DELETE FROM subs WHERE user_id = ?", (user_id,))
+    storage.write("DELETE FROM alert_anchors WHERE user_id = ?", (user_id,))
+    subscription_index.remove_user(user_id)
+    logger.info(f"User {user_id} blocked the bot, subscriptions pruned")
+
+# ==============================================================================
+# SUBSCRIPTION INDEX & ANCHOR ENGINE (in-memory)
+# ==============================================================================
+
+class CoinBook:
+    """
+    Подписчики одной монеты в параллельных NumPy-массивах: user_id, порог и личная
+    опорная цена (NaN — ещё не выставлена). Ёмкость растёт удвоением, удаление —
+    перестановкой последнего элемента на место удалённого.
+    """
+
+    def __init__(self, capacity: int = 16):
+        self.size = 0
+        self.user_ids = np.zeros(capacity, dtype=np.int64)
+        self.thresholds = np.zeros(capacity, dtype=np.float64)
+        self.anchors = np.full(capacity, np.nan, dtype=np.float64)
+        self.pos: Dict[int, int] = {}
+
+    def _grow(self):
+        capacity = len(self.user_ids) * 2
+        for name, fill in (("user_ids", 0), ("thresholds", 0.0), ("anchors", np.nan)):
+            old = getattr(self, name)
+            new = np.full(capacity, fill, dtype=old.dtype)
+            new[:self.size] = old[:self.size]
+            setattr(self, name, new)
+
+    def add(self, user_id: int, threshold: float, anchor: float = np.nan):
+        if user_id in self.pos:
+            return
+        if self.size == len(self.user_ids):
+            self._grow()
+        i = self.size
+        self.user_ids[i], self.thresholds[i], self.anchors[i] = user_id, threshold, anchor
+        self.pos[user_id] = i
+        self.size += 1
+
+    def remove(self, user_id: int):
+        i = self.pos.pop(user_id, None)
+        if i is None:
+            return
+        last = self.size - 1
+        if i != last:
+            moved = int(self.user_ids[last])
+            self.user_ids[i], self.thresholds[i], self.anchors[i] = (
+                self.user_ids[last], self.thresholds[last], self.anchors[last]
+            )
+            self.pos[moved] = i
+        self.anchors[last] = np.nan
+        self.size = last
+
+    def evaluate(self, price: float) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Один векторный проход по всем подписчикам: (индексы сработавших, их изменение в %,
+        их старые якоря, индексы новых якорей). Якоря сработавших и новых сразу
+        переставляются на текущую цену.
+        """
+        n = self.size
+        anchors = self.anchors[:n]
+        fresh = np.flatnonzero(np.isnan(anchors))
+        with np.errstate(invalid="ignore", divide="ignore"):
+            change = (price - anchors) / anchors * 100.0
+        hit = np.flatnonzero(np.abs(change) >= self.thresholds[:n])
+        old = anchors[hit].copy()
+        anchors[hit] = price
+        anchors[fresh] = price
+        return hit, change[hit], old, fresh
+
+class SubscriptionIndex:
+    """
+    coin -> CoinBook подписчиков с порогами и личными якорями, плюс профили юзеров.
+    У каждого (юзер, монета) своя опорная цена: алерт 5%-юзеру не сбрасывается
+    из-за того, что сработал 1%-юзер. Якоря сохраняются в alert_anchors,
+    после рестарта движение считается от них же — без повторных алертов.
+    """
+
+    def __init__(self):
+        self._books: Dict[str, CoinBook] = {}
+        self._users: Dict[int, Dict[str, Any]] = {}
+        self._coins_by_user: Dict[int, set] = {}
+
+    async def rebuild(self):
+        rows = await storage.fetchall("""
+            SELECT s.user_id, s.coin, u.currency, u.alert_percent, u.alert_digest, a.anchor
+            FROM subs s
+            JOIN users u ON u.user_id = s.user_id
+            LEFT JOIN alert_anchors a ON a.user_id = s.user_id AND a.coin = s.coin
+        """)
+        for table in (self._books, self._users, self._coins_by_user):
+            table.clear()
+        for r in rows:
+            anchor = r["anchor"] if r["anchor"] is not None else np.nan
+            self.add(r["user_id"], r["coin"], r["currency"], r["alert_percent"], anchor, r["alert_digest"])
+        logger.info(f"Subscription index built: {len(rows)} subs, {len(self._users)} users")
+
+    async def reload_anchors(self, coins: List[str]):
+        """Перечитывает якоря монет из базы (монета переехала к этому процессу)."""
+        if not coins:
+            return
+        rows = await storage.fetchall(
+            f"SELECT user_id, coin, anchor FROM alert_anchors WHERE coin IN ({','.join('?' * len(coins))})",
+            tuple(coins),
+        )
+        for coin in coins:
+            book = self._books.get(coin)
+            if book is not None:
+                book.anchors[:book.size] = np.nan
+        for r in rows:
+            book = self._books.get(r["coin"])
+            i = book.pos.get(r["user_id"]) if book else None
+            if i is not None:
+                book.anchors[i] = r["anchor"]
+
+    def sync_user(self, user: Dict[str, Any], coins: Dict[str, Optional[float]]):
+        """Приводит подписки юзера к прочитанным из базы: coin -> якорь (None — ещё нет)."""
+        user_id = user["user_id"]
+        for coin in self.coins(user_id) - coins.keys():
+            self.remove(user_id, coin)
+        for coin, anchor in coins.items():
+            self.add(
+                user_id, coin, user["currency"], user["alert_percent"],
+                anchor if anchor is not None else np.nan, user["alert_digest"],
+            )
+
+    def remove_user(self, user_id: int):
+        for coin in list(self._coins_by_user.get(user_id, ())):
+            self.remove(user_id, coin)
+
+    def add(
+        self, user_id: int, coin: str, currency: str, alert_percent: float,
+        anchor: float = np.nan, alert_digest: int = 0,
+    ):
+        coins = self._coins_by_user.setdefault(user_id, set())
+        if coin in coins:
+            return
+        if user_id not in self._users:
+            profile = user_cache.peek(user_id) or {"user_id": user_id, "currency": currency}
+            profile["alert_percent"] = float(alert_percent)
+            profile["alert_digest"] = int(alert_digest or 0)
+            self._users[user_id] = profile
+        coins.add(coin)
+        self._books.setdefault(coin, CoinBook()).add(user_id, float(alert_percent), anchor)
+
+    def remove(self, user_id: int, coin: str):
+        coins = self._coins_by_user.get(user_id)
+        if not coins or coin not in coins:
+            return
+        self._books[coin].remove(user_id)
+        coins.discard(coin)
+        if not coins:
+            del self._coins_by_user[user_id]
+            del self._users[user_id]
+
+    def profile(self, user_id: int) -> Optional[Dict[str, Any]]:
+        return self._users.get(user_id)
+
+    def coins(self, user_id: int) -> set:
+        return self._coins_by_user.get(user_id, set())
+
+    def update_user(self, user_id: int, column: str, value: Any):
+        user = self._users.get(user_id)
+        if user is None:
+            return
+        if column == "alert_percent":
+            for coin in self._coins_by_user[user_id]:
+                book = self._books[coin]
+                book.thresholds[book.pos[user_id]] = float(value)
+            user["alert_percent"] = float(value)
+        elif column in ("currency", "alert_digest"):
+            user[column] = value
+
+    def count(self, coin: str) -> int:
+        book = self._books.get(coin)
+        return book.size if book else 0
+
+    def subscribed_coins(self) -> List[str]:
+        """Монеты, у которых есть хотя бы один подписчик."""
+        return [coin for coin, book in self._books.items() if book.size]
+
+    def evaluate(self, coin: str, price: float) -> List[dict]:
+        """
+        Сравнивает цену со всеми личными якорями монеты. Возвращает сработавших
+        (user_id, currency, change_pct, anchor); изменённые якоря уходят в базу пачкой.
+        """
+        book = self._books.get(coin)
+        if book is None or book.size == 0:
+            return []
+        hit, change, old, fresh = book.evaluate(price)
+        changed = np.concatenate((hit, fresh))
+        if len(changed):
+            now = time.time()
+            storage.write_many(
+                "INSERT OR REPLACE INTO alert_anchors (user_id, coin, anchor, updated_at) VALUES (?, ?, ?, ?)",
+                [(int(uid), coin, price, now) for uid in book.user_ids[changed]],
+            )
+        return [
+            {**self._users[int(uid)], "user_id": int(uid), "change_pct": float(pct), "anchor": float(anchor)}
+            for uid, pct, anchor in zip(book.user_ids[hit], change, old)
+        ]
+
+subscription_index = SubscriptionIndex()
+
+# ==============================================================================
+# SINGLE-FLIGHT (схлопывание одинаковых запросов)
+# ==============================================================================
+
+class SingleFlight:
+    """
+    Пока по ключу идёт вычисление, все остальные запросы с тем же ключом ждут его результат,
+    а не запускают свою копию. Вычисление живёт в отдельной задаче, поэтому отмена
+    одного из ожидающих не роняет результат для остальных.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._inflight: Dict[Any, asyncio.Task] = {}
+        self.stats = {"leaders": 0, "coalesced": 0}
+        single_flights.append(self)
+
+    async def do(self, key: Any, fn: Callable[[], Awaitable[Any]]) -> Any:
+        task = self._inflight.get(key)
+        if task is not None:
+            self.stats["coalesced"] += 1
+        else:
+            self.stats["leaders"] += 1
+            task = asyncio.ensure_future(fn())
+            self._inflight[key] = task
+            task.add_done_callback(lambda t, k=key: self._finish(k, t))
+        return await asyncio.shield(task)
+
+    def _finish(self, key: Any, task: asyncio.Task):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        # Забираем исключение, чтобы asyncio не ругался, если все ожидающие отменились
+        if not task.cancelled():
+            task.exception()
+
+class StreamFlight:
+    """
+    Потоковый вариант SingleFlight: пока по ключу идёт стрим, остальные не запускают свой,
+    а подписываются на этот — сразу получают уже пришедший текст и дальше те же куски.
+    Стрим живёт в отдельной задаче и доходит до конца, даже если все подписчики ушли.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._inflight: Dict[Any, SimpleNamespace] = {}
+        self.stats = {"leaders": 0, "coalesced": 0}
+        single_flights.append(self)
+
+    async def follow(self, key: Any, fn: Callable[[], AsyncIterator[str]]) -> AsyncIterator[str]:
+        """Отдаёт весь накопленный текст каждый раз, когда он прирастает."""
+        flight = self._inflight.get(key)
+        if flight is not None:
+            self.stats["coalesced"] += 1
+        else:
+            self.stats["leaders"] += 1
+            flight = SimpleNamespace(parts=[], done=False, changed=asyncio.Event())
+            self._inflight[key] = flight
+            flight.task = asyncio.ensure_future(self._pump(key, flight, fn()))
+        seen = 0
+        while True:
+            if len(flight.parts) > seen:
+                seen = len(flight.parts)
+                yield "".join(flight.parts)
+            if flight.done:
+                return
+            await flight.changed.wait()
+
+    @staticmethod
+    def _notify(flight: SimpleNamespace):
+        changed, flight.changed = flight.changed, asyncio.Event()
+        changed.set()
+
+    async def _pump(self, key: Any, flight: SimpleNamespace, chunks: AsyncIterator[str]):
+        try:
+            async for chunk in chunks:
+                flight.parts.append(chunk)
+                self._notify(flight)
+        except Exception as e:
+            logger.error(f"Stream {self.name} error for {key}: {e}")
+        finally:
+            flight.done = True
+            if self._inflight.get(key) is flight:
+                del self._inflight[key]
+            self._notify(flight)
+
+def spawn_background(coro: Awaitable[Any], label: str):
+    """Фоновая задача «запустил и забыл»: держим ссылку и логируем ошибку."""
+    task = asyncio.ensure_future(coro)
+    background_tasks.add(task)
+
+    def _done(t: asyncio.Task):
+        background_tasks.discard(t)
+        if not t.cancelled() and t.exception():
+            logger.error(f"Background {label} error: {t.exception()}")
+
+    task.add_done_callback(_done)
+
+background_tasks: set = set()
+single_flights: List[SingleFlight] = []
+ai_flight = SingleFlight("ai")
+ai_stream_flight = StreamFlight("ai_stream")
+ticker_flight = SingleFlight("ticker")
+fiat_flight = SingleFlight("fiat")
+
+# ==============================================================================
+# ANALYSIS CACHE (LRU + TTL)
+# ==============================================================================
+
+class AnalysisCache:
+    """
+    Ограниченный LRU-кэш с TTL и режимом stale-while-revalidate.
+    get() возвращает (значение, состояние): "fresh" — отдаём как есть, "stale" — отдаём,
+    но пора обновить в фоне, "miss" — считать заново.
+    """
+
+    def __init__(self, ttl: float, stale_ttl: float, max_size: int):
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.max_size = max_size
+        self._data: "OrderedDict[Any, Tuple[float, Any]]" = OrderedDict()
+        self.stats = {"hits": 0, "stale_hits": 0, "misses": 0, "evictions": 0}
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def peek(self, key: Any) -> Tuple[Optional[Any], str]:
+        """То же, что get(), но без статистики и без влияния на порядок LRU."""
+        item = self._data.get(key)
+        if item is None:
+            return None, "miss"
+        age = time.time() - item[0]
+        if age < self.ttl:
+            return item[1], "fresh"
+        if age < self.ttl + self.stale_ttl:
+            return item[1], "stale"
+        return None, "miss"
+
+    def get(self, key: Any) -> Tuple[Optional[Any], str]:
+        value, state = self.peek(key)
+        if state == "miss":
+            self.stats["misses"] += 1
+            if key in self._data:
+                del self._data[key]
+                self.stats["evictions"] += 1
+            return None, state
+        self.stats["hits" if state == "fresh" else "stale_hits"] += 1
+        self._data.move_to_end(key)
+        return value, state
+
+    def set(self, key: Any, value: Any, ts: Optional[float] = None):
+        self._data[key] = (ts if ts is not None else time.time(), value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    def dump(self, max_age: float) -> List[Tuple[Any, float, Any]]:
+        """Записи (key, ts, value) не старше max_age в порядке LRU — для тёплого старта."""
+        limit = time.time() - max_age
+        return [(key, ts, value) for key, (ts, value) in self._data.items() if ts > limit]
+
+    def restore(self, items: List[Tuple[Any, float, Any]], max_age: float) -> int:
+        """
+        Записи не старше max_age. Свежие остаются свежими, остальные встают в начало окна
+        stale: первый же запрос получит их сразу и запустит обновление в фоне.
+        """
+        now = time.time()
+        restored = 0
+        for key, ts, value in items:
+            if now - ts > max_age:
+                continue
+            ts = max(ts, now - self.ttl)
+            current = self._data.get(key)
+            if current is None or current[0] < ts:
+                self.set(key, value, ts)
+                restored += 1
+        return restored
+
+# Кэш анализа по монете, не зависящий от валюты отображения: цена в валюте юзера
+# подставляется при ответе, так что USD- и RUB-юзер делят один вызов Gemini
+ai_cache = AnalysisCache(AI_CACHE_TTL, AI_CACHE_STALE_TTL, AI_CACHE_MAX_SIZE)
+
+# ==============================================================================
+# EXCHANGE CLIENT POOL
+# ==============================================================================
+
+class MeteredExchange:
+    """Обёртка клиента ccxt: каждый async-метод попадает в гистограмму с метками exchange и method."""
+
+    def __init__(self, exchange: Any):
+        self._exchange = exchange
+
+    def __getattr__(self, name: str) -> Any:
+        attr = getattr(self._exchange, name)
+        if not asyncio.iscoroutinefunction(attr):
+            return attr
+
+        async def _call(*args, **kwargs):
+            with metrics.timer("exchange_request_seconds", exchange=self._exchange.id, method=name):
+                return await attr(*args, **kwargs)
+        return _call
+
+class ExchangeUnavailable(Exception):
+    """Ни одна биржа не смогла ответить на запрос."""
+
+class SourceHealth:
+    """
+    Здоровье одной биржи: окно последних задержек, доля успехов (EWMA) и автомат.
+    После EXCHANGE_BREAKER_FAILURES ошибок подряд биржа выходит из ротации на
+    EXCHANGE_BREAKER_COOLDOWN секунд, потом пропускается один пробный запрос:
+    удался — автомат замыкается, нет — отдыхаем дальше.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.latencies: deque = deque(maxlen=EXCHANGE_LATENCY_WINDOW)
+        self.success_rate = 1.0
+        self.failures = 0
+        self.opened_at = 0.0  # 0 — автомат замкнут
+        self._probing = False
+        self.stats = {"ok": 0, "errors": 0, "opened": 0, "cancelled": 0}
+
+    @property
+    def is_open(self) -> bool:
+        return bool(self.opened_at) and time.monotonic() - self.opened_at < EXCHANGE_BREAKER_COOLDOWN
+
+    def allow(self) -> bool:
+        """Можно ли слать запрос сейчас. В полуоткрытом состоянии — только один пробный."""
+        if not self.opened_at:
+            return True
+        if self.is_open or self._probing:
+            return False
+        self._probing = True
+        return True
+
+    def record(self, ok: bool, latency: Optional[float] = None):
+        self._probing = False
+        self.success_rate += 0.1 * ((1.0 if ok else 0.0) - self.success_rate)
+        if ok:
+            self.stats["ok"] += 1
+            self.latencies.append(latency)
+            self.failures = 0
+            if self.opened_at:
+                logger.info(f"Exchange {self.name} is back, breaker closed")
+            self.opened_at = 0.0
+            return
+        self.stats["errors"] += 1
+        self.failures += 1
+        if self.opened_at or self.failures >= EXCHANGE_BREAKER_FAILURES:
+            if not self.is_open:
+                self.stats["opened"] += 1
+                logger.warning(f"Exchange {self.name}: {self.failures} failures in a row, breaker open")
+            self.opened_at = time.monotonic()
+
+    def cancelled(self, elapsed: float):
+        """Запрос проиграл дублю. Его время — нижняя оценка задержки, в окно её всё равно кладём."""
+        self._probing = False
+        self.stats["cancelled"] += 1
+        self.latencies.append(elapsed)
+
+    def percentile(self, p: float) -> Optional[float]:
+        if len(self.latencies) < 10:
+            return None
+        values = sorted(self.latencies)
+        return values[min(len(values) - 1, int(len(values) * p))]
+
+    def hedge_delay(self) -> float:
+        value = self.percentile(EXCHANGE_HEDGE_PERCENTILE)
+        if value is None:
+            return EXCHANGE_HEDGE_DEFAULT_DELAY
+        low, high = EXCHANGE_HEDGE_DELAY
+        return min(max(value, low), high)
+
+    def score(self) -> float:
+        p50 = self.percentile(0.5) or EXCHANGE_HEDGE_DEFAULT_DELAY
+        return self.success_rate / (0.05 + p50)
+
+class ExchangePool:
+    """
+    Один долгоживущий клиент биржи на всё приложение.
+    Держит тёплую aiohttp-сессию, грузит рынки один раз и обновляет их по расписанию.
+    """
+
+    def __init__(self, exchange_id: str = EXCHANGE_ID, concurrency: int = EXCHANGE_CONCURRENCY, api_url: str = ""):
+        self.exchange_id = exchange_id
+        self.api_url = api_url
+        self.health = SourceHealth(exchange_id)
+        self.exchange: Optional[Any] = None
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._start_lock = asyncio.Lock()
+        self._maintenance_task: Optional[asyncio.Task] = None
+        self._markets_ts = 0.0
+        self._last_used = 0.0
+        self._symbols: Dict[str, Optional[str]] = {}
+        self._symbols_version = -1.0
+
+    async def start(self):
+        async with self._start_lock:
+            if self.exchange is not None:
+                return
+            if not ccxt.loaded:
+                await asyncio.to_thread(ccxt.load)
+            self.exchange = getattr(ccxt, self.exchange_id)({"enableRateLimit": True})
+            if isinstance(self.exchange.options.get("fetchMarkets"), list):
+                # Нам нужен только спот: фьючерсные рынки не грузим
+                self.exchange.options["fetchMarkets"] = ["spot"]
+            if self.api_url:
+                self._override_urls(self.api_url)
+            await self._load_markets()
+            self._maintenance_task = asyncio.create_task(self._maintenance_loop())
+            logger.info(f"Exchange pool started: {self.exchange_id}, {len(self.exchange.markets or {})} markets")
+
+    def _override_urls(self, base: str):
+        """Все REST-адреса биржи на свой хост (пути сохраняются)."""
+        def _sub(value: Any) -> Any:
+            if isinstance(value, str):
+                return re.sub(r"^https?://[^/]+", base.rstrip("/"), value)
+            if isinstance(value, dict):
+                return {k: _sub(v) for k, v in value.items()}
+            return value
+
+        self.exchange.urls["api"] = _sub(self.exchange.urls["api"])
+
+    @property
+    def markets_version(self) -> float:
+        """Меняется при каждой удачной (пере)загрузке рынков."""
+        return self._markets_ts
+
+    def symbol_for(self, coin: str) -> Optional[str]:
+        """
+        Пара этой биржи для нашей монеты: та же пара, а если её нет — та же монета
+        к другому доллару из EXCHANGE_QUOTE_SUBSTITUTES. None — монета здесь не торгуется.
+        Пока рынки не загружены, отдаём как есть: ccxt догрузит их сам.
+        """
+        markets = self.exchange.markets if self.exchange is not None else None
+        if not markets:
+            return coin
+        if self._symbols_version != self._markets_ts:
+            self._symbols.clear()
+            self._symbols_version = self._markets_ts
+        if coin not in self._symbols:
+            base, quote = coin.split("/")
+            symbol = None
+            for q in (quote, *(x for x in EXCHANGE_QUOTE_SUBSTITUTES if x != quote)):
+                market = markets.get(f"{base}/{q}")
+                if market and market.get("active") is not False:
+                    symbol = market["symbol"]
+                    break
+            self._symbols[coin] = symbol
+        return self._symbols[coin]
+
+    async def _load_markets(self, reload: bool = False):
+        try:
+            async with self._semaphore:
+                await self.exchange.load_markets(reload=reload)
+            self._markets_ts = time.time()
+        except Exception as e:
+            # Без рынков ccxt догрузит их сам при первом запросе
+            logger.error(f"Markets load error: {e}")
+
+    async def _maintenance_loop(self):
+        while True:
+            await asyncio.sleep(EXCHANGE_KEEPALIVE)
+            now = time.time()
+            if now - self._markets_ts >= MARKETS_REFRESH_INTERVAL:
+                await self._load_markets(reload=True)
+            elif now - self._last_used >= EXCHANGE_KEEPALIVE:
+                # Дешёвый запрос, чтобы keep-alive соединения не закрылись по простою
+                try:
+                    async with self.acquire() as exchange:
+                        await exchange.fetch_time()
+                except Exception as e:
+                    logger.error(f"Exchange keepalive error: {e}")
+
+    @asynccontextmanager
+    async def acquire(self) -> AsyncIterator[Any]:
+        """Берём общий клиент в пользование с учётом лимита параллельных запросов."""
+        if self.exchange is None:
+            await self.start()
+        async with self._semaphore:
+            try:
+                yield MeteredExchange(self.exchange) if metrics.enabled else self.exchange
+            finally:
+                self._last_used = time.time()
+
+    async def close(self):
+        if self._maintenance_task:
+            self._maintenance_task.cancel()
+            self._maintenance_task = None
+        if self.exchange is not None:
+            await self.exchange.close()
+            self.exchange = None
+        logger.info("Exchange pool closed")
+
+exchange_pool = ExchangePool(api_url=EXCHANGE_API_URL)
+
+class PriceSource:
+    """
+    Рыночные данные с нескольких бирж: основная (exchange_pool) и резервные.
+    Запрос идёт на лучшую по здоровью биржу; если она молчит дольше своего
+    EXCHANGE_HEDGE_PERCENTILE задержек — тот же запрос дублируется на следующую,
+    берётся первый ответ. Ошибка — сразу переход к следующей, разомкнутые автоматы
+    пропускаются. Ответ всегда целиком с одной биржи и помечен, откуда он:
+    source, venue_symbol, hedged.
+    """
+
+    def __init__(self, pools: List[ExchangePool]):
+        self.pools = pools
+        self.primary = pools[0]
+        self.stats = {"hedged": 0, "hedge_wins": 0, "failovers": 0, "unavailable": 0}
+
+    async def start(self):
+        await self.primary.start()
+        # Резервные поднимаем фоном: загрузка их рынков не должна тормозить старт
+        for pool in self.pools[1:]:
+            spawn_background(pool.start(), f"exchange {pool.exchange_id} start")
+
+    async def close(self):
+        for pool in self.pools:
+            await pool.close()
+
+    def _ranked(self, pools: List[ExchangePool]) -> List[ExchangePool]:
+        def _score(pool: ExchangePool) -> float:
+            return pool.health.score() * (EXCHANGE_PRIMARY_BONUS if pool is self.primary else 1.0)
+        return sorted((p for p in pools if not p.health.is_open), key=_score, reverse=True)
+
+    async def _attempt(self, pool: ExchangePool, fn: Callable[[ExchangePool, Any], Awaitable[Any]]) -> Any:
+        started = time.monotonic()
+        try:
+            async with pool.acquire() as exchange:
+                result = await fn(pool, exchange)
+        except asyncio.CancelledError:
+            pool.health.cancelled(time.monotonic() - started)
+            raise
+        except Exception:
+            pool.health.record(False)
+            raise
+        pool.health.record(True, time.monotonic() - started)
+        return result
+
+    async def _hedged(
+        self, label: str, fn: Callable[[ExchangePool, Any], Awaitable[Any]], pools: List[ExchangePool],
+    ) -> Tuple[Any, ExchangePool, bool]:
+        queue = deque(self._ranked(pools))
+        pending: Dict[asyncio.Task, ExchangePool] = {}
+        hedges = 0
+        last_error: Optional[Exception] = None
+
+        def _launch() -> bool:
+            while queue:
+                pool = queue.popleft()
+                if pool.health.allow():
+                    pending[asyncio.create_task(self._attempt(pool, fn))] = pool
+                    return True
+            return False
+
+        _launch()
+        first = next(iter(pending.values()), None)
+        try:
+            while pending:
+                newest = list(pending.values())[-1]
+                timeout = newest.health.hedge_delay() if hedges < EXCHANGE_HEDGE_MAX and queue else None
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    # Биржа отвечает дольше обычного: подстраховываемся следующей
+                    if _launch():
+                        hedges += 1
+                        self.stats["hedged"] += 1
+                    continue
+                for task in done:
+                    pool = pending.pop(task)
+                    if task.exception() is None:
+                        if hedges and pool is not first:
+                            self.stats["hedge_wins"] += 1
+                        return task.result(), pool, hedges > 0
+                    last_error = task.exception()
+                    logger.warning(f"{label} failed on {pool.exchange_id}: {last_error}")
+                if not pending and _launch():
+                    self.stats["failovers"] += 1
+        finally:
+            for task in pending:
+                task.cancel()
+        self.stats["unavailable"] += 1
+        raise last_error or ExchangeUnavailable(f"{label}: no exchange available")
+
+    @staticmethod
+    def _quote(ticker: Dict[str, Any], coin: str, pool: ExchangePool, hedged: bool) -> Dict[str, Any]:
+        return {
+            **ticker, "symbol": coin, "venue_symbol": ticker.get("symbol"),
+            "source": pool.exchange_id, "hedged": hedged, "ts": time.time(),
+        }
+
+    async def ticker(self, coin: str) -> Dict[str, Any]:
+        async def _fetch(pool: ExchangePool, exchange: Any) -> Dict[str, Any]:
+            return await exchange.fetch_ticker(pool.symbol_for(coin))
+
+        pools = [p for p in self.pools if p.symbol_for(coin)]
+        ticker, pool, hedged = await self._hedged(f"fetch_ticker {coin}", _fetch, pools)
+        return self._quote(ticker, coin, pool, hedged)
+
+    async def tickers(self, coins: List[str]) -> Dict[str, Dict[str, Any]]:
+        """Тикеры пачкой. Весь снимок с одной биржи; монет, которых там нет, в нём не будет."""
+        async def _fetch(pool: ExchangePool, exchange: Any) -> Dict[str, Dict[str, Any]]:
+            symbols = {pool.symbol_for(c): c for c in coins}
+            symbols.pop(None, None)
+            if not symbols:
+                return {}
+            raw = await exchange.fetch_tickers(list(symbols))
+            return {symbols[sym]: t for sym, t in raw.items() if sym in symbols and t.get("last")}
+
+        if not coins:
+            return {}
+        raw, pool, hedged = await self._hedged(f"fetch_tickers x{len(coins)}", _fetch, self.pools)
+        return {coin: self._quote(t, coin, pool, hedged) for coin, t in raw.items()}
+
+    async def ohlcv(self, coin: str, timeframe: str, since: Optional[int] = None, limit: Optional[int] = None) -> List[List[float]]:
+        async def _fetch(pool: ExchangePool, exchange: Any) -> List[List[float]]:
+            return await exchange.fetch_ohlcv(pool.symbol_for(coin), timeframe=timeframe, since=since, limit=limit)
+
+        pools = [p for p in self.pools if p.symbol_for(coin)]
+        candles, _, _ = await self._hedged(f"fetch_ohlcv {coin}", _fetch, pools)
+        return candles
+
+price_source = PriceSource([
+    exchange_pool,
+    *(ExchangePool(x, api_url=EXCHANGE_FALLBACK_URLS.get(x, "")) for x in EXCHANGE_FALLBACKS if x != EXCHANGE_ID),
+])
+
+# ==============================================================================
+# MARKET SYMBOL INDEX
+# ==============================================================================
+
+class SymbolIndex:
+    """
+    Базовые активы торгуемых пар к QUOTE_ASSET, собранные из списка рынков биржи.
+    Ввод юзера проверяется по памяти: неизвестная монета отсекается без запроса к бирже,
+    алиасы («bitcoin», «эфир») разворачиваются, для опечаток подсказываем похожий тикер.
+    """
+
+    def __init__(self, quote: str = QUOTE_ASSET):
+        self.quote = quote
+        self._bases: set = set()
+        self._version = -1.0
+
+    def _ensure(self):
+        version = exchange_pool.markets_version
+        if version == self._version:
+            return
+        markets = exchange_pool.exchange.markets if exchange_pool.exchange else None
+        if markets:
+            self._bases = {
+                m["base"] for m in markets.values()
+                if m.get("quote") == self.quote and m.get("spot", True) and m.get("active") is not False
+            }
+            self._version = version
+        else:
+            # Рынки ещё не загрузились — знаем хотя бы свои монеты (и пересчитаем, когда загрузятся)
+            self._bases = {c.split("/")[0] for c in (*COINS, *coin_universe.coins)}
+
+    @property
+    def loaded(self) -> bool:
+        return bool(exchange_pool.exchange is not None and exchange_pool.exchange.markets)
+
+    async def wait_loaded(self, timeout: float) -> bool:
+        """Холодный старт: ждём список рынков, а не отвергаем тикер по запасному списку."""
+        if not self.loaded:
+            task = asyncio.ensure_future(exchange_pool.start())
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
+            await asyncio.wait({task}, timeout=timeout)
+        return self.loaded
+
+    def __len__(self) -> int:
+        self._ensure()
+        return len(self._bases)
+
+    def resolve(self, token: str) -> Tuple[Optional[str], Optional[str]]:
+        """(тикер или None, подсказка для опечатки или None)."""
+        self._ensure()
+        token = token.strip().upper()
+        if token in self._bases:
+            return token, None
+        alias = SYMBOL_ALIASES.get(token)
+        if alias in self._bases:
+            return alias, None
+        close = difflib.get_close_matches(token, list(self._bases) + list(SYMBOL_ALIASES), n=1, cutoff=0.75)
+        hint = SYMBOL_ALIASES.get(close[0], close[0]) if close else None
+        return None, hint
+
+    def pair(self, base: str) -> str:
+        return f"{base}/{self.quote}"
+
+symbol_index = SymbolIndex()
+
+# ==============================================================================
+# COIN UNIVERSE (какие монеты отслеживаем)
+# ==============================================================================
+
+class CoinUniverse:
+    """
+    Рабочий список монет: топ UNIVERSE_TOP_N пар к QUOTE_ASSET по объёму за 24ч
+    плюс все пары, на которые кто-то подписан. Собирает его лидер одним запросом
+    fetch_tickers по всем рынкам и кладёт в market_universe; остальные процессы
+    читают готовый список из базы. Подписчики (поток, снимки) узнают об изменениях
+    через слушателей.
+    """
+
+    def __init__(self, seed: List[str], top_n: int = UNIVERSE_TOP_N, quote: str = QUOTE_ASSET):
+        self.coins = list(seed)
+        self.top_n = top_n
+        self.quote = quote
+        self._listeners: List[Callable[[List[str]], None]] = []
+
+    def __len__(self) -> int:
+        return len(self.coins)
+
+    def add_listener(self, callback: Callable[[List[str]], None]):
+        """callback(coins) вызывается, когда список монет поменялся."""
+        self._listeners.append(callback)
+
+    def _eligible(self, market: Optional[Dict[str, Any]]) -> bool:
+        if not market or market.get("quote") != self.quote or not market.get("spot", True):
+            return False
+        if market.get("active") is False:
+            return False
+        base = market["base"]
+        return base not in UNIVERSE_EXCLUDE and not UNIVERSE_LEVERAGED_RE.match(base)
+
+    def _set(self, coins: List[str]):
+        if coins == self.coins:
+            return
+        added = len(set(coins) - set(self.coins))
+        removed = len(set(self.coins) - set(coins))
+        self.coins = coins
+        logger.info(f"Coin universe: {len(coins)} coins (+{added}/-{removed})")
+        for callback in self._listeners:
+            try:
+                callback(coins)
+            except Exception as e:
+                logger.error(f"Universe listener error: {e}")
+
+    async def refresh(self):
+        """Пересобирает список по бирже и сохраняет его для остальных процессов."""
+        async with exchange_pool.acquire() as exchange:
+            markets = exchange.markets or {}
+            tickers = await exchange.fetch_tickers()
+        ranked = sorted(
+            ((t.get("quoteVolume") or 0.0, sym) for sym, t in tickers.items() if self._eligible(markets.get(sym))),
+            reverse=True,
+        )
+        coins = [sym for _, sym in ranked[:self.top_n]]
+        top = set(coins)
+        for coin in sorted(subscription_index.subscribed_coins()):
+            if coin in top:
+                continue
+            if self._eligible(markets.get(coin)):
+                coins.append(coin)
+            else:
+                logger.warning(f"Subscribed pair {coin} is not traded anymore, skipping")
+        if not coins:
+            return
+        storage.write("DELETE FROM market_universe")
+        storage.write_many(
+            "INSERT INTO market_universe (coin, rank) VALUES (?, ?)", [(coin, i) for i, coin in enumerate(coins)]
+        )
+        self._set(coins)
+
+    async def load(self):
+        """Берёт список, собранный лидером; пока его нет — остаёмся на текущем."""
+        rows = await storage.fetchall("SELECT coin FROM market_universe ORDER BY rank")
+        if rows:
+            self._set([r["coin"] for r in rows])
+
+    async def run(self):
+        while True:
+            try:
+                await self.refresh()
+                delay = UNIVERSE_REFRESH_INTERVAL
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Universe refresh error: {e}")
+                delay = UNIVERSE_RETRY_INTERVAL
+            await asyncio.sleep(delay)
+
+coin_universe = CoinUniverse(COINS)
+
+# ==============================================================================
+# STREAMING MARKET DATA HUB (WebSocket)
+# ==============================================================================
+
+class StreamTransport(abc.ABC):
+    """
+    Транспорт потока рыночных данных. Отдаёт сырые сообщения в формате
+    combined stream Binance: {"stream": "...", "data": {...}}.
+    """
+
+    @abc.abstractmethod
+    def messages(self, streams: List[str]) -> AsyncIterator[Dict[str, Any]]:
+        """Одно подключение: итерация заканчивается (или падает), когда оно оборвалось."""
+
+class WebSocketTransport(StreamTransport):
+    """Обычный WebSocket через aiohttp. base_url можно направить на локальный фейковый сервер."""
+
+    def __init__(self, base_url: str = MARKET_STREAM_URL):
+        self.base_url = base_url.rstrip("/")
+
+    async def messages(self, streams: List[str]) -> AsyncIterator[Dict[str, Any]]:
+        url = f"{self.base_url}/stream?streams={'/'.join(streams)}"
+        async with aiohttp.ClientSession() as session:
+            async with session.ws_connect(url, heartbeat=20) as ws:
+                async for msg in ws:
+                    if msg.type == aiohttp.WSMsgType.TEXT:
+                        yield json.loads(msg.data)
+                    elif msg.type in (aiohttp.WSMsgType.CLOSED, aiohttp.WSMsgType.ERROR):
+                        break
+
+class MarketDataHub:
+    """
+    Одна потоковая подписка (ticker + kline) на все монеты и таблица последних значений в памяти.
+    Хендлеры читают из таблицы без сетевых запросов, монитор получает обновления через слушателей.
+    Если поток отвалился или данные протухли — прозрачно уходим в REST через price_source.
+    """
+
+    def __init__(
+        self,
+        coins: List[str],
+        transport: Optional[StreamTransport] = None,
+        timeframe: str = KLINE_TIMEFRAME,
+    ):
+        self.coins = list(coins)
+        self.transport = transport or WebSocketTransport()
+        self.timeframe = timeframe
+        self.tickers: Dict[str, Dict[str, Any]] = {}
+        self.connected = False
+        self._last_msg = 0.0
+        self._listeners: List[Callable[[str, Dict[str, Any]], None]] = []
+        self._task: Optional[asyncio.Task] = None
+        self._by_stream_id = {self._stream_id(c): c for c in self.coins}
+
+    @staticmethod
+    def _stream_id(coin: str) -> str:
+        return coin.replace("/", "").lower()
+
+    def add_listener(self, callback: Callable[[str, Dict[str, Any]], None]):
+        """callback(coin, ticker) вызывается на каждое обновление тикера."""
+        self._listeners.append(callback)
+
+    def is_live(self) -> bool:
+        return self.connected and time.time() - self._last_msg < MARKET_STREAM_STALE
+
+    def set_coins(self, coins: List[str]):
+        """Новый список монет: переподписываемся, тикеры выбывших монет забываем."""
+        self.coins = list(coins)
+        self._by_stream_id = {self._stream_id(c): c for c in self.coins}
+        for coin in set(self.tickers) - set(self.coins):
+            del self.tickers[coin]
+        if self._task is not None:
+            self._task.cancel()
+            self._task = asyncio.create_task(self._run())
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        self.connected = False
+
+    async def _run(self):
+        streams = []
+        for coin in self.coins:
+            sid = self._stream_id(coin)
+            streams += [f"{sid}@ticker", f"{sid}@kline_{self.timeframe}"]
+
+        backoff_min, backoff_max = MARKET_STREAM_BACKOFF
+        backoff = backoff_min
+        while True:
+            try:
+                messages = self.transport.messages(streams).__aiter__()
+                while True:
+                    # Соединение может остаться открытым, но замолчать: ждём не дольше
+                    # MARKET_STREAM_STALE и переподключаемся, а не висим на нём вечно
+                    try:
+                        msg = await asyncio.wait_for(messages.__anext__(), MARKET_STREAM_STALE)
+                    except StopAsyncIteration:
+                        break
+                    if not self.connected:
+                        self.connected = True
+                        backoff = backoff_min
+                        logger.info(f"Market stream connected: {len(streams)} streams")
+                    self._last_msg = time.time()
+                    self._handle(msg)
+            except asyncio.CancelledError:
+                raise
+            except asyncio.TimeoutError:
+                logger.warning(f"Market stream silent for {MARKET_STREAM_STALE}s, reconnecting")
+            except Exception as e:
+                logger.error(f"Market stream error: {e}")
+
+            if self.connected:
+                logger.warning("Market stream dropped, falling back to REST")
+            self.connected = False
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, backoff_max)
+
+    def _handle(self, msg: Dict[str, Any]):
+        data = msg.get("data") or {}
+        coin = self._by_stream_id.get(str(data.get("s", "")).lower())
+        if coin is None:
+            return
+
+        event = data.get("e")
+        if event == "24hrTicker":
+            ticker = {
+                "symbol": coin,
+                "last": float(data["c"]),
+                "open": float(data["o"]),
+                "high": float(data["h"]),
+                "low": float(data["l"]),
+                "percentage": float(data["P"]),
+                "quoteVolume": float(data["q"]),
+                "timestamp": data.get("E"),
+                "source": EXCHANGE_ID,
+                "ts": time.time(),
+            }
+            self.tickers[coin] = ticker
+            for callback in self._listeners:
+                try:
+                    callback(coin, ticker)
+                except Exception as e:
+                    logger.error(f"Market listener error: {e}")
+        elif event == "kline":
+            k = data["k"]
+            candle = [k["t"], float(k["o"]), float(k["h"]), float(k["l"]), float(k["c"]), float(k["v"])]
+            candle_store.upsert(coin, k["i"], candle)
+
+    def _fresh_ticker(self, coin: str) -> Optional[Dict[str, Any]]:
+        ticker = self.tickers.get(coin)
+        if ticker and self.is_live() and time.time() - ticker["ts"] < MARKET_STREAM_STALE:
+            return ticker
+        return None
+
+    def snapshot(self) -> Dict[str, float]:
+        """Последние цены всех монет из потока (пусто, если поток не живой)."""
+        if not self.is_live():
+            return {}
+        return {coin: t["last"] for coin, t in self.tickers.items()}
+
+    async def get_ticker(self, coin: str) -> Dict[str, Any]:
+        ticker = self._fresh_ticker(coin)
+        if ticker is not None:
+            return ticker
+        return await price_source.ticker(coin)
+
+market_hub = MarketDataHub(coin_universe.coins)
+coin_universe.add_listener(market_hub.set_coins)
+
+# ==============================================================================
+# MARKET DATA & TECH ANALYSIS
+# ==============================================================================
+
+def write_json_atomic(path: str, data: Any, **dump_kwargs):
+    """
+    Пишет JSON во временный файл рядом с path и подменяет им path. Имя временного файла
+    у каждого процесса своё, поэтому воркеры и сканеры не портят записи друг друга.
+    """
+    directory, name = os.path.split(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix=f"{name}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(data, f, **dump_kwargs)
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+
+class FiatRateService:
+    """
+    Курсы фиата относительно USD. Отдаёт последнее удачное значение без ожидания,
+    а обновляет его фоном заранее, до истечения TTL. Одна HTTP-сессия на всё время
+    жизни бота; последние курсы сохраняются в файл, чтобы после рестарта
+    не показывать цены по выдуманному курсу.
+    """
+
+    def __init__(self, url: str, ttl: float, path: str):
+        self.url = url
+        self.ttl = ttl
+        self.path = path
+        self.rates: Dict[str, float] = {"USD": 1.0}
+        self.ts = 0.0
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._task: Optional[asyncio.Task] = None
+        self.stats = {"hits": 0, "stale_hits": 0, "misses": 0, "refreshes": 0, "errors": 0}
+
+    def load(self):
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                data = json.load(f)
+            self.rates.update({k: float(v) for k, v in data["rates"].items()})
+            self.ts = float(data["ts"])
+            logger.info(f"Fiat rates loaded from {self.path} (age {time.time() - self.ts:.0f}s)")
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.warning(f"Fiat rates file {self.path} ignored: {e}")
+
+    def restore(self, rates: Dict[str, float], ts: float):
+        """Курсы из тёплого состояния, если они свежее загруженных из файла."""
+        if ts > self.ts:
+            self.rates.update({k: float(v) for k, v in rates.items()})
+            self.ts = ts
+
+    def _save(self):
+        write_json_atomic(self.path, {"ts": self.ts, "rates": self.rates})
+
+    def start(self):
+        self.load()
+        self._session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=4, keepalive_timeout=60),
+            timeout=aiohttp.ClientTimeout(total=10),
+        )
+        self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        if self._session:
+            await self._session.close()
+
+    def has_rates(self) -> bool:
+        return self.ts > 0
+
+    async def get(self) -> Dict[str, float]:
+        # Ждём сеть только если курсов нет вообще (первый запуск без файла)
+        if not self.has_rates():
+            self.stats["misses"] += 1
+            await fiat_flight.do("USD", self.refresh)
+        elif time.time() - self.ts > self.ttl:
+            self.stats["stale_hits"] += 1
+        else:
+            self.stats["hits"] += 1
+        return self.rates
+
+    async def _run(self):
+        while True:
+            # Обновляем на 80% TTL, чтобы юзеры никогда не видели протухший кэш
+            due = self.ts + self.ttl * 0.8 - time.time()
+            if due > 0:
+                await asyncio.sleep(due)
+            ok = await fiat_flight.do("USD", self.refresh)
+            if not ok:
+                await asyncio.sleep(FIAT_RETRY_INTERVAL)
+
+    async def refresh(self) -> bool:
+        try:
+            session = self._session or aiohttp.ClientSession()
+            try:
+                async with session.get(self.url) as resp:
+                    if resp.status != 200:
+                        logger.error(f"Failed to fetch fiat rates: status {resp.status}")
+                        self.stats["errors"] += 1
+                        return False
+                    data = await resp.json()
+            finally:
+                if session is not self._session:
+                    await session.close()
+            rates = data.get("rates", {})
+            for code in CURRENCY_SYMBOLS:
+                if code in rates:
+                    self.rates[code] = float(rates[code])
+            self.ts = time.time()
+            logger.info("Fiat rates updated: " + ", ".join(
+                f"USD/{c}={self.rates[c]}" for c in CURRENCY_SYMBOLS if c != "USD" and c in self.rates
+            ))
+            try:
+                self._save()
+            except OSError as e:
+                logger.warning(f"Fiat rates not saved: {e}")
+            self.stats["refreshes"] += 1
+            return True
+        except Exception as e:
+            logger.error(f"Fiat update error: {e}")
+            self.stats["errors"] += 1
+            return False
+
+fiat_rates = FiatRateService(FIAT_RATES_URL, FIAT_CACHE_TTL, FIAT_RATES_FILE)
+
+async def get_fiat_rates() -> Dict[str, float]:
+    """Актуальные курсы USD → фиат (последние известные, без ожидания сети)."""
+    return await fiat_rates.get()
+
+def convert_price_usd(price_usd: float, currency: str, rates: Dict[str, float]) -> str:
+    # Нет курса для валюты — честно показываем доллары
+    if currency not in rates:
+        currency = "USD"
+    symbol = CURRENCY_SYMBOLS.get(currency, "$")
+    value = price_usd * rates[currency]
+
+    if value < 1:
+        return f"{symbol}{value:.4f}"
+    if value < 100:
+        return f"{symbol}{value:.2f}"
+    return f"{symbol}{value:,.0f}".replace(",", " ")
+
+async def fetch_ticker_snapshot(coins: List[str]) -> Dict[str, Dict[str, Any]]:
+    """
+    Забирает тикеры всех отслеживаемых пар одним запросом (fetch_tickers) — с основной
+    биржи или, если она не ответила, с резервной. Пары, которых на бирже нет,
+    отбрасываются заранее — иначе ccxt уронит весь батч.
+    """
+    return await price_source.tickers(coins)
+
+def algorithmic_verdict(rsi: Optional[float]) -> Tuple[str, str, str]:
+    """Градусник рынка, комментарий и вердикт по RSI."""
+    bar = "🌤 Норма"
+    if rsi is not None:
+        if rsi < 30:
+            bar = "🥶 Сильная перепроданность"
+            comment = (
+                "Цена неоправданно низкая. Толпа сливает монету, "
+                "но для терпеливых это может быть хорошая точка входа."
+            )
+            verdict = "🟢 ПОКУПАТЬ / ДОКУПАТЬ"
+        elif rsi > 70:
+            bar = "🌋 Перегрев"
+            comment = (
+                "Ажиотаж зашкаливает. Новички залетают на хаях, "
+                "коррекция вниз выглядит очень вероятной."
+            )
+            verdict = "🔴 ФИКСИРОВАТЬ ПРИБЫЛЬ / ЖДАТЬ"
+        else:
+            bar = "🌤 Баланс"
+            comment = (
+                "Рынок спокоен, явного перекоса нет. Можно просто держать позицию "
+                "и ждать более сильного сигнала."
+            )
+            verdict = "⚪️ ДЕРЖАТЬ"
+    else:
+        comment = "Недостаточно данных для RSI, ориентируемся по цене и динамике."
+        verdict = "⚪️ НЕЙТРАЛЬНО"
+    return bar, comment, verdict
+
+def market_stats(coin: str, ticker: Dict[str, Any]) -> Dict[str, Any]:
+    """Валютонезависимые цифры для статистики и прогноза по одному тикеру."""
+    price = ticker["last"]
+    open_price = ticker.get("open", price - 1e-8)
+    high = ticker.get("high", price)
+    return {
+        "coin": coin,
+        "price": price,
+        "change_pct": ticker.get("percentage", 0.0) or 0.0,
+        "abs_change": price - open_price,
+        "high": high,
+        "low": ticker.get("low", price),
+        "volume": ticker.get("quoteVolume", 0.0),
+        "dist_from_high": ((high - price) / high * 100) if high else 0.0,
+        "source": ticker.get("source", EXCHANGE_ID),
+    }
+
+def calc_rsi(prices: List[float], period: int = RSI_PERIOD) -> Optional[float]:
+    if len(prices) < period + 1:
+        return None
+    deltas = [prices[i] - prices[i - 1] for i in range(1, len(prices))]
+    gains = [d if d > 0 else 0 for d in deltas]
+    losses = [abs(d) if d < 0 else 0 for d in deltas]
+
+    avg_gain = sum(gains[:period]) / period
+    avg_loss = sum(losses[:period]) / period
+
+    for i in range(period, len(prices) - 1):
+        avg_gain = (avg_gain * (period - 1) + gains[i]) / period
+        avg_loss = (avg_loss * (period - 1) + losses[i]) / period
+
+    if avg_loss == 0:
+        return 100.0 if avg_gain > 0 else 50.0
+    rs = avg_gain / avg_loss
+    return 100 - (100 / (1 + rs))
+
+def calc_sma(prices: List[float], period: int = SMA_PERIOD) -> Optional[float]:
+    if len(prices) < period:
+        return None
+    return sum(prices[-period:]) / period
+
+# ==============================================================================
+# INDICATOR ENGINE (скользящие индикаторы)
+# ==============================================================================
+
+def timeframe_ms(timeframe: str) -> int:
+    units = {"m": 60, "h": 3600, "d": 86400, "w": 604800}
+    return int(timeframe[:-1]) * units[timeframe[-1]] * 1000
+
+class WilderRSI:
+    """
+    RSI Уайлдера с состоянием: O(1) на новую свечу.
+    Порядок операций тот же, что в calc_rsi, поэтому на одном ряду результат совпадает до бита.
+    """
+
+    name = "rsi"
+
+    def __init__(self, period: int = RSI_PERIOD):
+        self.period = period
+        self.prev: Optional[float] = None
+        self.deltas = 0
+        self.sum_gain: float = 0
+        self.sum_loss: float = 0
+        self.avg_gain: Optional[float] = None
+        self.avg_loss: Optional[float] = None
+
+    def _step(self, close: float) -> Tuple[int, float, float, Optional[float], Optional[float]]:
+        d = close - self.prev
+        gain = d if d > 0 else 0
+        loss = abs(d) if d < 0 else 0
+        deltas = self.deltas + 1
+        sum_gain, sum_loss = self.sum_gain, self.sum_loss
+        avg_gain, avg_loss = self.avg_gain, self.avg_loss
+        if deltas <= self.period:
+            sum_gain += gain
+            sum_loss += loss
+            if deltas == self.period:
+                avg_gain = sum_gain / self.period
+                avg_loss = sum_loss / self.period
+        else:
+            avg_gain = (avg_gain * (self.period - 1) + gain) / self.period
+            avg_loss = (avg_loss * (self.period - 1) + loss) / self.period
+        return deltas, sum_gain, sum_loss, avg_gain, avg_loss
+
+    @staticmethod
+    def _value(avg_gain: Optional[float], avg_loss: Optional[float]) -> Optional[float]:
+        if avg_gain is None:
+            return None
+        if avg_loss == 0:
+            return 100.0 if avg_gain > 0 else 50.0
+        rs = avg_gain / avg_loss
+        return 100 - (100 / (1 + rs))
+
+    def update(self, close: float):
+        if self.prev is not None:
+            self.deltas, self.sum_gain, self.sum_loss, self.avg_gain, self.avg_loss = self._step(close)
+        self.prev = close
+
+    def value(self) -> Optional[float]:
+        return self._value(self.avg_gain, self.avg_loss)
+
+    def peek(self, close: float) -> Optional[float]:
+        """Значение, как если бы close был следующей свечой, без изменения состояния."""
+        if self.prev is None:
+            return None
+        _, _, _, avg_gain, avg_loss = self._step(close)
+        return self._value(avg_gain, avg_loss)
+
+    def batch(self, closes: "np.ndarray") -> "np.ndarray":
+        """RSI сразу для матрицы (монеты × свечи): векторно по монетам, те же операции, что в calc_rsi."""
+        rows, n = closes.shape
+        if n < self.period + 1:
+            return np.full(rows, np.nan)
+        deltas = closes[:, 1:] - closes[:, :-1]
+        gains = np.where(deltas > 0, deltas, 0.0)
+        losses = np.where(deltas < 0, -deltas, 0.0)
+        # Суммируем по шагам, а не np.sum: попарное суммирование numpy дало бы другой последний бит
+        avg_gain = np.zeros(rows)
+        avg_loss = np.zeros(rows)
+        for j in range(self.period):
+            avg_gain = avg_gain + gains[:, j]
+            avg_loss = avg_loss + losses[:, j]
+        avg_gain = avg_gain / self.period
+        avg_loss = avg_loss / self.period
+        for i in range(self.period, n - 1):
+            avg_gain = (avg_gain * (self.period - 1) + gains[:, i]) / self.period
+            avg_loss = (avg_loss * (self.period - 1) + losses[:, i]) / self.period
+        with np.errstate(divide="ignore", invalid="ignore"):
+            rsi = 100 - (100 / (1 + avg_gain / avg_loss))
+        return np.where(avg_loss == 0, np.where(avg_gain > 0, 100.0, 50.0), rsi)
+
+class SMA:
+    """Простая скользящая средняя по окну последних period цен (совпадает с calc_sma)."""
+
+    name = "sma"
+
+    def __init__(self, period: int = SMA_PERIOD):
+        self.period = period
+        self.window: deque = deque(maxlen=period)
+
+    def update(self, close: float):
+        self.window.append(close)
+
+    def value(self) -> Optional[float]:
+        if len(self.window) < self.period:
+            return None
+        return sum(self.window) / self.period
+
+    def peek(self, close: float) -> Optional[float]:
+        if len(self.window) + 1 < self.period:
+            return None
+        skip = 1 if len(self.window) == self.period else 0
+        return (sum(itertools.islice(self.window, skip, None)) + close) / self.period
+
+    def batch(self, closes: "np.ndarray") -> "np.ndarray":
+        rows, n = closes.shape
+        if n < self.period:
+            return np.full(rows, np.nan)
+        total = np.zeros(rows)
+        for j in range(n - self.period, n):
+            total = total + closes[:, j]
+        return total / self.period
+
+# Реестр индикаторов: новый (EMA, MACD, Bollinger...) — это класс с update/value/peek/batch
+# и одна строка здесь. Все индикаторы обновляются за один проход по свече.
+INDICATORS: Dict[str, Callable[[], Any]] = {
+    "rsi": lambda: WilderRSI(RSI_PERIOD),
+    "sma": lambda: SMA(SMA_PERIOD),
+}
+
+class IndicatorEngine:
+    """
+    Состояние индикаторов по (монета, таймфрейм). Закрытые свечи скармливаются по одной,
+    текущая (незакрытая) учитывается через peek, не портя состояние.
+    """
+
+    def __init__(self, factories: Dict[str, Callable[[], Any]] = INDICATORS):
+        self.factories = factories
+        self._state: Dict[Tuple[str, str], Dict[str, Any]] = {}
+        self._last_ts: Dict[Tuple[str, str], int] = {}
+
+    def seed(self, coin: str, timeframe: str, candles: List[List[float]]):
+        """Сбрасывает состояние и прогоняет закрытые свечи [ts, o, h, l, c, v]."""
+        key = (coin, timeframe)
+        self._state[key] = {name: make() for name, make in self.factories.items()}
+        self._last_ts.pop(key, None)
+        for candle in candles:
+            self.update(coin, timeframe, candle[4], candle[0])
+
+    def update(self, coin: str, timeframe: str, close: float, ts: int):
+        key = (coin, timeframe)
+        if ts <= self._last_ts.get(key, -1):
+            return
+        for indicator in self._state[key].values():
+            indicator.update(close)
+        self._last_ts[key] = ts
+
+    def observe(self, coin: str, timeframe: str, candles: List[List[float]]) -> Dict[str, Optional[float]]:
+        """
+        Принимает свежий список свечей (последняя — текущая незакрытая), докармливает
+        только новые закрытые свечи и возвращает значения с учётом текущей цены.
+        """
+        key = (coin, timeframe)
+        closed, live = candles[:-1], candles[-1]
+        last_ts = self._last_ts.get(key)
+        step = timeframe_ms(timeframe)
+        new = [c for c in closed if last_ts is None or c[0] > last_ts]
+        if key not in self._state or (new and last_ts is not None and new[0][0] - last_ts != step):
+            # Нет состояния или в истории дыра — пересчитываем с нуля по тому, что есть
+            self.seed(coin, timeframe, closed)
+        else:
+            for candle in new:
+                self.update(coin, timeframe, candle[4], candle[0])
+        return {name: ind.peek(live[4]) for name, ind in self._state[key].items()}
+
+    def compute_all(self, closes: Dict[str, List[float]]) -> Dict[str, Dict[str, Optional[float]]]:
+        """
+        Индикаторы по окнам цен сразу для всех монет. Монеты с одинаковой длиной ряда
+        считаются одной матрицей NumPy.
+        """
+        groups: Dict[int, List[str]] = {}
+        for coin, series in closes.items():
+            groups.setdefault(len(series), []).append(coin)
+
+        result: Dict[str, Dict[str, Optional[float]]] = {coin: {} for coin in closes}
+        for coins in groups.values():
+            matrix = np.array([closes[c] for c in coins], dtype=np.float64)
+            for name, make in self.factories.items():
+                values = make().batch(matrix)
+                for coin, v in zip(coins, values):
+                    result[coin][name] = None if np.isnan(v) else float(v)
+        return result
+
+indicator_engine = IndicatorEngine()
+
+def window_closes(candles: List[List[float]], price: float) -> List[float]:
+    """Цены закрытия окна свечей; текущая (незакрытая) свеча берёт живую цену."""
+    return [c[4] for c in candles[:-1]] + [price]
+
+# ==============================================================================
+# CANDLE STORE (локальная история OHLCV)
+# ==============================================================================
+
+class CandleRing:
+    """
+    Кольцевой буфер свечей фиксированного размера: массив capacity × 6 (ts, o, h, l, c, v) float64.
+    С path данные лежат в memory-mapped файлах и переживают рестарт.
+    """
+
+    def __init__(self, capacity: int, step_ms: int, path: Optional[str] = None):
+        self.capacity = capacity
+        self.step_ms = step_ms
+        if path is None:
+            self.data = np.zeros((capacity, 6), dtype=np.float64)
+            self.meta = np.zeros(2, dtype=np.int64)  # [head, count]
+            return
+        data_path, meta_path = f"{path}.bin", f"{path}.meta"
+        reuse = (
+            os.path.exists(data_path) and os.path.exists(meta_path)
+            and os.path.getsize(data_path) == capacity * 6 * 8
+        )
+        mode = "r+" if reuse else "w+"
+        self.data = np.memmap(data_path, dtype=np.float64, mode=mode, shape=(capacity, 6))
+        self.meta = np.memmap(meta_path, dtype=np.int64, mode=mode, shape=(2,))
+
+    @property
+    def count(self) -> int:
+        return int(self.meta[1])
+
+    def last_ts(self) -> Optional[int]:
+        if not self.count:
+            return None
+        return int(self.data[(self.meta[0] - 1) % self.capacity, 0])
+
+    def reset(self):
+        self.meta[:] = 0
+
+    def upsert(self, candle: List[float]) -> bool:
+        """Обновляет последнюю свечу или дописывает следующую. False — между ними дыра."""
+        head, count = int(self.meta[0]), int(self.meta[1])
+        last = self.last_ts()
+        ts = candle[0]
+        if last is not None and ts == last:
+            self.data[(head - 1) % self.capacity] = candle[:6]
+            return True
+        if last is not None and ts < last:
+            return True  # старьё, у нас уже есть
+        if last is not None and ts - last != self.step_ms:
+            return False
+        self.data[head] = candle[:6]
+        self.meta[0] = (head + 1) % self.capacity
+        self.meta[1] = min(count + 1, self.capacity)
+        return True
+
+    def tail(self, n: int) -> "np.ndarray":
+        n = min(n, self.count)
+        idx = (int(self.meta[0]) - n + np.arange(n)) % self.capacity
+        return self.data[idx]
+
+    def flush(self):
+        if isinstance(self.data, np.memmap):
+            self.data.flush()
+            self.meta.flush()
+
+class CandleStore:
+    """
+    Свечи по (монета, таймфрейм) в кольцевых буферах. Хендлеры читают отсюда,
+    с биржи докачивается только недостающий хвост, а kline-поток держит буфер актуальным.
+    """
+
+    def __init__(self, capacity: int = CANDLE_STORE_CAPACITY, directory: str = CANDLE_STORE_DIR):
+        self.capacity = capacity
+        self.directory = directory
+        self._rings: Dict[Tuple[str, str], CandleRing] = {}
+        self._flight = SingleFlight("candles")
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def ring(self, coin: str, timeframe: str) -> CandleRing:
+        key = (coin, timeframe)
+        if key not in self._rings:
+            path = None
+            if self.directory:
+                path = os.path.join(self.directory, f"{coin.replace('/', '_')}_{timeframe}")
+            self._rings[key] = CandleRing(self.capacity, timeframe_ms(timeframe), path)
+        return self._rings[key]
+
+    def upsert(self, coin: str, timeframe: str, candle: List[float]):
+        """Свеча из потока. Пишем только в уже засеянные буферы: дыры закроет backfill."""
+        ring = self._rings.get((coin, timeframe))
+        if ring is not None and ring.count:
+            ring.upsert(candle)
+
+    def _is_current(self, ring: CandleRing, limit: int) -> bool:
+        last = ring.last_ts()
+        if last is None or ring.count < limit:
+            return False
+        now_ms = int(time.time() * 1000)
+        return last >= now_ms - now_ms % ring.step_ms
+
+    async def backfill(self, coin: str, timeframe: str, limit: int):
+        ring = self.ring(coin, timeframe)
+        if self._is_current(ring, limit):
+            return
+
+        last = ring.last_ts()
+        now_ms = int(time.time() * 1000)
+        if last is None or ring.count < limit or now_ms - last > ring.step_ms * self.capacity:
+            # Истории нет или она безнадёжно устарела — качаем заново
+            ohlcv = await price_source.ohlcv(coin, timeframe, limit=min(self.capacity, 1000))
+            ring.reset()
+        else:
+            # Докачиваем только дыру, начиная с последней (возможно, недозакрытой) свечи
+            ohlcv = await price_source.ohlcv(coin, timeframe, since=last, limit=1000)
+        for candle in ohlcv:
+            ring.upsert(candle)
+        logger.info(f"Candles backfilled {coin} {timeframe}: +{len(ohlcv)}, {ring.count} in store")
+
+    async def get(self, coin: str, timeframe: str, limit: int) -> List[List[float]]:
+        ring = self.ring(coin, timeframe)
+        if not self._is_current(ring, limit):
+            await self._flight.do((coin, timeframe), lambda: self.backfill(coin, timeframe, limit))
+        return ring.tail(limit).tolist()
+
+    def flush(self):
+        for ring in self._rings.values():
+            ring.flush()
+
+    def dump(self, limit: int) -> Dict[str, List[List[float]]]:
+        return {
+            f"{coin}|{timeframe}": ring.tail(limit).tolist()
+            for (coin, timeframe), ring in self._rings.items() if ring.count
+        }
+
+    def restore(self, data: Dict[str, List[List[float]]]) -> int:
+        """Засевает пустые буферы (с CANDLE_STORE_DIR история и так пережила рестарт)."""
+        restored = 0
+        for key, candles in data.items():
+            coin, timeframe = key.split("|")
+            ring = self.ring(coin, timeframe)
+            if ring.count:
+                continue
+            for candle in candles:
+                ring.upsert(candle)
+            restored += 1
+        return restored
+
+candle_store = CandleStore()
+
+# ==============================================================================
+# GEMINI AI INTEGRATION
+# ==============================================================================
+
+class FakeGeminiModel:
+    """
+    Локальная замена Gemini для офлайн-проверок (GEMINI_FAKE=1): отвечает шаблонным текстом
+    с настраиваемой задержкой и долей ошибок, батч-промпты получают JSON по монетам.
+    """
+
+    def __init__(self, latency: float = GEMINI_FAKE_LATENCY, error_rate: float = GEMINI_FAKE_ERROR_RATE):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.calls = 0
+
+    async def generate_content_async(self, prompt: str, **kwargs) -> Any:
+        self.calls += 1
+        await asyncio.sleep(self.latency * random.uniform(0.5, 1.5))
+        if random.random() < self.error_rate:
+            raise RuntimeError("429 Resource has been exhausted (fake)")
+        coins = re.findall(r"^Монета: (\S+)$", prompt, re.MULTILINE)
+        if GEMINI_BATCH_MARKER in prompt:
+            text = json.dumps({c: f"🤖 {c}: тестовый вывод. ⚪️ ЖДАТЬ." for c in coins}, ensure_ascii=False)
+        else:
+            text = f"🤖 {coins[0] if coins else '?'}: тестовый вывод. ⚪️ ЖДАТЬ."
+        if kwargs.get("stream"):
+            return self._stream(text)
+        return SimpleNamespace(text=text)
+
+    async def _stream(self, text: str) -> AsyncIterator[Any]:
+        words = text.split(" ")
+        for i in range(0, len(words), 3):
+            await asyncio.sleep(self.latency / 10)
+            yield SimpleNamespace(text=" ".join(words[i:i + 3]) + " ")
+
+# Конфигурация Gemini: модель создаётся при первом запросе (или фоном после старта),
+# чтобы импорт genai не задерживал приём апдейтов
+GEMINI_ENABLED = GEMINI_FAKE or bool(GEMINI_KEY and not GEMINI_KEY.startswith("ВАШ_"))
+gemini_model: Optional[Any] = None
+
+def get_gemini_model() -> Optional[Any]:
+    global gemini_model
+    if gemini_model is None and GEMINI_ENABLED:
+        if GEMINI_FAKE:
+            gemini_model = FakeGeminiModel()
+        else:
+            genai.configure(api_key=GEMINI_KEY)
+            gemini_model = genai.GenerativeModel("gemini-2.5-flash")
+    return gemini_model
+
+AI_SYSTEM_PROMPT = (
+    "Ты — опытный крипто-трейдер с циничным, но профессиональным стилем речи. "
+    "Твоя задача — проанализировать технические данные монеты и дать краткий, "
+    "жесткий и понятный вердикт на русском языке. Не используй сложные термины "
+    "без объяснения. Скажи прямо: покупать, продавать или ждать. Используй эмодзи."
+)
+
+def build_ai_data_block(analysis: Dict[str, Any]) -> str:
+    # Подготовка строки RSI заранее
+    rsi = analysis["rsi"]
+    rsi_str = f"{rsi:.2f}" if rsi is not None else "нет данных"
+    return (
+        f"Монета: {analysis['coin']}\n"
+        f"Текущая цена (USDT): {analysis['price']:.4f}\n"
+        f"RSI(14): {rsi_str}\n"
+        f"Изменение за 24ч (%): {analysis['change_pct']:.2f}\n"
+        f"Объем за 24ч (USDT): {analysis['volume']:.0f}\n"
+        f"Отдаление от локального максимума 24ч (%): {analysis['dist_from_high']:.2f}"
+    )
+
+def build_ai_prompt(analysis: Dict[str, Any], mode_label: str = "AI") -> str:
+    # Мы просто склеиваем инструкции и данные в один текст
+    return (
+        f"{AI_SYSTEM_PROMPT}\n\n"
+        f"{build_ai_data_block(analysis)}\n"
+        f"Режим анализа: {mode_label}\n\n"
+        "Сформируй короткий вывод в 3-6 предложениях."
+    )
+
+def _is_quota_error(e: Exception) -> bool:
+    text = f"{type(e).__name__} {e}".lower()
+    return "resourceexhausted" in text or "429" in text or "quota" in text
+
+class AIGovernor:
+    """
+    Ограничитель вызовов Gemini: семафор на параллельность, жёсткий таймаут,
+    бюджет ожидания для хендлера и пауза с экспоненциальным ростом при исчерпании квоты.
+    """
+
+    def __init__(self, concurrency: int = GEMINI_CONCURRENCY):
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._pending: Dict[str, asyncio.Task] = {}
+        self._blocked_until = 0.0
+        self._backoff = 0.0
+        # coin -> когда его последний раз спрашивали в режиме AI (для фоновой предзагрузки)
+        self.demand: Dict[str, float] = {}
+        self.stats = {"calls": 0, "timeouts": 0, "errors": 0, "quota_backoffs": 0, "skipped": 0, "late": 0, "reused": 0}
+
+    def available(self) -> bool:
+        return GEMINI_ENABLED and time.time() >= self._blocked_until
+
+    @staticmethod
+    async def _model() -> Any:
+        # Первый вызов импортирует genai — в потоке, чтобы не останавливать event loop
+        return gemini_model or await asyncio.to_thread(get_gemini_model)
+
+    def is_pending(self, key: str) -> bool:
+        return key in self._pending
+
+    async def generate(self, prompt: str) -> Optional[str]:
+        if not self.available():
+            self.stats["skipped"] += 1
+            return None
+        async with self._semaphore:
+            self.stats["calls"] += 1
+            try:
+                with metrics.timer("gemini_request_seconds", mode="generate"):
+                    response = await asyncio.wait_for(
+                        (await self._model()).generate_content_async(prompt), GEMINI_TIMEOUT
+                    )
+            except Exception as e:
+                self._record_error(e)
+                return None
+        self._backoff = 0.0
+        if hasattr(response, "text") and response.text:
+            return response.text.strip()
+        return None
+
+    def _record_error(self, e: Exception):
+        metrics.inc("gemini_errors_total", kind=type(e).__name__)
+        if isinstance(e, asyncio.TimeoutError):
+            self.stats["timeouts"] += 1
+            logger.error(f"Gemini timeout after {GEMINI_TIMEOUT}s")
+        elif _is_quota_error(e):
+            self._backoff = min(max(self._backoff * 2, GEMINI_BACKOFF_MIN), GEMINI_BACKOFF_MAX)
+            self._blocked_until = time.time() + self._backoff
+            self.stats["quota_backoffs"] += 1
+            logger.warning(f"Gemini quota exhausted, pausing AI for {self._backoff:.0f}s")
+        else:
+            self.stats["errors"] += 1
+            logger.error(f"Gemini error: {e}")
+
+    async def stream(self, prompt: str, ready: Optional[Callable[[], Optional[str]]] = None) -> AsyncIterator[str]:
+        """
+        Потоковый ответ модели кусками текста. Те же семафор, общий таймаут и учёт квоты.
+        ready() проверяется уже под семафором: если готовый текст появился, пока ждали
+        очереди (предзагрузка, обычный запрос), отдаём его без вызова Gemini.
+        """
+        if not self.available():
+            self.stats["skipped"] += 1
+            return
+        async with self._semaphore:
+            text = ready() if ready is not None else None
+            if text:
+                self.stats["reused"] += 1
+                yield text
+                return
+            self.stats["calls"] += 1
+            started = time.monotonic()
+            deadline = started + GEMINI_TIMEOUT
+            first = True
+            try:
+                response = await asyncio.wait_for(
+                    (await self._model()).generate_content_async(prompt, stream=True), GEMINI_TIMEOUT
+                )
+                chunks = response.__aiter__()
+                while True:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise asyncio.TimeoutError()
+                    try:
+                        chunk = await asyncio.wait_for(chunks.__anext__(), remaining)
+                    except StopAsyncIteration:
+                        break
+                    text = getattr(chunk, "text", "")
+                    if text:
+                        if first:
+                            metrics.observe("gemini_request_seconds", time.monotonic() - started, mode="stream_first_chunk")
+                            first = False
+                        yield text
+            except Exception as e:
+                self._record_error(e)
+                return
+        self._backoff = 0.0
+
+    async def within_budget(
+        self, key: str, prompt: str, on_late: Callable[[Optional[str]], None]
+    ) -> Tuple[bool, Optional[str]]:
+        """
+        Ждёт ответ не дольше GEMINI_LATENCY_BUDGET. Не успели — (False, None): хендлер отвечает
+        алгоритмом, а on_late получит текст, когда тот придёт. Повторные запросы по тому же
+        ключу присоединяются к уже идущему вызову.
+        """
+        self.demand[key] = time.time()
+        task = self._pending.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self.generate(prompt))
+            self._pending[key] = task
+            task.add_done_callback(lambda t: self._pending.pop(key, None) if self._pending.get(key) is t else None)
+        try:
+            return True, await asyncio.wait_for(asyncio.shield(task), GEMINI_LATENCY_BUDGET)
+        except asyncio.TimeoutError:
+            self.stats["late"] += 1
+            task.add_done_callback(lambda t: on_late(t.result()) if not t.cancelled() else None)
+            return False, None
+
+    async def analyse_batch(self, items: List[Dict[str, Any]]) -> Dict[str, Optional[str]]:
+        """Несколько монет одним промптом; ответ — JSON {монета: текст}, разбираем по монетам."""
+        blocks = "\n\n".join(build_ai_data_block(item) for item in items)
+        prompt = (
+            f"{AI_SYSTEM_PROMPT}\n\n{GEMINI_BATCH_MARKER}\n"
+            "Для каждой монеты ниже сформируй короткий вывод в 3-6 предложениях. "
+            "Ответь строго JSON-объектом без пояснений: ключ — монета как в данных, значение — вывод.\n\n"
+            f"{blocks}"
+        )
+        raw = await self.generate(prompt)
+        if not raw:
+            return {}
+        # Модель любит заворачивать JSON в ```json ... ```
+        raw = re.sub(r"^```(?:json)?\s*|\s*```$", "", raw.strip())
+        try:
+            parsed = json.loads(raw)
+        except ValueError:
+            logger.error("Gemini batch reply is not valid JSON")
+            return {}
+        wanted = {item["coin"] for item in items}
+        return {coin: str(text).strip() for coin, text in parsed.items() if coin in wanted and text}
+
+ai_governor = AIGovernor()
+
+async def ai_prefetch_loop():
+    """
+    Фоном обновляет AI-тексты монет, которые недавно спрашивали, пачками по GEMINI_BATCH_SIZE
+    в одном промпте — популярные монеты почти всегда отвечают из кэша.
+    """
+    while True:
+        await asyncio.sleep(AI_PREFETCH_INTERVAL)
+        if not ai_governor.available():
+            continue
+        now = time.time()
+        due = []
+        for coin, asked in list(ai_governor.demand.items()):
+            if now - asked > AI_PREFETCH_DEMAND_WINDOW:
+                del ai_governor.demand[coin]
+                continue
+            cached, state = ai_cache.peek(coin)
+            snap = snapshot_scheduler.get(coin)
+            if snap is not None and (state != "fresh" or not cached["ai_raw"]) and not ai_governor.is_pending(coin):
+                due.append(snap)
+        for i in range(0, len(due), GEMINI_BATCH_SIZE):
+            chunk = due[i:i + GEMINI_BATCH_SIZE]
+            try:
+                texts = await ai_governor.analyse_batch(chunk)
+            except Exception as e:
+                logger.error(f"AI prefetch error: {e}")
+                continue
+            for snap in chunk:
+                if texts.get(snap["coin"]):
+                    ai_cache.set(snap["coin"], {**snap, "ai_raw": texts[snap["coin"]], "ai_attempted": True})
+            logger.info(f"AI prefetch: {len(texts)}/{len(chunk)} coins in one call")
+
+# ==============================================================================
+# KEYBOARDS
+# ==============================================================================
+
+def main_menu_kb() -> ReplyKeyboardMarkup:
+    kb = [
+        [KeyboardButton(text="🧠 AI Прогноз"), KeyboardButton(text="📊 Статистика")],
+        [KeyboardButton(text="🔔 Подписки"), KeyboardButton(text="⚙️ Настройки")],
+    ]
+    return ReplyKeyboardMarkup(keyboard=kb, resize_keyboard=True)
+
+def settings_kb(user: dict) -> InlineKeyboardMarkup:
+    curr = user["currency"]
+    mode = user["analysis_mode"]
+    alert = user["alert_percent"]
+    
+    currency_buttons = [
+        InlineKeyboardButton(
+            text=f"{'✅ ' if curr==code else ''}{CURRENCY_FLAGS.get(code, '')} {code}",
+            callback_data=f"set_curr_{code}",
+        )
+        for code in CURRENCY_SYMBOLS
+    ]
+    kb = [currency_buttons[i:i + 3] for i in range(0, len(currency_buttons), 3)]
+    kb += [
+        [
+            InlineKeyboardButton(
+                text=f"Чувствительность: {alert:.1f}%", callback_data="cycle_alert"
+            ),
+            InlineKeyboardButton(
+                text=f"Алерты: {'📬 сводкой' if user['alert_digest'] else '🔔 сразу'}",
+                callback_data="toggle_digest",
+            ),
+        ],
+        [
+            InlineKeyboardButton(
+                text=f"Режим: {'🧊 Алгоритм' if mode=='ALG' else '🧠 AI'}",
+                callback_data="toggle_mode",
+            ),
+            InlineKeyboardButton(
+                text=f"Стриминг AI: {'✅' if user['ai_stream'] else '☑️'}",
+                callback_data="toggle_stream",
+            ),
+        ],
+    ]
+    return InlineKeyboardMarkup(inline_keyboard=kb)
+
+def coins_kb(page: int, mode: str, subs: Optional[List[str]] = None) -> InlineKeyboardMarkup:
+    per_page = 10
+    # Список живой: после пересборки страница могла оказаться за концом
+    coins = coin_universe.coins
+    page = min(page, max(0, (len(coins) - 1) // per_page))
+    start = page * per_page
+    end = start + per_page
+    coins_page = coins[start:end]
+    subs = subs or []
+
+    rows: List[List[InlineKeyboardButton]] = []
+    row: List[InlineKeyboardButton] = []
+
+    for coin in coins_page:
+        ticker = coin.split("/")[0]
+        if mode == "ai":
+            text = f"🧠 {ticker}"
+            cb = f"ai_{coin}_{page}"
+        elif mode == "stats":
+            text = f"📊 {ticker}"
+            cb = f"st_{coin}_{page}"
+        else:  # subs
+            sub_mark = "✅" if coin in subs else "☑️"
+            text = f"{sub_mark} {ticker}"
+            cb = f"sub_{coin}_{page}"
+
+        row.append(InlineKeyboardButton(text=text, callback_data=cb))
+        if len(row) == 2:
+            rows.append(row)
+            row = []
+
+    if row:
+        rows.append(row)
+
+    nav_row: List[InlineKeyboardButton] = []
+    if page > 0:
+        nav_row.append(InlineKeyboardButton(text="⬅️", callback_data=f"pg_{mode}_{page-1}"))
+    if end < len(coins):
+        nav_row.append(InlineKeyboardButton(text="➡️", callback_data=f"pg_{mode}_{page+1}"))
+    if nav_row:
+        rows.append(nav_row)
+
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+# ==============================================================================
+# HANDLERS
+# ==============================================================================
+
+@dp.message(Command("start"))
+async def cmd_start(message: types.Message):
+    await get_user(message.from_user.id)
+    # Раз написал /start, значит бот снова разблокирован
+    storage.write("DELETE FROM blocked_users WHERE user_id = ?", (message.from_user.id,))
+    await message.answer(
+        "🧠 Crypto AI Analyst\n\n"
+        "Я анализирую рынок, зову на помощь Gemini и говорю простым языком.\n"
+        "Нажми кнопку AI Прогноз или напиши сумму, например: 100 TON",
+        reply_markup=main_menu_kb(),
+        parse_mode="HTML",
+    )
+
+@dp.message(F.text == "⚙️ Настройки")
+async def cmd_settings(message: types.Message):
+    user = await get_user(message.from_user.id)
+    await message.answer(
+        "⚙️ Настройки профиля:", parse_mode="HTML", reply_markup=settings_kb(user)
+    )
+
+@dp.callback_query(F.data.startswith("set_curr_"))
+async def cb_set_curr(call: CallbackQuery):
+    _, _, code = call.data.split("_")
+    if code not in CURRENCY_SYMBOLS:
+        await call.answer()
+        return
+    await update_user(call.from_user.id, "currency", code)
+    await call.message.edit_reply_markup(reply_markup=settings_kb(await get_user(call.from_user.id)))
+    await call.answer(f"Валюта отображения: {code}")
+
+@dp.callback_query(F.data == "cycle_alert")
+async def cb_cycle_alert(call: CallbackQuery):
+    user = await get_user(call.from_user.id)
+    options = [1.0, 3.0, 5.0]
+    try:
+        idx = options.index(float(user["alert_percent"]))
+        new_val = options[(idx + 1) % len(options)]
+    except ValueError:
+        new_val = 3.0
+    await update_user(call.from_user.id, "alert_percent", new_val)
+    await call.message.edit_reply_markup(reply_markup=settings_kb(await get_user(call.from_user.id)))
+    await call.answer(f"Чувствительность: {new_val:.1f}%")
+
+@dp.callback_query(F.data == "toggle_digest")
+async def cb_toggle_digest(call: CallbackQuery):
+    user = await get_user(call.from_user.id)
+    new_val = 0 if user["alert_digest"] else 1
+    await update_user(call.from_user.id, "alert_digest", new_val)
+    await call.message.edit_reply_markup(reply_markup=settings_kb(await get_user(call.from_user.id)))
+    await call.answer(
+        f"Алерты придут одной сводкой раз в {ALERT_DIGEST_WINDOW} сек" if new_val else "Алерты приходят сразу"
+    )
+
+@dp.callback_query(F.data == "toggle_mode")
+async def cb_toggle_mode(call: CallbackQuery):
+    user = await get_user(call.from_user.id)
+    new_mode = "ALG" if user["analysis_mode"] == "AI" else "AI"
+    await update_user(call.from_user.id, "analysis_mode", new_mode)
+    await call.message.edit_reply_markup(reply_markup=settings_kb(await get_user(call.from_user.id)))
+    await call.answer(f"Режим: {'AI' if new_mode=='AI' else 'Алгоритмический'}")
+
+@dp.callback_query(F.data == "toggle_stream")
+async def cb_toggle_stream(call: CallbackQuery):
+    user = await get_user(call.from_user.id)
+    new_val = 0 if user["ai_stream"] else 1
+    await update_user(call.from_user.id, "ai_stream", new_val)
+    await call.message.edit_reply_markup(reply_markup=settings_kb(await get_user(call.from_user.id)))
+    await call.answer("AI-ответ будет печататься по мере генерации" if new_val else "Стриминг AI выключен")
+
+# --- Меню выбора монет ---
+
+@dp.message(F.text == "🧠 AI Прогноз")
+async def menu_ai(message: types.Message):
+    await message.answer(
+        "Выбери монету для анализа:", reply_markup=coins_kb(0, "ai"), parse_mode="HTML"
+    )
+
+@dp.message(F.text == "📊 Статистика")
+async def menu_stats(message: types.Message):
+    await message.answer(
+        "Выбери монету для статистики за 24ч:",
+        reply_markup=coins_kb(0, "stats"),
+        parse_mode="HTML",
+    )
+
+@dp.message(F.text == "🔔 Подписки")
+async def menu_subs(message: types.Message):
+    await message.answer(
+        "Нажми на монету, чтобы подписаться/отписаться от сигналов:",
+        reply_markup=coins_kb(0, "subs", await get_subs(message.from_user.id)),
+        parse_mode="HTML",
+    )
+
+@dp.callback_query(F.data.startswith("pg_"))
+async def cb_page(call: CallbackQuery):
+    _, mode, page = call.data.split("_")
+    page_i = int(page)
+    subs = await get_subs(call.from_user.id) if mode == "subs" else None
+    await call.message.edit_reply_markup(reply_markup=coins_kb(page_i, mode, subs))
+    await call.answer()
+
+@dp.callback_query(F.data.startswith("sub_"))
+async def cb_sub(call: CallbackQuery):
+    _, coin, page = call.data.split("_")
+    added = await toggle_sub(call.from_user.id, coin)
+    text = "Подписка включена" if added else "Подписка отключена"
+    await call.message.edit_reply_markup(
+        reply_markup=coins_kb(int(page), "subs", await get_subs(call.from_user.id))
+    )
+    await call.answer(text)
+
+# --- Статистика ---
+
+def render_data_age(ts: float, status: str) -> str:
+    """Приписка к ответу из устаревшего снимка: насколько стары данные и что с ними делаем."""
+    minutes = max(1, round((time.time() - ts) / 60))
+    return f"\n\n⏳ Данные {minutes} мин назад — {status}"
+
+def render_stats(stats: Dict[str, Any], currency: str, rates: Dict[str, float]) -> str:
+    price_str = convert_price_usd(stats["price"], currency, rates)
+    change_pct = stats["change_pct"]
+    vol = stats["volume"]
+
+    liq_warning = ""
+    if vol < 1_000_000:
+        liq_warning = "\n⚠️ Мало ликвидности. Спреды могут быть высокими."
+
+    sign = "+" if change_pct >= 0 else ""
+    return (
+        f"📊 Статистика за 24ч: {stats['coin']}\n\n"
+        f"💰 Цена: {price_str}\n"
+        f"📈 Изменение: {sign}{change_pct:.2f}% ({stats['abs_change']:+.4f} USDT)\n\n"
+        f"🔝 High 24h: {stats['high']:.4f}\n"
+        f"🔻 Low 24h: {stats['low']:.4f}\n"
+        f"💸 Объем: {vol:,.0f} USDT{liq_warning}\n"
+        f"🏦 Источник: {stats.get('source', EXCHANGE_ID)}"
+    )
+
+@dp.callback_query(F.data.startswith("st_"))
+async def cb_stats(call: CallbackQuery):
+    coin = call.data.split("_")[1]
+    user = await get_user(call.from_user.id)
+
+    try:
+        stats, state = snapshot_scheduler.peek(coin)
+        rates = await get_fiat_rates()
+        if state == "stale":
+            # Устаревший снимок сразу показываем с возрастом, а цену тем временем берём с биржи
+            stale_text = render_stats(stats, user["currency"], rates)
+            await call.message.edit_text(stale_text + render_data_age(stats["ts"], "обновляю..."), parse_mode="HTML")
+            try:
+                ticker = await ticker_flight.do(coin, lambda: market_hub.get_ticker(coin))
+            except Exception as e:
+                logger.warning(f"Stats refresh failed {coin}, showing snapshot: {e}")
+                await call.message.edit_text(
+                    stale_text + render_data_age(stats["ts"], "биржа пока не отвечает."), parse_mode="HTML"
                 )
+                return
+            stats = market_stats(coin, ticker)
+        elif state == "miss":
+            await call.message.edit_text(f"📊 Собираю статистику по {coin}...", parse_mode="HTML")
+            ticker = await ticker_flight.do(coin, lambda: market_hub.get_ticker(coin))
+            stats = market_stats(coin, ticker)
+
+        await call.message.edit_text(render_stats(stats, user["currency"], rates), parse_mode="HTML")
+    except Exception as e:
+        logger.error(f"Stats error {coin}: {e}")
+        await call.message.edit_text("⚠️ Не удалось получить статистику, попробуйте позже.")
 
-        # Фоллбек: алгоритмический анализ
-        if not ai_text:
-            bar = "🌤 Норма"
-            if rsi is not None:
-                if rsi < 30:
-                    bar = "🥶 Сильная перепроданность"
-                    comment = (
-                        "Цена неоправданно низкая. Толпа сливает монету, "
-                        "но для терпеливых это может быть хорошая точка входа."
-                    )
-                    verdict = "🟢 ПОКУПАТЬ / ДОКУПАТЬ"
-                elif rsi > 70:
-                    bar = "🌋 Перегрев"
-                    comment = (
-                        "Ажиотаж зашкаливает. Новички залетают на хаях, "
-                        "коррекция вниз выглядит очень вероятной."
-                    )
-                    verdict = "🔴 ФИКСИРОВАТЬ ПРИБЫЛЬ / ЖДАТЬ"
-                else:
-                    bar = "🌤 Баланс"
-                    comment = (
-                        "Рынок спокоен, явного перекоса нет. Можно просто держать позицию "
-                        "и ждать более сильного сигнала."
-                    )
-                    verdict = "⚪️ ДЕРЖАТЬ"
+# --- AI ПРОГНОЗ (Gemini + кэш) ---
+
+async def build_analysis(coin: str, with_ai: bool) -> Dict[str, Any]:
+    """
+    Вся медленная часть прогноза: биржа, индикаторы, Gemini.
+    Результат не зависит от валюты юзера и сразу кладётся в ai_cache.
+    """
+    cached, state = ai_cache.peek(coin)
+    snap = snapshot_scheduler.get(coin)
+    if cached is not None and state == "fresh" and with_ai and not cached["ai_attempted"]:
+        # Рыночные данные свежие (их посчитали для ALG-юзера), не хватает только текста Gemini
+        analysis = dict(cached)
+    elif snap is not None:
+        # Всё уже посчитано фоном — сеть не нужна
+        analysis = {**snap, "ai_raw": None, "ai_attempted": False}
+    else:
+        ticker = await market_hub.get_ticker(coin)
+        ohlcv = await candle_store.get(coin, KLINE_TIMEFRAME, ANALYSIS_CANDLES)
+        # То же окно и тот же расчёт, что у снимков: RSI не должен зависеть от пути ответа
+        closes = window_closes(ohlcv, ticker["last"])
+        indicators = indicator_engine.compute_all({coin: closes})[coin]
+
+        analysis = {
+            **market_stats(coin, ticker),
+            "rsi": indicators["rsi"],
+            "ai_raw": None,
+            "ai_attempted": False,
+        }
+
+    # Попытка AI-анализа в пределах бюджета ожидания
+    if with_ai:
+        def _late(text: Optional[str]):
+            # Gemini ответил после того, как юзер получил алгоритмический фоллбек
+            if text:
+                cached, _ = ai_cache.peek(coin)
+                ai_cache.set(coin, {**(cached or analysis), "ai_raw": text, "ai_attempted": True})
+
+        done, text = await ai_governor.within_budget(coin, build_ai_prompt(analysis), _late)
+        analysis["ai_raw"] = text
+        analysis["ai_attempted"] = done
+
+    ai_cache.set(coin, analysis)
+    return analysis
+
+def render_ai_header(analysis: Dict[str, Any], currency: str, rates: Dict[str, float]) -> str:
+    rsi = analysis["rsi"]
+    return (
+        f"🧠 AI-прогноз по {analysis['coin']}\n\n"
+        f"💰 Цена: {convert_price_usd(analysis['price'], currency, rates)}\n"
+        f"RSI(14): {int(rsi) if rsi else '-'} | Изм.24ч: {analysis['change_pct']:.2f}%\n\n"
+    )
+
+def render_forecast(analysis: Dict[str, Any], currency: str, mode: str, rates: Dict[str, float]) -> str:
+    """Текст прогноза для конкретного юзера: цена в его валюте, AI или алгоритм по режиму."""
+    coin = analysis["coin"]
+    rsi = analysis["rsi"]
+    price_str = convert_price_usd(analysis["price"], currency, rates)
+
+    if mode == "AI" and analysis["ai_raw"]:
+        return render_ai_header(analysis, currency, rates) + analysis["ai_raw"]
+
+    # Фоллбек: алгоритмический анализ
+    bar, comment, verdict = algorithmic_verdict(rsi)
+    text = (
+        f"🧠 Прогноз по {coin}\n\n"
+        f"💰 Цена: {price_str}\n"
+        f"🌡 Градусник рынка: {bar}\n\n"
+        f"🗣 {comment}\n\n"
+        f"⚖️ Вердикт: {verdict}"
+    )
+    if mode == "AI" and not analysis["ai_attempted"] and ai_governor.available():
+        text += "\n\n⏳ AI-разбор ещё готовится — загляни через минуту."
+    return text
+
+def _fresh_ai_text(coin: str) -> Optional[str]:
+    cached, state = ai_cache.peek(coin)
+    return cached["ai_raw"] if cached is not None and state == "fresh" else None
+
+async def stream_ai_text(analysis: Dict[str, Any]) -> AsyncIterator[str]:
+    """Один стрим Gemini по монете; готовый текст сразу кладётся в ai_cache."""
+    coin = analysis["coin"]
+    parts: List[str] = []
+    async for chunk in ai_governor.stream(build_ai_prompt(analysis), ready=lambda: _fresh_ai_text(coin)):
+        parts.append(chunk)
+        yield chunk
+    full = "".join(parts).strip()
+    if full:
+        cached, _ = ai_cache.peek(coin)
+        ai_cache.set(coin, {**(cached or analysis), "ai_raw": full, "ai_attempted": True})
+
+async def stream_ai_forecast(message: types.Message, analysis: Dict[str, Any], currency: str) -> Dict[str, Any]:
+    """
+    Печатает ответ Gemini по мере генерации. Все, кто стримит ту же монету, читают
+    один вызов модели (ai_stream_flight). Сообщение правим не чаще STREAM_EDIT_INTERVAL,
+    чтобы не упереться в лимиты Telegram.
+    """
+    coin = analysis["coin"]
+    ai_governor.demand[coin] = time.time()
+    rates = await get_fiat_rates()
+    header = render_ai_header(analysis, currency, rates)
+    text = ""
+    last_edit = time.monotonic()
+
+    async def _edit(text: str):
+        try:
+            await message.edit_text(text, parse_mode="HTML")
+        except TelegramBadRequest as e:
+            if "not modified" not in str(e):
+                raise
+
+    async for text in ai_stream_flight.follow(coin, lambda: stream_ai_text(analysis)):
+        if time.monotonic() - last_edit >= STREAM_EDIT_INTERVAL:
+            await _edit(header + text + " ▌")
+            last_edit = time.monotonic()
+
+    full = text.strip()
+    result = {**analysis, "ai_raw": full or None, "ai_attempted": bool(full)}
+    await _edit(render_forecast(result, currency, "AI", rates))
+    return result
+
+@dp.callback_query(F.data.startswith("ai_"))
+async def cb_ai(call: CallbackQuery):
+    coin = call.data.split("_")[1]
+    user = await get_user(call.from_user.id)
+    currency = user["currency"]
+    mode = user["analysis_mode"]
+    with_ai = mode == "AI"
+
+    try:
+        snap = snapshot_scheduler.get(coin)
+        if not with_ai and snap is not None:
+            # Алгоритмический прогноз целиком есть в снимке: ни сети, ни ожидания
+            analysis, state = {**snap, "ai_raw": None, "ai_attempted": False}, "snapshot"
+        else:
+            # Проверяем кэш. Анализ без AI-текста не подходит юзеру в режиме AI
+            analysis, state = ai_cache.get(coin)
+            if analysis is not None and with_ai and not analysis["ai_attempted"]:
+                analysis, state = None, "miss"
+
+        aged_ts = None
+        if analysis is None and not with_ai:
+            # Свежего нет, но есть устаревший снимок (рестарт, биржа молчит): отвечаем им
+            # с возрастом данных, а анализ досчитываем в фоне, как для устаревшего кэша
+            stale, snap_state = snapshot_scheduler.peek(coin)
+            if snap_state == "stale":
+                analysis, state = {**stale, "ai_raw": None, "ai_attempted": False}, "stale"
+                aged_ts = stale["ts"]
+
+        flight_key = (coin, with_ai)
+        if analysis is None and user["ai_stream"] and with_ai and ai_governor.available():
+            # Стриминг: рыночные данные без AI, а текст модели печатаем по кускам
+            await call.message.edit_text(f"🧠 Анализирую {coin}...", parse_mode="HTML")
+            if snap is not None:
+                base = {**snap, "ai_raw": None, "ai_attempted": False}
             else:
-                comment = "Недостаточно данных для RSI, ориентируемся по цене и динамике."
-                verdict = "⚪️ НЕЙТРАЛЬНО"
-
-            ai_text = (
-                f"🧠 Прогноз по {coin}\n\n"
-                f"💰 Цена: {price_str}\n"
-                f"🌡 Градусник рынка: {bar}\n\n"
-                f"🗣 {comment}\n\n"
-                f"⚖️ Вердикт: {verdict}"
-            )
+                base = await ai_flight.do((coin, False), lambda: build_analysis(coin, False))
+            await call.answer()
+            await stream_ai_forecast(call.message, base, currency)
+            return
 
-        # Сохраняем в кэш и отправляем
-        ai_cache[cache_key] = {"text": ai_text, "ts": now}
-        await call.message.edit_text(ai_text, parse_mode="HTML")
-        await call.answer()
+        if analysis is None:
+            await call.message.edit_text(f"🧠 Анализирую {coin}...", parse_mode="HTML")
+            analysis = await ai_flight.do(flight_key, lambda: build_analysis(coin, with_ai))
+        elif state == "stale":
+            # Отвечаем сразу устаревшим, а свежий анализ досчитываем в фоне
+            spawn_background(ai_flight.do(flight_key, lambda: build_analysis(coin, with_ai)), "ai refresh")
+
+        rates = await get_fiat_rates()
+        text = render_forecast(analysis, currency, mode, rates)
+        if aged_ts is not None:
+            text += render_data_age(aged_ts, "обновляю в фоне.")
+        await call.message.edit_text(text, parse_mode="HTML")
+        await call.answer("Ответ из кэша" if state in ("fresh", "stale") else None)
     except Exception as e:
         logger.error(f"AI analyse error {coin}: {e}")
         await call.message.edit_text(
             "⚠️ Не получилось получить данные для анализа, попробуй позже."
         )
-    finally:
-        await exchange.close()
 
-# --- Калькулятор: 100 TON, 0.5 BTC и т.п. ---
+# --- Калькулятор: 100 TON, 0.5 BTC и т.п. (несколько позиций через запятую) ---
+
+# Запятая и ровно три цифры — разделитель тысяч (1,000 DOGE), иначе десятичная запятая (0,5 BTC)
+CONVERTER_THOUSANDS = r"\d{1,3}(?:,\d{3})+(?:\.\d+)?"
+CONVERTER_ITEM = rf"({CONVERTER_THOUSANDS}|\d+(?:[.,]\d+)?)\s*([A-Za-zА-Яа-яЁё]+)"
+CONVERTER_RE = re.compile(rf"^\s*{CONVERTER_ITEM}(?:\s*[,;+\n]\s*{CONVERTER_ITEM})*\s*$")
+
+def parse_amount(raw: str) -> float:
+    if re.fullmatch(CONVERTER_THOUSANDS, raw):
+        return float(raw.replace(",", ""))
+    return float(raw.replace(",", "."))
+
+def looks_like_ticker(token: str) -> bool:
+    """«BTCC», «XYZ» — юзер явно имел в виду тикер, а не слово из обычной фразы."""
+    return re.fullmatch(r"[A-Z][A-Z0-9]{1,9}", token.strip()) is not None
+
+def resolve_fiat(token: str) -> Optional[str]:
+    token = token.strip().upper()
+    code = FIAT_ALIASES.get(token, token)
+    return code if code in CURRENCY_SYMBOLS else None
 
-@dp.message(F.text.regexp(r"^(\d+(\.\d+)?)\s+([A-Za-z]+)$"))
+async def price_assets(pairs: List[str]) -> Dict[str, float]:
+    """Цены пар: из живого потока, а чего там нет — одним запросом fetch_tickers."""
+    live = market_hub.snapshot()
+    prices = {p: live[p] for p in pairs if p in live}
+    missing = sorted(set(pairs) - set(prices))
+    if missing:
+        key = tuple(missing)
+        tickers = await ticker_flight.do(key, lambda: fetch_ticker_snapshot(missing))
+        prices.update({p: t["last"] for p, t in tickers.items()})
+    return prices
+
+def _fmt_amount(value: float) -> str:
+    return f"{value:,.2f}".replace(",", " ")
+
+@dp.message(F.text.regexp(CONVERTER_RE))
 async def converter_handler(message: types.Message):
-    m = re.match(r"^(\d+(\.\d+)?)\s+([A-Za-z]+)$", message.text.strip())
-    if not m:
-        return
+    items = re.findall(CONVERTER_ITEM, message.text)[:CONVERTER_MAX_ASSETS]
+    if not symbol_index.loaded and any(
+        resolve_fiat(raw) is None and symbol_index.resolve(raw)[0] is None for _, raw in items
+    ):
+        # Рынки ещё грузятся после старта: запасной список знает не все тикеры
+        await symbol_index.wait_loaded(CONVERTER_MARKETS_WAIT)
+
+    # Сначала проверяем тикеры по индексу рынков — неизвестное отсекаем без сети.
+    # positions: (сумма, актив, фиат ли)
+    positions: List[Tuple[float, str, bool]] = []
+    unknown: List[str] = []
+    typos: List[str] = []
+    for raw_amount, raw_symbol in items:
+        fiat = resolve_fiat(raw_symbol)
+        base, hint = (fiat, None) if fiat else symbol_index.resolve(raw_symbol)
+        if base is None:
+            name = f"{raw_symbol.upper()} (может, {hint}?)" if hint else raw_symbol.upper()
+            unknown.append(name)
+            if hint or looks_like_ticker(raw_symbol):
+                typos.append(name)
+        else:
+            positions.append((parse_amount(raw_amount), base, fiat is not None))
 
-    amount = float(m.group(1).replace(",", "."))
-    symbol = m.group(3).upper()
-    pair = f"{symbol}/USDT"
+    if not positions:
+        # Опечатка в тикере («100 BTCC») — подсказываем. Иначе это обычная фраза
+        # вроде «5 минут», а не запрос конвертера, и молчим
+        if typos:
+            await message.answer("⚠️ Не нашёл " + ", ".join(typos))
+        return
 
-    exchange = ccxt.binance()
+    pairs = [symbol_index.pair(base) for _, base, fiat in positions if not fiat]
     try:
-        ticker = await exchange.fetch_ticker(pair)
-        price_usd = ticker["last"]
-        total_usd = amount * price_usd
+        prices = await price_assets(pairs) if pairs else {}
+    except Exception as e:
+        logger.error(f"Converter error {positions}: {e}")
+        await message.answer("⚠️ Не удалось получить цены, попробуй позже.")
+        return
 
-        rates = await get_fiat_rates()
-        total_rub = total_usd * rates["RUB"]
-        total_eur = total_usd * rates["EUR"]
-
-        msg = (
-            f"🧮 Конвертация {amount} {symbol}\n\n"
-            f"≈ {total_usd:,.2f} USD\n"
-            f"≈ {total_rub:,.2f} RUB\n"
-            f"≈ {total_eur:,.2f} EUR"
+    rates = await get_fiat_rates()
+    lines: List[str] = []
+    converted: List[Tuple[float, str]] = []
+    total_usd = 0.0
+    for amount, base, fiat in positions:
+        if fiat:
+            # Курсы фиата — единиц валюты за 1 USD
+            rate = rates.get(base)
+            value = amount / rate if rate else None
+        else:
+            price = prices.get(symbol_index.pair(base))
+            value = amount * price if price is not None else None
+        if value is None:
+            unknown.append(base)
+            continue
+        total_usd += value
+        converted.append((amount, base))
+        lines.append(f"{amount:g} {base} ≈ {_fmt_amount(value)} USD")
+
+    if not lines:
+        await message.answer("⚠️ Не нашёл на бирже: " + ", ".join(unknown))
+        return
+
+    totals = [f"≈ {_fmt_amount(total_usd * rates[code])} {code}" for code in CURRENCY_SYMBOLS if code in rates]
+    if len(lines) == 1:
+        amount, base = converted[0]
+        msg = f"🧮 Конвертация {amount:g} {base}\n\n" + "\n".join(totals)
+    else:
+        msg = "🧮 Конвертация\n\n" + "\n".join(lines) + "\n\n💼 Итого:\n" + "\n".join(totals)
+    if unknown:
+        msg += "\n\n⚠️ Не нашёл на бирже: " + ", ".join(unknown)
+    await message.answer(msg, parse_mode="HTML")
+
+# ==============================================================================
+# ANALYSIS SNAPSHOTS (предрасчёт для мгновенных ответов)
+# ==============================================================================
+
+class SnapshotScheduler:
+    """
+    На каждое обновление рынка заранее считает по монете статистику за 24ч, RSI
+    (векторно по всем монетам сразу) и алгоритмический вердикт. Хендлеру остаётся
+    взять снимок из памяти и отформатировать в валюте юзера.
+    """
+
+    def __init__(self):
+        self.snapshots: Dict[str, Dict[str, Any]] = {}
+        self._dirty: set = set()
+        self._task: Optional[asyncio.Task] = None
+        # candle_errors — монеты без свечей; из них rsi_carried — RSI взят из прошлого снимка,
+        # skipped — переносить нечего, снимок не обновлён
+        self.stats = {"refreshed": 0, "candle_errors": 0, "rsi_carried": 0, "skipped": 0}
+
+    def start(self):
+        market_hub.add_listener(lambda coin, ticker: self._dirty.add(coin))
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    def get(self, coin: str) -> Optional[Dict[str, Any]]:
+        """Снимок, если он не старше SNAPSHOT_MAX_AGE, иначе None — хендлер посчитает сам."""
+        snap, state = self.peek(coin)
+        return snap if state == "fresh" else None
+
+    def peek(self, coin: str) -> Tuple[Optional[Dict[str, Any]], str]:
+        """
+        (снимок, состояние) как у AnalysisCache: "fresh" — моложе SNAPSHOT_MAX_AGE, "stale" —
+        не старше WARM_STATE_STALE_MAX_AGE (после рестарта или пока биржа не отвечает):
+        его можно показать, но только с возрастом данных; "miss" — снимка нет.
+        """
+        snap = self.snapshots.get(coin)
+        if snap is None:
+            return None, "miss"
+        age = time.time() - snap["ts"]
+        if age < SNAPSHOT_MAX_AGE:
+            return snap, "fresh"
+        if age <= WARM_STATE_STALE_MAX_AGE:
+            return snap, "stale"
+        return None, "miss"
+
+    async def _run(self):
+        while True:
+            try:
+                if market_hub.is_live():
+                    tickers = {c: market_hub.tickers[c] for c in self._dirty if c in market_hub.tickers}
+                    self._dirty.clear()
+                    interval = SNAPSHOT_INTERVAL
+                else:
+                    tickers = await fetch_ticker_snapshot(coin_universe.coins)
+                    interval = SNAPSHOT_REST_INTERVAL
+                if tickers:
+                    await self.refresh(tickers)
+            except Exception as e:
+                logger.error(f"Snapshot refresh error: {e}")
+                interval = SNAPSHOT_REST_INTERVAL
+            await asyncio.sleep(interval)
+
+    async def refresh(self, tickers: Dict[str, Dict[str, Any]]):
+        coins = list(tickers)
+        candles = await asyncio.gather(
+            *(candle_store.get(coin, KLINE_TIMEFRAME, ANALYSIS_CANDLES) for coin in coins), return_exceptions=True
         )
-        await message.answer(msg.replace(",", " "), parse_mode="HTML")
-    except Exception as e:
-        logger.error(f"Converter error {symbol}: {e}")
-        await message.answer("⚠️ Не удалось найти такую пару на бирже.")
-    finally:
-        await exchange.close()
+        closes: Dict[str, List[float]] = {}
+        failed: set = set()
+        for coin, result in zip(coins, candles):
+            if isinstance(result, Exception) or not result:
+                logger.error(f"Snapshot candles error {coin}: {result}")
+                failed.add(coin)
+                continue
+            closes[coin] = window_closes(result, tickers[coin]["last"])
+
+        indicators = indicator_engine.compute_all(closes)
+        now = time.time()
+        for coin in coins:
+            rsi = indicators.get(coin, {}).get("rsi")
+            rsi_ts = now
+            if coin in failed:
+                # Без свечей RSI не посчитать, а «нет данных» выглядело бы как честный ответ.
+                # Берём RSI прошлого снимка, пока он не слишком стар, иначе снимок не обновляем —
+                # старый сам выйдет за SNAPSHOT_MAX_AGE, и хендлер посчитает всё заново
+                self.stats["candle_errors"] += 1
+                prev = self.snapshots.get(coin)
+                if prev is None or prev["rsi"] is None or now - prev.get("rsi_ts", prev["ts"]) > SNAPSHOT_RSI_MAX_AGE:
+                    self.stats["skipped"] += 1
+                    continue
+                self.stats["rsi_carried"] += 1
+                rsi, rsi_ts = prev["rsi"], prev.get("rsi_ts", prev["ts"])
+            bar, comment, verdict = algorithmic_verdict(rsi)
+            self.snapshots[coin] = {
+                **market_stats(coin, tickers[coin]),
+                "rsi": rsi,
+                "rsi_ts": rsi_ts,
+                "bar": bar,
+                "comment": comment,
+                "verdict": verdict,
+                "ts": now,
+            }
+            self.stats["refreshed"] += 1
+
+snapshot_scheduler = SnapshotScheduler()
+
+# ==============================================================================
+# WARM STATE (быстрый рестарт)
+# ==============================================================================
+
+class WarmState:
+    """
+    Всё, что после рестарта пришлось бы заново собирать по сети: курсы фиата,
+    снимки рынка, кэш анализа и хвосты свечей (без них первый пересчёт снимков —
+    это запрос свечей на каждую монету). Лидер пишет файл раз в WARM_STATE_INTERVAL
+    и при остановке, любой процесс читает его при старте. Якоря алертов, подписки
+    и список монет здесь не нужны — они и так в базе.
+    """
+
+    VERSION = 1
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def collect(self) -> Dict[str, Any]:
+        return {
+            "version": self.VERSION,
+            "ts": time.time(),
+            "fiat": {"ts": fiat_rates.ts, "rates": dict(fiat_rates.rates)},
+            "snapshots": dict(snapshot_scheduler.snapshots),
+            "ai_cache": ai_cache.dump(WARM_STATE_STALE_MAX_AGE),
+            "candles": {} if CANDLE_STORE_DIR else candle_store.dump(WARM_STATE_CANDLES),
+        }
+
+    def _write(self, state: Dict[str, Any]):
+        # numpy-числа из индикаторов json сам не знает
+        write_json_atomic(self.path, state, ensure_ascii=False, default=float)
+
+    async def save(self):
+        """Снимок собираем в event loop, а сериализацию и запись отдаём потоку."""
+        started = time.perf_counter()
+        try:
+            await asyncio.to_thread(self._write, self.collect())
+            logger.info(f"Warm state saved to {self.path} in {time.perf_counter() - started:.2f}s")
+        except Exception as e:
+            logger.warning(f"Warm state not saved: {e}")
+
+    def load(self) -> bool:
+        started = time.perf_counter()
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return False
+        except Exception as e:
+            logger.warning(f"Warm state file {self.path} ignored: {e}")
+            return False
+        age = time.time() - state.get("ts", 0)
+        if state.get("version") != self.VERSION or age > WARM_STATE_MAX_AGE:
+            logger.info(f"Warm state in {self.path} is outdated (age {age:.0f}s), cold start")
+            return False
+
+        fiat = state.get("fiat") or {}
+        if fiat.get("rates"):
+            fiat_rates.restore(fiat["rates"], fiat.get("ts", 0.0))
+        # Время снимков не трогаем: старше SNAPSHOT_MAX_AGE они идут как устаревшие — хендлер
+        # показывает их с возрастом данных и обновляет по бирже, а планировщик (он стартует
+        # следом) пересчитывает их и переносит RSI, если свечи ещё не доступны
+        now = time.time()
+        snapshots = 0
+        for coin, snap in (state.get("snapshots") or {}).items():
+            if now - snap["ts"] > WARM_STATE_STALE_MAX_AGE or coin in snapshot_scheduler.snapshots:
+                continue
+            snapshot_scheduler.snapshots[coin] = {**snap, "rsi_ts": snap.get("rsi_ts", snap["ts"])}
+            snapshots += 1
+        cached = ai_cache.restore(state.get("ai_cache") or [], WARM_STATE_STALE_MAX_AGE)
+        candles = candle_store.restore(state.get("candles") or {})
+        logger.info(
+            f"Warm state loaded in {time.perf_counter() - started:.2f}s (age {age:.0f}s): "
+            f"{snapshots} snapshots, {cached} analyses, {candles} candle buffers"
+        )
+        return True
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(WARM_STATE_INTERVAL)
+            await self.save()
+
+warm_state = WarmState(WARM_STATE_FILE)
+
+# ==============================================================================
+# ALERT DELIVERY (очередь исходящих сообщений)
+# ==============================================================================
+
+class RateLimiter:
+    """Токен-бакет: в среднем не больше rate событий в секунду, всплеск до burst."""
+
+    def __init__(self, rate: float, burst: Optional[float] = None):
+        self.rate = rate
+        self.capacity = burst or rate
+        self._tokens = self.capacity
+        self._ts = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._ts) * self.rate)
+                self._ts = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+class AlertDelivery:
+    """
+    Ограниченная очередь алертов и пул воркеров, которые укладываются в лимиты Telegram
+    (глобальный и на чат). Свежие алерты уходят первыми, а устаревшие по той же паре
+    (юзер, монета) выкидываются. RetryAfter переносит отправку, заблокировавшие бота
+    юзеры записываются в blocked_users и вычищаются из подписок.
+    """
+
+    def __init__(self, workers: int = ALERT_WORKERS, maxsize: int = ALERT_QUEUE_SIZE):
+        self.workers = workers
+        self._queue: asyncio.PriorityQueue = asyncio.PriorityQueue(maxsize)
+        self._seq = itertools.count()
+        # (user_id, coin) -> seq самого свежего алерта: всё, что старше, уже неактуально
+        self._latest: Dict[Tuple[int, str], int] = {}
+        self._chat_next: Dict[int, float] = {}
+        self._global = RateLimiter(TELEGRAM_GLOBAL_RATE)
+        self._tasks: List[asyncio.Task] = []
+        self._timers: set = set()
+        self.stats = {"sent": 0, "dropped": 0, "superseded": 0, "expired": 0, "retried": 0, "blocked": 0}
+
+    def start(self):
+        for i in range(self.workers):
+            self._tasks.append(asyncio.create_task(self._worker(i)))
+
+    async def stop(self, drain: float = 0.0):
+        """
+        Останавливает воркеры. С drain > 0 сначала ждёт до drain секунд, пока они дошлют
+        очередь, включая отложенные по лимиту чата алерты; что не успело — теряется.
+        """
+        if drain > 0 and self._tasks:
+            try:
+                await asyncio.wait_for(self._drained(), drain)
+            except asyncio.TimeoutError:
+                logger.warning(
+                    f"Alert queue not drained in {drain}s: {self.qsize()} queued, {len(self._timers)} delayed"
+                )
+        for task in self._tasks:
+            task.cancel()
+        for handle in self._timers:
+            handle.cancel()
+        self._tasks.clear()
+        self._timers.clear()
+
+    async def _drained(self):
+        while True:
+            await self._queue.join()
+            if not self._timers:
+                return
+            await asyncio.sleep(0.1)
+
+    def qsize(self) -> int:
+        return self._queue.qsize()
+
+    def submit(self, user_id: int, coin: str, text: str) -> bool:
+        seq = next(self._seq)
+        alert = {"user_id": user_id, "coin": coin, "text": text, "created": time.time(), "attempts": 0}
+        if not self._put(seq, alert):
+            # Новый не влез — уже стоящий в очереди алерт по этой паре остаётся актуальным
+            return False
+        self._latest[(user_id, coin)] = seq
+        return True
+
+    def _put(self, seq: int, alert: Dict[str, Any]) -> bool:
+        try:
+            # Приоритет — время создания: чем свежее алерт, тем раньше он уйдёт
+            self._queue.put_nowait((-alert["created"], seq, alert))
+            return True
+        except asyncio.QueueFull:
+            self.stats["dropped"] += 1
+            logger.warning(f"Alert queue full, dropped alert for {alert['user_id']} {alert['coin']}")
+            return False
+
+    def _put_later(self, delay: float, seq: int, alert: Dict[str, Any]):
+        def _fire():
+            self._timers.discard(handle)
+            if not self._put(seq, alert):
+                self._done(seq, alert)
+
+        handle = asyncio.get_running_loop().call_later(delay, _fire)
+        self._timers.add(handle)
+
+    def _is_current(self, seq: int, alert: Dict[str, Any]) -> bool:
+        return self._latest.get((alert["user_id"], alert["coin"])) == seq
+
+    def _done(self, seq: int, alert: Dict[str, Any]):
+        key = (alert["user_id"], alert["coin"])
+        if self._latest.get(key) == seq:
+            del self._latest[key]
+
+    async def _worker(self, n: int):
+        while True:
+            _, seq, alert = await self._queue.get()
+            try:
+                await self._deliver(seq, alert)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Alert worker {n} error: {e}")
+            finally:
+                self._queue.task_done()
+
+    async def _deliver(self, seq: int, alert: Dict[str, Any]):
+        if not self._is_current(seq, alert):
+            self.stats["superseded"] += 1
+            return
+        if time.time() - alert["created"] > ALERT_MAX_AGE:
+            self.stats["expired"] += 1
+            self._done(seq, alert)
+            return
+
+        chat_id = alert["user_id"]
+        now = time.monotonic()
+        wait = self._chat_next.get(chat_id, 0.0) - now
+        if wait > 0:
+            # Чат ещё на паузе: не держим воркер, а возвращаем алерт в очередь позже
+            self._put_later(wait, seq, alert)
+            return
+
+        await self._global.acquire()
+        self._chat_next[chat_id] = time.monotonic() + TELEGRAM_CHAT_INTERVAL
+        try:
+            await bot.send_message(chat_id, alert["text"], parse_mode="HTML")
+            self.stats["sent"] += 1
+            self._done(seq, alert)
+        except TelegramRetryAfter as e:
+            self.stats["retried"] += 1
+            self._chat_next[chat_id] = time.monotonic() + e.retry_after
+            self._put_later(e.retry_after, seq, alert)
+        except TelegramForbiddenError:
+            self.stats["blocked"] += 1
+            self._done(seq, alert)
+            await mark_user_blocked(chat_id)
+        except TelegramBadRequest as e:
+            self.stats["dropped"] += 1
+            self._done(seq, alert)
+            logger.error(f"Alert rejected for {chat_id}: {e}")
+        except Exception as e:
+            alert["attempts"] += 1
+            if alert["attempts"] >= ALERT_MAX_ATTEMPTS:
+                self.stats["dropped"] += 1
+                self._done(seq, alert)
+                logger.error(f"Alert send failed for {chat_id}, giving up: {e}")
+            else:
+                self.stats["retried"] += 1
+                self._put_later(2 ** alert["attempts"], seq, alert)
+        finally:
+            self._prune_chats()
+
+    def _prune_chats(self):
+        if len(self._chat_next) > 10_000:
+            now = time.monotonic()
+            self._chat_next = {c: t for c, t in self._chat_next.items() if t > now}
+
+alert_delivery = AlertDelivery()
+
+def format_alert(coin: str, change_pct: float, anchor: float, price: float, currency: str, rates: Dict[str, float]) -> str:
+    arrow = "🚀" if change_pct > 0 else "🔻"
+    return (
+        f"🚨 Движение по {coin}\n"
+        f"{arrow} {change_pct:.2f}% (от {anchor:.4f})\n"
+        f"Текущая цена: {convert_price_usd(price, currency, rates)}"
+    )
+
+class AlertDigest:
+    """
+    Режим сводки: сработавшие алерты юзера копятся ALERT_DIGEST_WINDOW секунд с первого
+    и уходят одним сообщением, монеты по убыванию силы движения. Повторное срабатывание
+    той же монеты внутри окна не добавляет строку — движение считается от первого якоря.
+    Отправку делает монитор своего процесса: flush_due в конце каждого цикла.
+    """
+
+    def __init__(self, window: float = ALERT_DIGEST_WINDOW):
+        self.window = window
+        # user_id -> {"due", "currency", "submit", "alerts", "coins": {coin: {"anchor", "price"}}}
+        self._pending: Dict[int, Dict[str, Any]] = {}
+        self._order: deque = deque()  # (due, user_id); окно одно на всех, так что порядок сам по возрастанию
+        self.stats = {"alerts": 0, "digests": 0, "saved": 0}
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def add(self, user: Dict[str, Any], coin: str, price: float, submit: Callable[[int, str, str], bool]):
+        user_id = user["user_id"]
+        entry = self._pending.get(user_id)
+        if entry is None:
+            due = time.monotonic() + self.window
+            entry = self._pending[user_id] = {"due": due, "alerts": 0, "coins": {}}
+            self._order.append((due, user_id))
+        entry["currency"] = user["currency"]
+        entry["submit"] = submit
+        entry["alerts"] += 1
+        entry["coins"].setdefault(coin, {"anchor": user["anchor"]})["price"] = price
+        self.stats["alerts"] += 1
+
+    def render(self, coins: Dict[str, Dict[str, float]], currency: str, rates: Dict[str, float]) -> str:
+        moves = sorted(
+            ((coin, (c["price"] / c["anchor"] - 1) * 100, c) for coin, c in coins.items()),
+            key=lambda m: abs(m[1]), reverse=True,
+        )
+        if len(moves) == 1:
+            coin, change_pct, c = moves[0]
+            return format_alert(coin, change_pct, c["anchor"], c["price"], currency, rates)
+        lines = [f"📬 Сводка движений ({len(moves)})"]
+        for coin, change_pct, c in moves:
+            arrow = "🚀" if change_pct > 0 else "🔻"
+            lines.append(f"{arrow} {coin} {change_pct:+.2f}% → {convert_price_usd(c['price'], currency, rates)}")
+        return "\n".join(lines)
+
+    async def flush_due(self, force: bool = False) -> int:
+        """Отправляет сводки, у которых истекло окно (force — все). Возвращает число сообщений."""
+        now = time.monotonic()
+        ready = []
+        while self._order and (force or self._order[0][0] <= now):
+            _, user_id = self._order.popleft()
+            ready.append((user_id, self._pending.pop(user_id)))
+        if not ready:
+            return 0
+        rates = await get_fiat_rates()
+        for user_id, entry in ready:
+            text = self.render(entry["coins"], entry["currency"], rates)
+            # Ключ уникален: следующая сводка не должна вытеснить ещё не отправленную
+            entry["submit"](user_id, f"digest:{entry['due']}", text)
+            self.stats["digests"] += 1
+            self.stats["saved"] += entry["alerts"] - 1
+        return len(ready)
+
+alert_digest = AlertDigest()
 
 # ==============================================================================
 # BACKGROUND MONITOR (Простые алерты по %)
 # ==============================================================================
 
+async def check_coin_alerts(
+    coin: str,
+    price: float,
+    submit: Optional[Callable[[int, str, str], bool]] = None,
+) -> int:
+    """
+    Сравнивает цену монеты с личными якорями подписчиков и ставит алерты в очередь
+    на отправку (по умолчанию — alert_delivery, у сканера-партиции — outbox в базе);
+    алерты юзеров в режиме сводки уходят в alert_digest.
+    Возвращает количество сработавших алертов.
+    """
+    submit = submit or alert_delivery.submit
+    # Движок сам переставляет якоря сработавших и новых подписчиков
+    matched = subscription_index.evaluate(coin, price)
+    if not matched:
+        return 0
+
+    sent = 0
+    rates = await get_fiat_rates()
+    for u in matched:
+        if u.get("alert_digest"):
+            alert_digest.add(u, coin, price, submit)
+            sent += 1
+            continue
+        text = format_alert(coin, u["change_pct"], u["anchor"], price, u["currency"], rates)
+        if submit(u["user_id"], coin, text):
+            sent += 1
+    return sent
+
+class AdaptivePoller:
+    """
+    Планировщик REST-опроса: у каждой пары свой срок следующей проверки.
+    Вес пары растёт с её недавней волатильностью (EWMA |Δ%| / √сек) и числом
+    подписчиков; бюджет budget обновлений в секунду делится пропорционально весам,
+    интервал зажат в [POLL_MIN_INTERVAL, POLL_MAX_INTERVAL]. Созревшие пары
+    забираются одним запросом fetch_tickers.
+    """
+
+    def __init__(self, budget: Optional[float] = None):
+        self.budget = budget or POLL_BUDGET
+        self._due: Dict[str, float] = {}
+        self._last: Dict[str, Tuple[float, float]] = {}  # coin -> (цена, monotonic)
+        self._vol: Dict[str, float] = {}
+
+    def weight(self, coin: str) -> float:
+        vol = self._vol.get(coin, POLL_VOL_REF)
+        return (1.0 + vol / POLL_VOL_REF) * (1.0 + math.log1p(subscription_index.count(coin)))
+
+    def intervals(self, coins: List[str]) -> Dict[str, float]:
+        weights = {coin: self.weight(coin) for coin in coins}
+        total = sum(weights.values())
+        return {
+            coin: min(max(total / (w * self.budget), POLL_MIN_INTERVAL), POLL_MAX_INTERVAL)
+            for coin, w in weights.items()
+        }
+
+    def observe(self, coin: str, price: float, now: float):
+        prev = self._last.get(coin)
+        self._last[coin] = (price, now)
+        if prev is None or prev[0] <= 0:
+            return
+        move = abs(price / prev[0] - 1.0) * 100 / math.sqrt(max(now - prev[1], 1e-3))
+        vol = self._vol.get(coin, POLL_VOL_REF)
+        self._vol[coin] = vol + POLL_VOL_ALPHA * (move - vol)
+
+    async def poll(self, coins: List[str]) -> Dict[str, float]:
+        """Цены пар, чей срок подошёл (пусто, если опрашивать пока некого)."""
+        now = time.monotonic()
+        due = [coin for coin in coins if self._due.get(coin, 0.0) <= now]
+        if not due:
+            return {}
+        tickers = await fetch_ticker_snapshot(due)
+        now = time.monotonic()
+        prices = {}
+        for coin in due:
+            ticker = tickers.get(coin)
+            if ticker is not None:
+                prices[coin] = ticker["last"]
+                self.observe(coin, ticker["last"], now)
+        intervals = self.intervals(coins)
+        for coin in due:
+            # Пару без цены (снята с торгов) не дёргаем чаще максимального интервала
+            self._due[coin] = now + (intervals[coin] if coin in prices else POLL_MAX_INTERVAL)
+        for coin in set(self._due) - set(coins):
+            self._due.pop(coin, None)
+            self._last.pop(coin, None)
+            self._vol.pop(coin, None)
+        return prices
+
+# Счётчики монитора для логов и бенчмарка
+monitor_stats: Dict[str, Any] = {"cycles": 0, "alerts": 0, "cycle_times": deque(maxlen=1000)}
+
 async def background_monitor():
-    logger.info("Background monitor started...")
-    exchange = ccxt.binance({'enableRateLimit': True})
-    last_prices: Dict[str, float] = {}
+    logger.info(f"Background monitor started ({'batch' if MONITOR_BATCH_MODE else 'per-coin'} mode)...")
+    # Монеты, по которым поток прислал обновление с прошлой проверки
+    changed: set = set()
+    market_hub.add_listener(lambda coin, ticker: changed.add(coin))
+    poller = AdaptivePoller()
 
     while True:
-        for coin in COINS:
-            try:
-                ticker = await exchange.fetch_ticker(coin)
-                price = ticker["last"]
+        if not MONITOR_BATCH_MODE:
+            for coin in list(coin_universe.coins):
+                try:
+                    ticker = await price_source.ticker(coin)
+                    await check_coin_alerts(coin, ticker["last"])
+                except Exception as e:
+                    logger.error(f"Monitor error {coin}: {e}")
 
-                # Флаг: нужно ли обновлять опорную цену?
-                # Обновляем только если отправили алерт или это первый запуск для монеты
-                should_update_anchor = False
+                await asyncio.sleep(1.0)
 
-                if coin not in last_prices:
-                    should_update_anchor = True
-                else:
-                    old = last_prices[coin]
-                    if old > 0:
-                        change_pct = (price - old) / old * 100
-                        subs = get_subscribers(coin)
-
-                        # Проверяем всех подписчиков
-                        for u in subs:
-                            threshold = u["alert_percent"]
-                            if abs(change_pct) >= threshold:
-                                rates = await get_fiat_rates()
-                                p_str = convert_price_usd(price, u["currency"], rates)
-                                arrow = "🚀" if change_pct > 0 else "🔻"
-                                text = (
-                                    f"🚨 Движение по {coin}\n"
-                                    f"{arrow} {change_pct:.2f}% (от {old:.4f})\n"
-                                    f"Текущая цена: {p_str}"
-                                )
-                                try:
-                                    await bot.send_message(
-                                        u["user_id"], text, parse_mode="HTML"
-                                    )
-                                    await asyncio.sleep(0.05)
-                                except (TelegramForbiddenError, TelegramRetryAfter, TelegramBadRequest):
-                                    pass
-
-                        # Если хотя бы одному юзеру отправили — сбрасываем "якорь"
-                        should_update_anchor = True
-
-                # Обновляем цену только если было событие или инициализация
-                if should_update_anchor:
-                    last_prices[coin] = price
+            await alert_digest.flush_due()
+            await asyncio.sleep(ALERT_CHECK_DELAY)
+            continue
+
+        # Батч-режим: за цикл один снимок цен — из потока или по расписанию опроса
+        cycle_start = time.monotonic()
+        sent = 0
+        if market_hub.is_live():
+            # Цены уже в памяти: проверяем только то, что поменялось
+            live = market_hub.snapshot()
+            prices = {coin: live[coin] for coin in changed if coin in live}
+            changed.clear()
+            source, interval = "stream", MONITOR_STREAM_INTERVAL
+        else:
+            try:
+                prices = await poller.poll(coin_universe.coins)
+            except Exception as e:
+                logger.error(f"Monitor snapshot error: {e}")
+                prices = {}
+            source, interval = "rest", POLL_TICK
+        fetch_time = time.monotonic() - cycle_start
 
+        for coin, price in prices.items():
+            try:
+                sent += await check_coin_alerts(coin, price)
             except Exception as e:
                 logger.error(f"Monitor error {coin}: {e}")
+        try:
+            digests = await alert_digest.flush_due()
+        except Exception as e:
+            logger.error(f"Digest flush error: {e}")
+            digests = 0
+
+        cycle_time = time.monotonic() - cycle_start
+        monitor_stats["cycles"] += 1
+        monitor_stats["alerts"] += sent
+        monitor_stats["cycle_times"].append(cycle_time)
+        metrics.set("monitor_cycle_seconds", cycle_time, source=source)
+        if sent or digests or monitor_stats["cycles"] % MONITOR_LOG_EVERY == 0:
+            logger.info(
+                f"Monitor cycle ({source}): {len(prices)}/{len(coin_universe)} coins, {sent} alerts, "
+                f"{digests} digests (sends saved so far: {alert_digest.stats['saved']}), "
+                f"fetch {fetch_time:.2f}s, total {cycle_time:.2f}s, "
+                f"queue {alert_delivery.qsize()}, delivery {alert_delivery.stats}"
+            )
+        await asyncio.sleep(max(0.0, interval - cycle_time))
+
+# ==============================================================================
+# PARTITIONED MONITOR (несколько процессов-сканеров)
+# ==============================================================================
+
+class HashRing:
+    """Консистентное хеширование: при входе/выходе узла переезжает только его доля монет."""
+
+    def __init__(self, nodes: List[str], replicas: int = HASH_RING_REPLICAS):
+        points = sorted(
+            (self._hash(f"{node}#{i}"), node) for node in nodes for i in range(replicas)
+        )
+        self._keys = [p[0] for p in points]
+        self._nodes = [p[1] for p in points]
+
+    @staticmethod
+    def _hash(key: str) -> int:
+        return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+    def owner(self, key: str) -> Optional[str]:
+        if not self._keys:
+            return None
+        pos = bisect.bisect(self._keys, self._hash(key)) % len(self._keys)
+        return self._nodes[pos]
+
+def _outbox_submit(user_id: int, coin: str, text: str) -> bool:
+    storage.write(
+        "INSERT INTO alert_outbox (user_id, coin, text, created) VALUES (?, ?, ?, ?)",
+        (user_id, coin, text, time.time()),
+    )
+    return True
+
+async def run_monitor_partition(index: int):
+    """
+    Сканер одной партиции. Монеты делятся между живыми сканерами по кольцу, членство —
+    heartbeat в таблице monitor_members. Личные якоря подписчиков лежат в alert_anchors:
+    взяв монету, сканер перечитывает их оттуда, так что переезд и рестарт их не теряют.
+    Алерты пишутся в alert_outbox, отправляет их лидер.
+    """
+    member = f"{index}:{os.getpid()}"
+    await init_db()
+    await subscription_index.rebuild()
+    await coin_universe.load()
+    await price_source.start()
+    fiat_rates.start()
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    owned: List[str] = []
+    # Общий бюджет опроса делится между сканерами поровну
+    poller = AdaptivePoller(POLL_BUDGET / max(1, MONITOR_PARTITIONS))
+    last_heartbeat = 0.0
+    last_resync = time.monotonic()
+    logger.info(f"Monitor partition {member} started")
+    try:
+        while not stop.is_set():
+            cycle_start = time.monotonic()
+            if cycle_start - last_heartbeat >= MONITOR_HEARTBEAT_INTERVAL:
+                now = time.time()
+                storage.write(
+                    "INSERT OR REPLACE INTO monitor_members (member_id, heartbeat) VALUES (?, ?)", (member, now)
+                )
+                storage.write("DELETE FROM monitor_members WHERE heartbeat < ?", (now - MONITOR_MEMBER_TTL,))
+                rows = await storage.fetchall("SELECT member_id FROM monitor_members")
+                ring = HashRing([r["member_id"] for r in rows])
+                new_owned = [coin for coin in coin_universe.coins if ring.owner(coin) == member]
+                last_heartbeat = cycle_start
+
+                if new_owned != owned:
+                    await subscription_index.reload_anchors([coin for coin in new_owned if coin not in owned])
+                    logger.info(
+                        f"Partition {member}: {len(new_owned)} coins of {len(coin_universe)}, {len(rows)} members"
+                    )
+                    owned = new_owned
+
+            if time.monotonic() - last_resync > SHARED_RESYNC_INTERVAL:
+                await subscription_index.rebuild()
+                await coin_universe.load()
+                last_resync = time.monotonic()
+
+            sent = 0
+            try:
+                prices = await poller.poll(owned) if owned else {}
+            except Exception as e:
+                logger.error(f"Partition {member} snapshot error: {e}")
+                prices = {}
+            for coin, price in prices.items():
+                try:
+                    sent += await check_coin_alerts(coin, price, _outbox_submit)
+                except Exception as e:
+                    logger.error(f"Partition {member} error {coin}: {e}")
+            try:
+                digests = await alert_digest.flush_due()
+            except Exception as e:
+                logger.error(f"Partition {member} digest flush error: {e}")
+                digests = 0
+            if sent or digests:
+                logger.info(
+                    f"Partition {member}: {sent} alerts, {digests} digests to outbox "
+                    f"(sends saved so far: {alert_digest.stats['saved']})"
+                )
+
+            cycle_time = time.monotonic() - cycle_start
+            try:
+                await asyncio.wait_for(stop.wait(), max(0.0, POLL_TICK - cycle_time))
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        # Уходим честно: соседи заберут наши монеты на следующем цикле, не дожидаясь TTL
+        storage.write("DELETE FROM monitor_members WHERE member_id = ?", (member,))
+        # Накопленные сводки — в outbox, их отправит лидер
+        try:
+            await alert_digest.flush_due(force=True)
+        except Exception as e:
+            logger.error(f"Partition {member} digest flush on shutdown failed: {e}")
+        await fiat_rates.close()
+        await price_source.close()
+        await storage.close()
+
+def _monitor_partition_entry(index: int):
+    asyncio.run(run_monitor_partition(index))
+
+async def supervise_monitor_partitions():
+    """Держит MONITOR_PARTITIONS процессов-сканеров живыми, упавшие перезапускает."""
+    ctx = multiprocessing.get_context("spawn")
+    procs: Dict[int, Any] = {}
+    try:
+        while True:
+            for i in range(MONITOR_PARTITIONS):
+                proc = procs.get(i)
+                if proc is not None and proc.is_alive():
+                    continue
+                if proc is not None:
+                    logger.warning(f"Monitor partition {i} exited with code {proc.exitcode}, restarting")
+                proc = ctx.Process(target=_monitor_partition_entry, args=(i,), name=f"monitor-partition-{i}")
+                proc.start()
+                procs[i] = proc
+            await asyncio.sleep(LEADER_RETRY_INTERVAL)
+    finally:
+        for proc in procs.values():
+            proc.terminate()
+        for proc in procs.values():
+            await asyncio.to_thread(proc.join, 10)
+
+async def outbox_drain_loop():
+    """Координатор: перекладывает алерты сканеров из alert_outbox в общую очередь отправки."""
+    while True:
+        rows = await storage.fetchall(
+            "SELECT id, user_id, coin, text, created FROM alert_outbox ORDER BY id LIMIT ?", (OUTBOX_BATCH,)
+        )
+        now = time.time()
+        for r in rows:
+            if now - r["created"] <= ALERT_MAX_AGE:
+                alert_delivery.submit(r["user_id"], r["coin"], r["text"])
+        if rows:
+            storage.write("DELETE FROM alert_outbox WHERE id <= ?", (rows[-1]["id"],))
+        if len(rows) < OUTBOX_BATCH:
+            await asyncio.sleep(OUTBOX_DRAIN_INTERVAL)
+
+# ==============================================================================
+# WEBHOOK WORKERS & LEADER ELECTION
+# ==============================================================================
+
+class LeaderLock:
+    """
+    Эксклюзивный flock на файл рядом с базой. Держит его ровно один процесс —
+    он и гоняет фоновый монитор. Умер процесс — ОС сама снимает блокировку,
+    и её подхватывает следующий воркер.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._fd: Optional[int] = None
+
+    @property
+    def held(self) -> bool:
+        return self._fd is not None
+
+    def try_acquire(self) -> bool:
+        if self._fd is not None:
+            return True
+        if fcntl is None:
+            # Нет flock (Windows) — там и воркер всегда один
+            self._fd = -1
+            return True
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+        os.ftruncate(fd, 0)
+        os.write(fd, str(os.getpid()).encode())
+        self._fd = fd
+        return True
+
+    def release(self):
+        if self._fd is None:
+            return
+        if self._fd >= 0:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+        self._fd = None
+
+leader_lock = LeaderLock(LEADER_LOCK_FILE)
+
+async def leader_loop():
+    """Ждёт лидерства и запускает то, что должно работать в единственном экземпляре."""
+    while not leader_lock.try_acquire():
+        await asyncio.sleep(LEADER_RETRY_INTERVAL)
+    logger.info(f"Process {os.getpid()} is the leader: running alert monitor")
+    alert_delivery.start()
+    tasks = [
+        asyncio.create_task(coin_universe.run()),
+        asyncio.create_task(warm_state.run()),
+    ]
+    if MONITOR_PARTITIONS > 0:
+        tasks.append(asyncio.create_task(supervise_monitor_partitions()))
+        tasks.append(asyncio.create_task(outbox_drain_loop()))
+    else:
+        tasks.append(asyncio.create_task(background_monitor()))
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        # Якоря этих алертов уже сохранены: не отправим сводку сейчас — она пропадёт насовсем
+        try:
+            await alert_digest.flush_due(force=True)
+        except Exception as e:
+            logger.error(f"Digest flush on shutdown failed: {e}")
+        await alert_delivery.stop(drain=ALERT_DRAIN_TIMEOUT)
+        # Пока блокировка наша, файл не пишет никто другой
+        await warm_state.save()
+        leader_lock.release()
+
+async def shared_resync_loop():
+    """
+    Воркеры меняют подписки и настройки в общей базе, а индекс у каждого свой.
+    Периодически перечитываем его, чтобы монитор видел подписки из всех процессов,
+    а заодно и список монет, который собирает лидер.
+    """
+    while True:
+        await asyncio.sleep(SHARED_RESYNC_INTERVAL)
+        try:
+            await subscription_index.rebuild()
+            await coin_universe.load()
+        except Exception as e:
+            logger.error(f"Subscription resync error: {e}")
+
+class TelegramRequestMetrics(BaseRequestMiddleware):
+    """Время каждого вызова Bot API (sendMessage, editMessageText, ...)."""
+
+    async def __call__(self, make_request, bot, method):
+        with metrics.timer("telegram_request_seconds", method=method.__api_method__):
+            return await make_request(bot, method)
+
+async def handler_metrics_middleware(handler, event, data):
+    with metrics.timer("handler_seconds", handler=data["handler"].callback.__name__):
+        return await handler(event, data)
+
+def _stats_samples(name: str, help_text: str, label: str, stats: Dict[str, Any], **labels: str):
+    return [(name, "counter", help_text, {**labels, label: key}, value) for key, value in stats.items()]
+
+def collect_runtime_metrics() -> List[Tuple[str, str, str, Dict[str, str], float]]:
+    """Счётчики, которые модули уже ведут сами: читаем их в момент скрейпа."""
+    samples = []
+    for cache_name, cache in (("ai", ai_cache), ("user", user_cache), ("fiat", fiat_rates)):
+        samples += _stats_samples("cache_events_total", "Cache hits/misses/evictions", "event", cache.stats, cache=cache_name)
+    samples += _stats_samples("alerts_total", "Alert delivery outcomes (sent, dropped, ...)", "result", alert_delivery.stats)
+    samples += _stats_samples("alert_digest_total", "Digest mode: alerts folded, digests sent, sends saved", "kind", alert_digest.stats)
+    samples += _stats_samples("snapshot_total", "Snapshot refreshes, candle errors, carried RSI, skipped coins", "event", snapshot_scheduler.stats)
+    samples += _stats_samples("gemini_calls_total", "AI governor outcomes", "result", ai_governor.stats)
+    samples += _stats_samples("price_source_total", "Hedged requests, hedge wins, failovers, total outages", "event", price_source.stats)
+    # Строки одной метрики в Prometheus должны идти подряд: сначала счётчики всех бирж, потом их gauge
+    for pool in price_source.pools:
+        samples += _stats_samples("exchange_health_total", "Exchange calls by outcome", "event", pool.health.stats, exchange=pool.exchange_id)
+    for pool in price_source.pools:
+        samples.append(("exchange_breaker_open", "gauge", "1 while the exchange circuit breaker is open", {"exchange": pool.exchange_id}, int(pool.health.is_open)))
+    samples += _stats_samples("db_statements_total", "Storage reads, queued writes and transactions", "kind", storage.stats)
+    for sf in single_flights:
+        samples += _stats_samples("single_flight_total", "Single-flight leaders vs coalesced callers", "role", sf.stats, flight=sf.name)
+    samples.append(("monitor_alerts_total", "counter", "Alerts produced by the monitor", {}, monitor_stats["alerts"]))
+    samples.append(("alert_queue_size", "gauge", "Alerts waiting for delivery", {}, alert_delivery.qsize()))
+    samples.append(("ai_cache_size", "gauge", "Entries in the analysis cache", {}, len(ai_cache)))
+    samples.append(("coin_universe_size", "gauge", "Coins currently watched", {}, len(coin_universe)))
+    return samples
+
+async def setup_metrics(port: int):
+    """Включает метрики: HTTP-эндпоинт, middleware Bot API и хендлеров, коллекторы."""
+    metrics.describe("handler_seconds", "histogram", "Handler latency")
+    metrics.describe("exchange_request_seconds", "histogram", "Exchange API call latency by ccxt method")
+    metrics.describe("gemini_request_seconds", "histogram", "Gemini latency (full reply or first streamed chunk)")
+    metrics.describe("db_operation_seconds", "histogram", "SQLite read round trips and batch flushes")
+    metrics.describe("telegram_request_seconds", "histogram", "Bot API call latency by method")
+    metrics.describe("monitor_cycle_seconds", "gauge", "Duration of the last monitor cycle")
+    metrics.describe("startup_seconds", "gauge", "Seconds from process start to each startup phase")
+    bot.session.middleware(TelegramRequestMetrics())
+    dp.message.middleware(handler_metrics_middleware)
+    dp.callback_query.middleware(handler_metrics_middleware)
+    metrics.add_collector(collect_runtime_metrics)
+    await metrics.start(METRICS_HOST, port)
+    # Фазы, пройденные до включения метрик (импорт), публикуем задним числом
+    for phase, elapsed in startup_marks.items():
+        metrics.set("startup_seconds", elapsed, phase=phase)
+
+# Фаза старта -> секунд от запуска процесса
+startup_marks: Dict[str, float] = {}
+
+def mark_startup(phase: str):
+    elapsed = time.monotonic() - PROCESS_STARTED
+    startup_marks[phase] = elapsed
+    metrics.set("startup_seconds", elapsed, phase=phase)
+    logger.info(f"Startup: {phase} after {elapsed:.2f}s")
+
+@dp.update.outer_middleware()
+async def first_update_middleware(handler, event, data):
+    if "first_update" not in startup_marks:
+        mark_startup("first_update")
+    return await handler(event, data)
+
+async def start_market_services():
+    """Биржи, поток, снимки и Gemini. Тяжёлые импорты идут в потоке, event loop тем временем отвечает юзерам."""
+    try:
+        await price_source.start()
+        if MARKET_STREAM_ENABLED:
+            market_hub.start()
+        snapshot_scheduler.start()
+        mark_startup("market_data")
+        if GEMINI_ENABLED:
+            await asyncio.to_thread(get_gemini_model)
+    except Exception as e:
+        # Не смертельно: клиенты бирж и Gemini поднимутся сами при первом запросе
+        logger.error(f"Market services start error: {e}")
+
+market_services_task: Optional[asyncio.Task] = None
+ai_prefetch_task: Optional[asyncio.Task] = None
+
+async def start_services(worker_id: int = 0):
+    global market_services_task, ai_prefetch_task
+    if METRICS_PORT:
+        await setup_metrics(METRICS_PORT + worker_id)
+    await init_db()
+    await subscription_index.rebuild()
+    await coin_universe.load()
+    fiat_rates.start()
+    # Снимки, кэш анализа и свечи с прошлого запуска: первые клики не ждут сеть
+    warm_state.load()
+    market_services_task = asyncio.create_task(start_market_services())
+    # Спрос и кэш анализа у каждого воркера свои, поэтому и предзагрузка в каждом, а не только в лидере
+    ai_prefetch_task = asyncio.create_task(ai_prefetch_loop())
+    mark_startup("ready")
+
+async def stop_services():
+    for task in (market_services_task, ai_prefetch_task):
+        if task is not None and not task.done():
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+    await snapshot_scheduler.stop()
+    logger.info(f"AI governor stats: {ai_governor.stats}")
+    logger.info("Single-flight stats: " + ", ".join(f"{sf.name}={sf.stats}" for sf in single_flights))
+    logger.info(f"AI cache stats: {ai_cache.stats}, size {len(ai_cache)}")
+    logger.info(f"User cache stats: {user_cache.stats}, size {len(user_cache)}")
+    await market_hub.close()
+    await fiat_rates.close()
+    candle_store.flush()
+    await price_source.close()
+    await storage.close()
+    await metrics.close()
+    await bot.session.close()
 
-            await asyncio.sleep(1.0)
+async def run_webhook_worker(worker_id: int):
+    await start_services(worker_id)
+    shared = SHARED_WORKERS
+    if shared:
+        # Соседний воркер мог поменять настройки юзера — долго кэшу не доверяем
+        user_cache.ttl = USER_CACHE_SHARED_TTL
 
-        await asyncio.sleep(ALERT_CHECK_DELAY)
+    app = web.Application()
+    SimpleRequestHandler(
+        dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET or None
+    ).register(app, path=WEBHOOK_PATH)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, WEB_HOST, WEB_PORT, reuse_port=shared).start()
 
-    await exchange.close()
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    tasks = [asyncio.create_task(leader_loop())]
+    if shared:
+        tasks.append(asyncio.create_task(shared_resync_loop()))
+    logger.info(f"Webhook worker {worker_id} (pid {os.getpid()}) listening on {WEB_HOST}:{WEB_PORT}{WEBHOOK_PATH}")
+    try:
+        await stop.wait()
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await runner.cleanup()
+        await stop_services()
+
+def _webhook_worker_entry(worker_id: int):
+    asyncio.run(run_webhook_worker(worker_id))
+
+async def set_webhook():
+    try:
+        await bot.set_webhook(
+            WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET or None,
+            drop_pending_updates=True,
+        )
+        logger.info(f"Webhook set to {WEBHOOK_URL}{WEBHOOK_PATH}")
+    finally:
+        await bot.session.close()
+
+def run_webhook():
+    """N процессов на одном порту (SO_REUSEPORT), ядро раскидывает соединения между ними."""
+    if WEBHOOK_URL:
+        asyncio.run(set_webhook())
+    if WEB_WORKERS <= 1:
+        _webhook_worker_entry(0)
+        return
+    ctx = multiprocessing.get_context("spawn")
+    procs = [
+        ctx.Process(target=_webhook_worker_entry, args=(i,), name=f"webhook-worker-{i}")
+        for i in range(WEB_WORKERS)
+    ]
+    for p in procs:
+        p.start()
+    try:
+        for p in procs:
+            p.join()
+    except KeyboardInterrupt:
+        # SIGINT получила вся группа процессов, воркеры завершаются сами
+        for p in procs:
+            p.join(timeout=10)
+            if p.is_alive():
+                p.terminate()
+
+mark_startup("import")
 
 # ==============================================================================
 # ENTRY POINT
 # ==============================================================================
 
 async def main():
-    init_db()
+    await start_services()
     await bot.delete_webhook(drop_pending_updates=True)
-    asyncio.create_task(background_monitor())
+    leader_task = asyncio.create_task(leader_loop())
 
     try:
         logger.info("Bot started polling...")
         await dp.start_polling(bot)
     finally:
-        await bot.session.close()
+        leader_task.cancel()
+        await asyncio.gather(leader_task, return_exceptions=True)
+        await stop_services()
 
 if __name__ == "__main__":
     try:
-        asyncio.run(main())
+        if BOT_MODE == "webhook":
+            run_webhook()
+        else:
+            asyncio.run(main())
     except KeyboardInterrupt:
         logger.info("Bot stopped.")
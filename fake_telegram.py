@@ -0,0 +1,256 @@
+"""
+Локальный фейковый Telegram для нагрузочных прогонов бота без сети.
+
+  * FakeTelegramServer — отвечает на вызовы Bot API (sendMessage, editMessageText, ...)
+    с настраиваемой задержкой и долей ошибок 429. Бот направляется на него через
+    TELEGRAM_API_URL=http://127.0.0.1:8081
+  * UpdateGenerator — шлёт апдейты (команды, кнопки меню, callback'и) на вебхук бота
+    с заданной частотой, как это делал бы сам Telegram.
+
+Пример: бот в режиме вебхука на 4 воркерах и 200 апдейтов в секунду:
+
+    BOT_MODE=webhook WEB_WORKERS=4 TELEGRAM_API_URL=http://127.0.0.1:8081 python bot.py
+    python fake_telegram.py --api-port 8081 --webhook http://127.0.0.1:8080/webhook --rate 200
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import random
+import time
+from typing import Any, Dict, List, Optional
+
+import aiohttp
+from aiohttp import web
+
+COINS = ["BTC/USDT", "ETH/USDT", "TON/USDT", "SOL/USDT", "DOGE/USDT", "XRP/USDT"]
+
+# Доли типов апдейтов в генерируемом трафике
+TRAFFIC_MIX = {
+    "start": 0.05,
+    "menu_ai": 0.15,
+    "menu_stats": 0.10,
+    "menu_subs": 0.05,
+    "menu_settings": 0.05,
+    "cb_ai": 0.30,
+    "cb_stats": 0.15,
+    "cb_sub": 0.05,
+    "cb_settings": 0.05,
+    "convert": 0.05,
+}
+
+MENU_TEXTS = {
+    "start": "/start",
+    "menu_ai": "🧠 AI Прогноз",
+    "menu_stats": "📊 Статистика",
+    "menu_subs": "🔔 Подписки",
+    "menu_settings": "⚙️ Настройки",
+}
+
+# ==============================================================================
+# FAKE BOT API SERVER
+# ==============================================================================
+
+class FakeTelegramServer:
+    """Минимальный Bot API: на всё отвечает успехом, сообщения получают растущие id."""
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 8081,
+                 latency: float = 0.03, error_rate: float = 0.0):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.error_rate = error_rate
+        self.calls: Dict[str, int] = {}
+        self.errors = 0
+        self._message_ids = itertools.count(1000)
+        self._runner: Optional[web.AppRunner] = None
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_route("*", "/bot{token}/{method}", self._handle)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+
+    async def close(self):
+        if self._runner:
+            await self._runner.cleanup()
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        self.calls[method] = self.calls.get(method, 0) + 1
+        if request.content_type == "application/json":
+            params = await request.json()
+        else:
+            params = dict(await request.post())
+        if self.latency:
+            await asyncio.sleep(random.uniform(0.5, 1.5) * self.latency)
+
+        if self.error_rate and method in ("sendMessage", "editMessageText") and random.random() < self.error_rate:
+            self.errors += 1
+            return web.json_response({
+                "ok": False, "error_code": 429,
+                "description": "Too Many Requests: retry after 1",
+                "parameters": {"retry_after": 1},
+            })
+        return web.json_response({"ok": True, "result": self._result(method, params)})
+
+    def _result(self, method: str, params: Dict[str, Any]) -> Any:
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "FakeBot", "username": "fake_bot"}
+        if method in ("sendMessage", "editMessageText", "editMessageReplyMarkup"):
+            chat_id = int(params.get("chat_id", 0) or 0)
+            message_id = int(params.get("message_id", 0) or 0) or next(self._message_ids)
+            return {
+                "message_id": message_id,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "text": params.get("text", ""),
+            }
+        return True
+
+# ==============================================================================
+# UPDATE GENERATOR
+# ==============================================================================
+
+class UpdateGenerator:
+    """Собирает апдейты в формате Bot API из смеси TRAFFIC_MIX."""
+
+    def __init__(self, users: int = 1000, seed: Optional[int] = None):
+        self.users = users
+        self._rnd = random.Random(seed)
+        self._update_ids = itertools.count(1)
+        self._kinds = list(TRAFFIC_MIX)
+        self._weights = [TRAFFIC_MIX[k] for k in self._kinds]
+
+    def _user(self, user_id: int) -> Dict[str, Any]:
+        return {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"}
+
+    def _message(self, user_id: int, text: str) -> Dict[str, Any]:
+        return {
+            "message_id": self._rnd.randint(1, 10**6),
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": self._user(user_id),
+            "text": text,
+        }
+
+    def message(self, user_id: int, text: str) -> Dict[str, Any]:
+        return {"update_id": next(self._update_ids), "message": self._message(user_id, text)}
+
+    def callback(self, user_id: int, data: str) -> Dict[str, Any]:
+        return {
+            "update_id": next(self._update_ids),
+            "callback_query": {
+                "id": str(self._rnd.randint(1, 10**12)),
+                "from": self._user(user_id),
+                "chat_instance": str(user_id),
+                "message": self._message(user_id, "…"),
+                "data": data,
+            },
+        }
+
+    def next(self) -> Dict[str, Any]:
+        kind = self._rnd.choices(self._kinds, self._weights)[0]
+        user_id = self._rnd.randint(1, self.users)
+        coin = self._rnd.choice(COINS)
+        if kind in MENU_TEXTS:
+            return self.message(user_id, MENU_TEXTS[kind])
+        if kind == "convert":
+            return self.message(user_id, f"{self._rnd.randint(1, 500)} {coin.split('/')[0]}")
+        if kind == "cb_ai":
+            return self.callback(user_id, f"ai_{coin}_0")
+        if kind == "cb_stats":
+            return self.callback(user_id, f"st_{coin}_0")
+        if kind == "cb_sub":
+            return self.callback(user_id, f"sub_{coin}_0")
+        return self.callback(user_id, self._rnd.choice(
+            ["set_curr_USD", "set_curr_RUB", "set_curr_EUR", "cycle_alert", "toggle_mode"]
+        ))
+
+async def drive_webhook(webhook_url: str, rate: float, duration: float, users: int,
+                        secret: str = "", seed: Optional[int] = None) -> Dict[str, Any]:
+    """Шлёт апдейты на вебхук с постоянной частотой и меряет время ответа."""
+    gen = UpdateGenerator(users, seed)
+    headers = {"X-Telegram-Bot-Api-Secret-Token": secret} if secret else {}
+    latencies: List[float] = []
+    failures = 0
+
+    async def _post(session: aiohttp.ClientSession, update: Dict[str, Any]):
+        nonlocal failures
+        started = time.perf_counter()
+        try:
+            async with session.post(webhook_url, data=json.dumps(update), headers={
+                **headers, "Content-Type": "application/json",
+            }) as resp:
+                await resp.read()
+                if resp.status != 200:
+                    failures += 1
+        except aiohttp.ClientError:
+            failures += 1
+        latencies.append(time.perf_counter() - started)
+
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=256)) as session:
+        pending = set()
+        interval = 1.0 / rate
+        started = time.perf_counter()
+        sent = 0
+        while time.perf_counter() - started < duration:
+            pending.add(asyncio.create_task(_post(session, gen.next())))
+            pending = {t for t in pending if not t.done()}
+            sent += 1
+            # Держим заданную частоту, а не «как можно быстрее»
+            delay = started + sent * interval - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        if pending:
+            await asyncio.gather(*pending)
+
+    latencies.sort()
+
+    def _pct(p: float) -> float:
+        return round(latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000, 2) if latencies else 0.0
+
+    return {
+        "sent": sent,
+        "failures": failures,
+        "p50_ms": _pct(0.50),
+        "p95_ms": _pct(0.95),
+        "p99_ms": _pct(0.99),
+    }
+
+async def _main(args: argparse.Namespace):
+    server = FakeTelegramServer(port=args.api_port, latency=args.api_latency, error_rate=args.api_error_rate)
+    await server.start()
+    print(f"Fake Bot API on {server.url}")
+    try:
+        if args.webhook:
+            result = await drive_webhook(args.webhook, args.rate, args.duration, args.users, args.secret, args.seed)
+            result["api_calls"] = server.calls
+            result["api_errors"] = server.errors
+            print(json.dumps(result, ensure_ascii=False, indent=2))
+        else:
+            await asyncio.Event().wait()
+    finally:
+        await server.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Фейковый Telegram: Bot API сервер и генератор апдейтов")
+    parser.add_argument("--api-port", type=int, default=8081)
+    parser.add_argument("--api-latency", type=float, default=0.03, help="задержка ответа Bot API, сек")
+    parser.add_argument("--api-error-rate", type=float, default=0.0, help="доля ответов 429")
+    parser.add_argument("--webhook", default="", help="URL вебхука бота; пусто — только сервер")
+    parser.add_argument("--secret", default="", help="WEBHOOK_SECRET бота")
+    parser.add_argument("--rate", type=float, default=50, help="апдейтов в секунду")
+    parser.add_argument("--duration", type=float, default=10, help="длительность прогона, сек")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=None)
+    try:
+        asyncio.run(_main(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,22 @@
+"""
+Общая настройка тестов: bot.py читает конфиг из окружения при импорте,
+поэтому всё выставляем до него. Сеть не нужна — база и файлы во временной папке.
+"""
+
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+_workdir = tempfile.mkdtemp(prefix="bot-tests-")
+os.environ.update({
+    "BOT_TOKEN": "123456:TEST",
+    "DB_FILE": os.path.join(_workdir, "test.db"),
+    "FIAT_RATES_FILE": os.path.join(_workdir, "fiat_rates.json"),
+    "WARM_STATE_FILE": os.path.join(_workdir, "warm_state.json"),
+    "EXCHANGE_FALLBACKS": "",
+    "GEMINI_FAKE": "1",
+    "GEMINI_FAKE_LATENCY": "0.05",
+})
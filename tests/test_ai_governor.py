@@ -0,0 +1,140 @@
+"""Ограничитель Gemini на локальной заглушке: семафор, бюджет ожидания, пауза по квоте, батчи."""
+
+import asyncio
+
+import pytest
+
+import bot
+
+class CountingModel(bot.FakeGeminiModel):
+    """Заглушка, которая помнит промпты и пик одновременных вызовов."""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.active = 0
+        self.peak = 0
+        self.prompts = []
+
+    async def generate_content_async(self, prompt: str, **kwargs):
+        self.prompts.append(prompt)
+        self.active += 1
+        self.peak = max(self.peak, self.active)
+        try:
+            return await super().generate_content_async(prompt, **kwargs)
+        finally:
+            self.active -= 1
+
+@pytest.fixture
+def model(monkeypatch):
+    def install(**kwargs):
+        fake = CountingModel(**{"latency": 0.05, "error_rate": 0.0, **kwargs})
+        monkeypatch.setattr(bot, "gemini_model", fake)
+        return fake
+
+    return install
+
+def analysis(coin: str) -> dict:
+    return {"coin": coin, "price": 100.0, "rsi": 50.0, "change_pct": 1.0, "volume": 1e6, "dist_from_high": -2.0}
+
+def test_semaphore_caps_parallel_calls(model):
+    fake = model()
+
+    async def scenario():
+        governor = bot.AIGovernor(concurrency=2)
+        texts = await asyncio.gather(*(governor.generate(bot.build_ai_prompt(analysis(f"C{i}/USDT"))) for i in range(6)))
+        return governor, texts
+
+    governor, texts = asyncio.run(scenario())
+    assert all(texts)
+    assert fake.calls == 6 and fake.peak == 2
+    assert governor.stats["calls"] == 6
+
+def test_latency_budget_falls_back_and_delivers_late(model, monkeypatch):
+    fake = model(latency=0.4)
+    monkeypatch.setattr(bot, "GEMINI_LATENCY_BUDGET", 0.05)
+
+    async def scenario():
+        governor = bot.AIGovernor()
+        late = asyncio.get_running_loop().create_future()
+        prompt = bot.build_ai_prompt(analysis("BTC/USDT"))
+        first, second = await asyncio.gather(
+            governor.within_budget("BTC/USDT", prompt, late.set_result),
+            governor.within_budget("BTC/USDT", prompt, lambda text: None),
+        )
+        return governor, first, second, await asyncio.wait_for(late, 5)
+
+    governor, first, second, late_text = asyncio.run(scenario())
+    assert first == (False, None) and second == (False, None)
+    # Второй запрос по той же монете присоединился к уже идущему вызову
+    assert fake.calls == 1
+    assert late_text.startswith("🤖 BTC/USDT")
+    assert governor.stats["late"] == 2
+    assert "BTC/USDT" in governor.demand
+
+def test_timeout_is_counted(model, monkeypatch):
+    model(latency=1.0)
+    monkeypatch.setattr(bot, "GEMINI_TIMEOUT", 0.05)
+
+    async def scenario():
+        governor = bot.AIGovernor()
+        return governor, await governor.generate("Монета: BTC/USDT")
+
+    governor, text = asyncio.run(scenario())
+    assert text is None
+    assert governor.stats["timeouts"] == 1
+
+def test_quota_errors_pause_ai_with_growing_backoff(model):
+    fake = model(error_rate=1.0)
+
+    async def scenario():
+        governor = bot.AIGovernor()
+        assert await governor.generate("Монета: BTC/USDT") is None
+        assert not governor.available()
+        first_backoff = governor._backoff
+        # Пока пауза не истекла, Gemini не трогаем
+        assert await governor.generate("Монета: BTC/USDT") is None
+        assert fake.calls == 1
+        governor._blocked_until = 0.0
+        assert await governor.generate("Монета: BTC/USDT") is None
+        second_backoff = governor._backoff
+        # Удачный вызов сбрасывает паузу
+        fake.error_rate = 0.0
+        governor._blocked_until = 0.0
+        assert await governor.generate("Монета: BTC/USDT")
+        return governor, first_backoff, second_backoff
+
+    governor, first_backoff, second_backoff = asyncio.run(scenario())
+    assert first_backoff == bot.GEMINI_BACKOFF_MIN
+    assert second_backoff == 2 * bot.GEMINI_BACKOFF_MIN
+    assert governor._backoff == 0.0
+    assert governor.stats["quota_backoffs"] == 2 and governor.stats["skipped"] == 1
+
+def test_batch_prompt_is_split_per_coin(model):
+    fake = model()
+    coins = ["BTC/USDT", "ETH/USDT", "SOL/USDT"]
+
+    async def scenario():
+        governor = bot.AIGovernor()
+        return await governor.analyse_batch([analysis(c) for c in coins])
+
+    texts = asyncio.run(scenario())
+    assert fake.calls == 1 and bot.GEMINI_BATCH_MARKER in fake.prompts[0]
+    assert sorted(texts) == coins
+    assert all(texts[c].startswith(f"🤖 {c}") for c in coins)
+
+def test_batch_reply_in_code_fence_or_broken(model, monkeypatch):
+    model()
+    replies = iter(['```json\n{"BTC/USDT": "вверх", "XRP/USDT": "лишнее"}\n```', "не JSON"])
+
+    async def generate(self, prompt):
+        return next(replies)
+
+    monkeypatch.setattr(bot.AIGovernor, "generate", generate)
+
+    async def scenario():
+        governor = bot.AIGovernor()
+        return [await governor.analyse_batch([analysis("BTC/USDT")]) for _ in range(2)]
+
+    fenced, broken = asyncio.run(scenario())
+    assert fenced == {"BTC/USDT": "вверх"}
+    assert broken == {}
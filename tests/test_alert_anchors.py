@@ -0,0 +1,65 @@
+"""Движок личных якорей: книга монеты, пороги и сверка индекса с БД."""
+
+import numpy as np
+import pytest
+
+import bot
+
+@pytest.fixture
+def anchor_writes(monkeypatch):
+    writes = []
+    monkeypatch.setattr(bot.storage, "write_many", lambda sql, rows: writes.extend(rows))
+    return writes
+
+def test_coin_book_swap_remove_keeps_positions():
+    book = bot.CoinBook(capacity=2)
+    for uid in range(1, 6):
+        book.add(uid, float(uid), anchor=100.0 + uid)
+    book.remove(2)
+    book.remove(5)
+    assert book.size == 3
+    for uid in (1, 3, 4):
+        i = book.pos[uid]
+        assert book.user_ids[i] == uid
+        assert book.thresholds[i] == uid
+        assert book.anchors[i] == 100.0 + uid
+
+def test_personal_anchors(anchor_writes):
+    index = bot.SubscriptionIndex()
+    index.add(1, "BTC/USDT", "USD", 1.0)
+    index.add(2, "BTC/USDT", "RUB", 5.0)
+
+    # Первая цена только выставляет якоря
+    assert index.evaluate("BTC/USDT", 100.0) == []
+    assert sorted(row[0] for row in anchor_writes) == [1, 2]
+
+    # +2%: сработал только 1%-юзер, его якорь переставлен, у 5%-юзера — нет
+    hits = index.evaluate("BTC/USDT", 102.0)
+    assert [(h["user_id"], h["currency"], h["anchor"]) for h in hits] == [(1, "USD", 100.0)]
+    assert hits[0]["change_pct"] == pytest.approx(2.0)
+
+    # Ещё +4% от исходной цены: 5%-юзер считает от своих 100, а не от 102
+    hits = index.evaluate("BTC/USDT", 106.0)
+    assert sorted(h["user_id"] for h in hits) == [1, 2]
+    assert {h["user_id"]: h["anchor"] for h in hits} == {1: 102.0, 2: 100.0}
+
+def test_threshold_change_and_unsubscribe(anchor_writes):
+    index = bot.SubscriptionIndex()
+    index.add(1, "ETH/USDT", "USD", 5.0, anchor=100.0)
+    assert index.evaluate("ETH/USDT", 103.0) == []
+    index.update_user(1, "alert_percent", 1.0)
+    assert [h["user_id"] for h in index.evaluate("ETH/USDT", 103.0)] == [1]
+    index.remove(1, "ETH/USDT")
+    assert index.count("ETH/USDT") == 0
+    assert index.profile(1) is None
+    assert index.evaluate("ETH/USDT", 200.0) == []
+
+def test_sync_user_reconciles_with_database(anchor_writes):
+    index = bot.SubscriptionIndex()
+    user = {"user_id": 7, "currency": "USD", "alert_percent": 3.0, "alert_digest": 0}
+    index.add(7, "BTC/USDT", "USD", 3.0)
+    index.sync_user(user, {"ETH/USDT": 50.0, "SOL/USDT": None})
+    assert index.coins(7) == {"ETH/USDT", "SOL/USDT"}
+    book = index._books["ETH/USDT"]
+    assert book.anchors[book.pos[7]] == 50.0
+    assert np.isnan(index._books["SOL/USDT"].anchors[0])
@@ -0,0 +1,85 @@
+"""Очередь доставки алертов: вытеснение устаревших и переполнение."""
+
+import asyncio
+
+import bot
+
+def test_delivery_sends_only_latest_alert_per_user_and_coin(monkeypatch):
+    sent = []
+
+    async def send_message(chat_id, text, **kwargs):
+        sent.append((chat_id, text))
+
+    monkeypatch.setattr(bot.bot, "send_message", send_message)
+
+    async def scenario():
+        delivery = bot.AlertDelivery(workers=2)
+        delivery.submit(1, "BTC/USDT", "old")
+        delivery.submit(1, "BTC/USDT", "new")
+        delivery.submit(2, "BTC/USDT", "other user")
+        delivery.start()
+        await asyncio.wait_for(delivery._queue.join(), 5)
+        await delivery.stop()
+        return delivery
+
+    delivery = asyncio.run(scenario())
+    assert sorted(sent) == [(1, "new"), (2, "other user")]
+    assert delivery.stats["sent"] == 2
+    assert delivery.stats["superseded"] == 1
+    assert delivery._latest == {}
+
+def test_full_queue_keeps_the_queued_alert():
+    async def scenario():
+        delivery = bot.AlertDelivery(workers=0, maxsize=1)
+        assert delivery.submit(1, "BTC/USDT", "queued")
+        assert not delivery.submit(1, "BTC/USDT", "rejected")
+        _, seq, alert = delivery._queue.get_nowait()
+        return delivery, seq, alert
+
+    delivery, seq, alert = asyncio.run(scenario())
+    assert alert["text"] == "queued"
+    assert delivery._is_current(seq, alert)
+    assert delivery.stats["dropped"] == 1
+
+def test_stop_drains_queue_before_cancelling_workers(monkeypatch):
+    sent = []
+
+    async def send_message(chat_id, text, **kwargs):
+        await asyncio.sleep(0.01)
+        sent.append(chat_id)
+
+    monkeypatch.setattr(bot.bot, "send_message", send_message)
+    # Второй алерт тому же чату ждёт паузу чата в таймере, а не в очереди
+    monkeypatch.setattr(bot, "TELEGRAM_CHAT_INTERVAL", 0.2)
+
+    async def scenario():
+        delivery = bot.AlertDelivery(workers=2)
+        delivery.start()
+        for uid in range(10):
+            delivery.submit(uid, "BTC/USDT", "alert")
+        delivery.submit(0, "ETH/USDT", "alert")
+        await delivery.stop(drain=5)
+        return delivery
+
+    delivery = asyncio.run(scenario())
+    assert sorted(sent) == [0] + list(range(10))
+    assert delivery.stats["sent"] == 11
+
+def test_stop_gives_up_after_drain_deadline(monkeypatch):
+    async def send_message(chat_id, text, **kwargs):
+        await asyncio.sleep(10)
+
+    monkeypatch.setattr(bot.bot, "send_message", send_message)
+
+    async def scenario():
+        delivery = bot.AlertDelivery(workers=1)
+        delivery.start()
+        delivery.submit(1, "BTC/USDT", "stuck")
+        delivery.submit(2, "BTC/USDT", "waiting")
+        started = asyncio.get_running_loop().time()
+        await delivery.stop(drain=0.2)
+        return delivery, asyncio.get_running_loop().time() - started
+
+    delivery, elapsed = asyncio.run(scenario())
+    assert elapsed < 1
+    assert delivery.stats["sent"] == 0
@@ -0,0 +1,72 @@
+"""Режим сводки: сворачивание алертов пользователя в одно сообщение."""
+
+import asyncio
+
+import pytest
+
+import bot
+
+@pytest.fixture
+def rates(monkeypatch):
+    async def _rates():
+        return {"USD": 1.0, "RUB": 100.0}
+
+    monkeypatch.setattr(bot, "get_fiat_rates", _rates)
+
+def test_digest_folds_alerts_into_one_message(rates):
+    digest = bot.AlertDigest(window=60)
+    sent = []
+    submit = lambda user_id, key, text: sent.append((user_id, key, text)) or True
+    user = {"user_id": 1, "currency": "USD", "anchor": 100.0}
+    digest.add(user, "BTC/USDT", 103.0, submit)
+    digest.add({**user, "anchor": 10.0}, "ETH/USDT", 9.0, submit)
+    # Повтор монеты внутри окна не добавляет строку и считает от первого якоря
+    digest.add({**user, "anchor": 103.0}, "BTC/USDT", 104.0, submit)
+
+    assert asyncio.run(digest.flush_due()) == 0  # окно ещё не истекло
+    assert asyncio.run(digest.flush_due(force=True)) == 1
+    (user_id, key, text), = sent
+    assert user_id == 1 and key.startswith("digest:")
+    lines = text.splitlines()
+    assert lines[0] == "📬 Сводка движений (2)"
+    # По убыванию силы движения: -10% раньше +4%
+    assert lines[1].startswith("🔻 ETH/USDT -10.00%")
+    assert lines[2].startswith("🚀 BTC/USDT +4.00%")
+    assert digest.stats == {"alerts": 3, "digests": 1, "saved": 2}
+    assert len(digest) == 0
+
+def test_leader_shutdown_sends_pending_digests(rates, monkeypatch):
+    sent = []
+
+    async def send_message(chat_id, text, **kwargs):
+        sent.append((chat_id, text))
+
+    async def idle():
+        await asyncio.Event().wait()
+
+    async def noop():
+        pass
+
+    monkeypatch.setattr(bot.bot, "send_message", send_message)
+    monkeypatch.setattr(bot.leader_lock, "try_acquire", lambda: True)
+    monkeypatch.setattr(bot.leader_lock, "release", lambda: None)
+    monkeypatch.setattr(bot.coin_universe, "run", idle)
+    monkeypatch.setattr(bot.warm_state, "run", idle)
+    monkeypatch.setattr(bot.warm_state, "save", noop)
+    monkeypatch.setattr(bot, "background_monitor", idle)
+    monkeypatch.setattr(bot, "alert_digest", bot.AlertDigest(window=600))
+    monkeypatch.setattr(bot, "alert_delivery", bot.AlertDelivery(workers=1))
+
+    async def scenario():
+        leader = asyncio.create_task(bot.leader_loop())
+        await asyncio.sleep(0.05)
+        user = {"user_id": 5, "currency": "USD", "anchor": 100.0}
+        bot.alert_digest.add(user, "BTC/USDT", 103.0, bot.alert_delivery.submit)
+        # Окно сводки ещё далеко, а процесс уже останавливают
+        leader.cancel()
+        await asyncio.gather(leader, return_exceptions=True)
+
+    asyncio.run(scenario())
+    # Единственный алерт сводки уходит обычным сообщением
+    (chat_id, text), = sent
+    assert chat_id == 5 and "BTC/USDT" in text
@@ -0,0 +1,52 @@
+"""Конвертер: ответ на запросы с активами и опечатками, молчание на обычные фразы."""
+
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import bot
+
+@pytest.fixture
+def converter(monkeypatch):
+    monkeypatch.setattr(bot.symbol_index, "_bases", {"BTC", "ETH", "DOGE", "TON"})
+    monkeypatch.setattr(bot.symbol_index, "_ensure", lambda: None)
+    monkeypatch.setattr(bot.SymbolIndex, "loaded", property(lambda self: True))
+
+    async def price_assets(pairs):
+        return {p: {"BTC/USDT": 50_000.0, "DOGE/USDT": 0.1}.get(p, 1.0) for p in pairs}
+
+    async def rates():
+        return {"USD": 1.0, "RUB": 100.0}
+
+    monkeypatch.setattr(bot, "price_assets", price_assets)
+    monkeypatch.setattr(bot, "get_fiat_rates", rates)
+
+    def ask(text: str):
+        replies = []
+
+        async def answer(reply, **kwargs):
+            replies.append(reply)
+
+        assert bot.CONVERTER_RE.match(text)
+        asyncio.run(bot.converter_handler(SimpleNamespace(text=text, answer=answer)))
+        return replies
+
+    return ask
+
+def test_plain_phrase_gets_no_reply(converter):
+    assert converter("5 минут") == []
+    assert converter("2 kids") == []
+
+def test_typo_in_ticker_gets_a_hint(converter):
+    assert converter("100 BTCC") == ["⚠️ Не нашёл BTCC (может, BTC?)"]
+    assert converter("100 btcc") == ["⚠️ Не нашёл BTCC (может, BTC?)"]
+    # Без подсказки, но явно тикер
+    assert converter("5 XYZQ") == ["⚠️ Не нашёл XYZQ"]
+
+def test_known_assets_are_converted(converter):
+    reply, = converter("1,000 DOGE, 0,5 BTC, 100 BTCC")
+    assert "1000 DOGE ≈ 100.00 USD" in reply
+    assert "0.5 BTC ≈ 25 000.00 USD" in reply
+    assert "≈ 2 510 000.00 RUB" in reply
+    assert reply.endswith("⚠️ Не нашёл на бирже: BTCC (может, BTC?)")
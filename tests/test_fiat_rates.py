@@ -0,0 +1,33 @@
+"""Файл курсов фиата: одновременные сохранения из нескольких процессов не мешают друг другу."""
+
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import bot
+
+def test_concurrent_saves_leave_a_valid_file(tmp_path):
+    path = str(tmp_path / "fiat_rates.json")
+    services = []
+    for i in range(8):
+        service = bot.FiatRateService("http://fake", 60, path)
+        service.rates.update({"RUB": 90.0 + i})
+        service.ts = 1000.0 + i
+        services.append(service)
+
+    def save_many(service):
+        for _ in range(50):
+            service._save()
+
+    with ThreadPoolExecutor(len(services)) as pool:
+        list(pool.map(save_many, services))
+
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+    assert data["rates"]["RUB"] == 90.0 + (data["ts"] - 1000.0)
+    # Временные файлы не остаются в папке
+    assert os.listdir(tmp_path) == ["fiat_rates.json"]
+
+    loaded = bot.FiatRateService("http://fake", 60, path)
+    loaded.load()
+    assert loaded.ts == data["ts"]
@@ -0,0 +1,38 @@
+"""Консистентное кольцо сканеров-партиций."""
+
+from collections import Counter
+
+import bot
+
+KEYS = [f"COIN{i}/USDT" for i in range(2000)]
+
+def test_empty_ring_has_no_owner():
+    assert bot.HashRing([]).owner("BTC/USDT") is None
+
+def test_owner_is_deterministic_and_order_independent():
+    a = bot.HashRing(["0:100", "1:101", "2:102"])
+    b = bot.HashRing(["2:102", "0:100", "1:101"])
+    assert all(a.owner(k) == b.owner(k) for k in KEYS)
+
+def test_keys_are_spread_evenly():
+    nodes = [f"{i}:{1000 + i}" for i in range(4)]
+    counts = Counter(bot.HashRing(nodes).owner(k) for k in KEYS)
+    assert set(counts) == set(nodes)
+    assert max(counts.values()) < 2 * min(counts.values())
+
+def test_joining_node_takes_only_its_share():
+    nodes = [f"{i}:{1000 + i}" for i in range(4)]
+    before = bot.HashRing(nodes)
+    after = bot.HashRing(nodes + ["4:1004"])
+    moved = [k for k in KEYS if before.owner(k) != after.owner(k)]
+    # Переезжают только монеты нового узла, примерно 1/5 от всех
+    assert all(after.owner(k) == "4:1004" for k in moved)
+    assert 0.1 < len(moved) / len(KEYS) < 0.3
+
+def test_leaving_node_hands_over_only_its_keys():
+    nodes = [f"{i}:{1000 + i}" for i in range(4)]
+    before = bot.HashRing(nodes)
+    after = bot.HashRing(nodes[1:])
+    for k in KEYS:
+        if before.owner(k) != nodes[0]:
+            assert after.owner(k) == before.owner(k)
@@ -0,0 +1,116 @@
+"""Скользящие индикаторы должны совпадать с эталонными calc_rsi / calc_sma до бита."""
+
+import asyncio
+import random
+
+import numpy as np
+import pytest
+
+import bot
+
+def random_series(rnd: random.Random, n: int):
+    price = rnd.uniform(0.001, 50_000)
+    series = []
+    for _ in range(n):
+        # Бывают и плоские участки: avg_loss == 0 — отдельная ветка
+        price *= 1 + (rnd.gauss(0, 0.02) if rnd.random() > 0.1 else 0.0)
+        series.append(price)
+    return series
+
+@pytest.fixture
+def series_set():
+    rnd = random.Random(20240601)
+    return [random_series(rnd, rnd.randint(1, 120)) for _ in range(200)]
+
+def test_incremental_rsi_and_sma_match_reference(series_set):
+    for series in series_set:
+        rsi, sma = bot.WilderRSI(), bot.SMA()
+        for i, close in enumerate(series):
+            # peek — как если бы close был следующей свечой, состояние не меняется
+            assert rsi.peek(close) == bot.calc_rsi(series[:i] + [close])
+            assert sma.peek(close) == bot.calc_sma(series[:i] + [close])
+            rsi.update(close)
+            sma.update(close)
+            assert rsi.value() == bot.calc_rsi(series[:i + 1])
+            assert sma.value() == bot.calc_sma(series[:i + 1])
+
+def test_batch_matches_reference(series_set):
+    for n in (10, 15, 20, 50, 120):
+        rows = [s[:n] for s in series_set if len(s) >= n]
+        if not rows:
+            continue
+        matrix = np.array(rows)
+        for row, value in zip(rows, bot.WilderRSI().batch(matrix)):
+            expected = bot.calc_rsi(row)
+            assert (np.isnan(value) and expected is None) or value == expected
+        for row, value in zip(rows, bot.SMA().batch(matrix)):
+            expected = bot.calc_sma(row)
+            assert (np.isnan(value) and expected is None) or value == expected
+
+def candles_from(series, start_ts: int = 0, step: int = 3_600_000):
+    return [[start_ts + i * step, c, c, c, c, 1.0] for i, c in enumerate(series)]
+
+def test_engine_observe_matches_full_recompute():
+    rnd = random.Random(7)
+    series = random_series(rnd, 200)
+    candles = candles_from(series)
+    engine = bot.IndicatorEngine()
+    # История растёт по одной свече, последняя — текущая незакрытая; observe помнит всю историю
+    for end in range(50, len(candles) + 1):
+        values = engine.observe("BTC/USDT", "1h", candles[:end])
+        closes = series[:end]
+        assert values["rsi"] == bot.calc_rsi(closes)
+        assert values["sma"] == bot.calc_sma(closes)
+
+def test_forecast_and_snapshot_use_the_same_window(monkeypatch):
+    rnd = random.Random(5)
+    series = random_series(rnd, 200)
+    candles = candles_from(series)
+    window = {}
+
+    async def get_candles(coin, timeframe, limit):
+        return [list(c) for c in window["candles"][-limit:]]
+
+    async def get_ticker(coin):
+        return window["ticker"]
+
+    monkeypatch.setattr(bot.candle_store, "get", get_candles)
+    monkeypatch.setattr(bot.market_hub, "get_ticker", get_ticker)
+    monkeypatch.setattr(bot.snapshot_scheduler, "snapshots", {})
+    monkeypatch.setattr(bot, "ai_cache", bot.AnalysisCache(bot.AI_CACHE_TTL, bot.AI_CACHE_STALE_TTL, 10))
+
+    async def scenario():
+        # Окно в ANALYSIS_CANDLES свечей сдвигается по одной, у текущей свечи — живая цена
+        for end in range(bot.ANALYSIS_CANDLES, len(candles) + 1):
+            live = series[end - 1] * 1.001
+            window["candles"] = candles[:end]
+            window["ticker"] = {"last": live}
+            expected = bot.calc_rsi(series[end - bot.ANALYSIS_CANDLES:end - 1] + [live])
+
+            analysis = await bot.build_analysis("BTC/USDT", with_ai=False)
+            assert analysis["rsi"] == expected
+
+            await bot.snapshot_scheduler.refresh({"BTC/USDT": window["ticker"]})
+            assert bot.snapshot_scheduler.snapshots["BTC/USDT"]["rsi"] == expected
+            bot.snapshot_scheduler.snapshots.clear()
+
+    asyncio.run(scenario())
+
+def test_engine_reseeds_after_gap():
+    rnd = random.Random(11)
+    series = random_series(rnd, 80)
+    candles = candles_from(series)
+    engine = bot.IndicatorEngine()
+    engine.observe("ETH/USDT", "1h", candles[:40])
+    # Пропали 10 свечей: состояние пересчитывается по присланному окну, а не склеивается с дырой
+    window = candles[50:80]
+    values = engine.observe("ETH/USDT", "1h", window)
+    assert values["rsi"] == bot.calc_rsi([c[4] for c in window])
+
+def test_compute_all_groups_by_length():
+    rnd = random.Random(3)
+    closes = {f"C{i}/USDT": random_series(rnd, rnd.choice((10, 30, 50))) for i in range(30)}
+    result = bot.indicator_engine.compute_all(closes)
+    for coin, series in closes.items():
+        assert result[coin]["rsi"] == bot.calc_rsi(series)
+        assert result[coin]["sma"] == bot.calc_sma(series)
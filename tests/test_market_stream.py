@@ -0,0 +1,104 @@
+"""MarketDataHub против локального WebSocket-сервера (FakeBinanceStream из benchmark.py)."""
+
+import asyncio
+import time
+
+import pytest
+
+import bot
+from benchmark import FakeBinanceStream, free_port
+
+COINS = ["BTC/USDT", "ETH/USDT"]
+
+async def wait_for(condition, timeout: float = 5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("condition not reached in time")
+        await asyncio.sleep(0.02)
+
+@pytest.fixture(autouse=True)
+def fast_stream(monkeypatch):
+    monkeypatch.setattr(bot, "MARKET_STREAM_STALE", 0.5)
+    monkeypatch.setattr(bot, "MARKET_STREAM_BACKOFF", (0.05, 0.2))
+
+def run_with_stream(scenario):
+    async def _main():
+        server = FakeBinanceStream({"BTC/USDT": 50_000.0, "ETH/USDT": 3_000.0, "SOL/USDT": 150.0},
+                                   free_port(), interval=0.05)
+        await server.start()
+        hub = bot.MarketDataHub(COINS, transport=bot.WebSocketTransport(server.url))
+        hub.start()
+        try:
+            await scenario(server, hub)
+        finally:
+            await hub.close()
+            await server.close()
+
+    asyncio.run(_main())
+
+def test_transport_is_abstract():
+    with pytest.raises(TypeError):
+        bot.StreamTransport()
+
+def test_stream_fills_tickers_and_candles():
+    # Поток пишет только в засеянный буфер: кладём прошлую часовую свечу
+    step = 3_600_000
+    hour = int(time.time() * 1000) // step * step
+    ring = bot.candle_store.ring("BTC/USDT", "1h")
+    ring.reset()
+    ring.upsert([hour - step, 1.0, 1.0, 1.0, 1.0, 1.0])
+
+    async def scenario(server, hub):
+        await wait_for(lambda: hub.is_live() and set(hub.tickers) == set(COINS))
+        assert server.subscriptions[0] == ["btcusdt@ticker", "btcusdt@kline_1h", "ethusdt@ticker", "ethusdt@kline_1h"]
+        assert hub.snapshot()["BTC/USDT"] == hub.tickers["BTC/USDT"]["last"]
+        await wait_for(lambda: ring.last_ts() == hour)
+        assert ring.tail(1)[0][4] == pytest.approx(server.prices["BTC/USDT"], rel=0.01)
+
+    run_with_stream(scenario)
+
+def test_reconnects_after_server_drop():
+    async def scenario(server, hub):
+        await wait_for(hub.is_live)
+        await server.drop()
+        await wait_for(lambda: not hub.connected)
+        await wait_for(lambda: server.connections == 2 and hub.is_live())
+        assert server.subscriptions[1] == server.subscriptions[0]
+
+    run_with_stream(scenario)
+
+def test_silent_stream_falls_back_to_rest_and_reconnects(monkeypatch):
+    rest_calls = []
+
+    async def rest_ticker(coin):
+        rest_calls.append(coin)
+        return {"symbol": coin, "last": 1.0, "source": "rest"}
+
+    monkeypatch.setattr(bot.price_source, "ticker", rest_ticker)
+
+    async def scenario(server, hub):
+        await wait_for(hub.is_live)
+        assert (await hub.get_ticker("BTC/USDT"))["source"] == bot.EXCHANGE_ID
+        server.paused = True
+        # Соединение открыто, но данных нет: через MARKET_STREAM_STALE поток не живой
+        await wait_for(lambda: not hub.is_live())
+        assert hub.snapshot() == {}
+        assert (await hub.get_ticker("BTC/USDT"))["source"] == "rest"
+        assert rest_calls == ["BTC/USDT"]
+        # Хаб сам бросает молчащее соединение и переподключается
+        await wait_for(lambda: server.connections >= 2)
+        server.paused = False
+        await wait_for(hub.is_live)
+
+    run_with_stream(scenario)
+
+def test_set_coins_resubscribes():
+    async def scenario(server, hub):
+        await wait_for(hub.is_live)
+        hub.set_coins(["BTC/USDT", "SOL/USDT"])
+        await wait_for(lambda: "SOL/USDT" in hub.tickers)
+        assert server.subscriptions[-1] == ["btcusdt@ticker", "btcusdt@kline_1h", "solusdt@ticker", "solusdt@kline_1h"]
+        assert "ETH/USDT" not in hub.tickers
+
+    run_with_stream(scenario)
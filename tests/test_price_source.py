@@ -0,0 +1,116 @@
+"""PriceSource против двух локальных бирж (FakeBinanceServer из benchmark.py): дубли, переход, автомат."""
+
+import asyncio
+
+import pytest
+
+import bot
+from benchmark import FakeBinanceServer, free_port
+
+COINS = ["BTC/USDT", "ETH/USDT"]
+
+@pytest.fixture(autouse=True)
+def fast_breaker(monkeypatch):
+    monkeypatch.setattr(bot, "EXCHANGE_BREAKER_FAILURES", 3)
+    monkeypatch.setattr(bot, "EXCHANGE_BREAKER_COOLDOWN", 0.3)
+
+def run_with_exchanges(scenario):
+    """Основная биржа (binance) и резервная (binanceus), у каждой свой фейковый сервер."""
+    async def _main():
+        primary = FakeBinanceServer(COINS, free_port(), latency=0.0, volatility=0.0)
+        fallback = FakeBinanceServer(COINS, free_port(), latency=0.0, volatility=0.0)
+        for server in (primary, fallback):
+            await server.start()
+        pools = [bot.ExchangePool("binance", api_url=primary.url), bot.ExchangePool("binanceus", api_url=fallback.url)]
+        for pool in pools:
+            await pool.start()
+        source = bot.PriceSource(pools)
+        try:
+            await scenario(source, primary, fallback)
+        finally:
+            await source.close()
+            for server in (primary, fallback):
+                await server.close()
+
+    asyncio.run(_main())
+
+def test_healthy_primary_answers_alone():
+    async def scenario(source, primary, fallback):
+        ticker = await source.ticker("BTC/USDT")
+        assert ticker["source"] == "binance" and not ticker["hedged"]
+        assert ticker["last"] == pytest.approx(primary.prices["BTC/USDT"])
+        assert "24hr" not in fallback.calls
+
+    run_with_exchanges(scenario)
+
+def test_error_fails_over_to_fallback():
+    async def scenario(source, primary, fallback):
+        primary.error_rate = 1.0
+        tickers = await source.tickers(COINS)
+        assert {t["source"] for t in tickers.values()} == {"binanceus"}
+        assert sorted(tickers) == COINS
+        assert source.stats["failovers"] == 1
+        assert source.pools[0].health.stats["errors"] == 1
+
+    run_with_exchanges(scenario)
+
+def test_slow_primary_is_hedged(monkeypatch):
+    monkeypatch.setattr(bot, "EXCHANGE_HEDGE_DEFAULT_DELAY", 0.1)
+    monkeypatch.setattr(bot, "EXCHANGE_HEDGE_DELAY", (0.05, 0.2))
+
+    async def scenario(source, primary, fallback):
+        primary.latency = 2.0  # заведомо дольше задержки перед дублем
+        ticker = await source.ticker("ETH/USDT")
+        assert ticker["source"] == "binanceus" and ticker["hedged"]
+        assert source.stats["hedged"] == 1 and source.stats["hedge_wins"] == 1
+        # Проигравший запрос отменён (не дожидаясь его), а его время всё равно попало в окно задержек
+        await asyncio.sleep(0.05)
+        assert source.pools[0].health.stats["cancelled"] == 1
+
+    run_with_exchanges(scenario)
+
+def test_breaker_opens_and_recovers():
+    async def scenario(source, primary, fallback):
+        health = source.pools[0].health
+        primary.error_rate = 1.0
+        for _ in range(bot.EXCHANGE_BREAKER_FAILURES):
+            assert (await source.ticker("BTC/USDT"))["source"] == "binanceus"
+        assert health.is_open and health.stats["opened"] == 1
+
+        # Разомкнутую биржу не трогаем вовсе
+        calls = primary.calls["24hr"]
+        assert (await source.ticker("BTC/USDT"))["source"] == "binanceus"
+        assert primary.calls["24hr"] == calls
+
+        # Биржа ожила: после паузы один пробный запрос замыкает автомат
+        primary.error_rate = 0.0
+        await asyncio.sleep(bot.EXCHANGE_BREAKER_COOLDOWN + 0.05)
+        assert (await source.ticker("BTC/USDT"))["source"] == "binance"
+        assert not health.is_open and health.opened_at == 0.0
+
+    run_with_exchanges(scenario)
+
+def test_total_outage_raises():
+    async def scenario(source, primary, fallback):
+        primary.error_rate = fallback.error_rate = 1.0
+        with pytest.raises(Exception):
+            await source.ticker("BTC/USDT")
+        assert source.stats["unavailable"] == 1
+
+    run_with_exchanges(scenario)
+
+def test_exchange_metric_families_are_contiguous(monkeypatch):
+    pools = [bot.ExchangePool(x) for x in ("binance", "okx", "bybit")]
+    monkeypatch.setattr(bot, "price_source", bot.PriceSource(pools))
+    registry = bot.Metrics()
+    registry.add_collector(bot.collect_runtime_metrics)
+
+    names = [
+        line.split("{")[0].split(" ")[0]
+        for line in registry.render().splitlines() if line and not line.startswith("#")
+    ]
+    for family in ("exchange_health_total", "exchange_breaker_open"):
+        first = names.index(family)
+        last = len(names) - 1 - names[::-1].index(family)
+        assert set(names[first:last + 1]) == {family}
+    assert names.count("exchange_breaker_open") == 3
@@ -0,0 +1,69 @@
+"""Тёплый рестарт: снимки и анализы из файла должны пригодиться, а не протухнуть при загрузке."""
+
+import json
+import time
+
+import pytest
+
+import bot
+
+@pytest.fixture
+def fresh_state(monkeypatch):
+    monkeypatch.setattr(bot.snapshot_scheduler, "snapshots", {})
+    monkeypatch.setattr(bot, "ai_cache", bot.AnalysisCache(bot.AI_CACHE_TTL, bot.AI_CACHE_STALE_TTL, 100))
+
+def snapshot(coin: str, ts: float):
+    return {"coin": coin, "price": 100.0, "change_pct": 1.0, "rsi": 55.0, "rsi_ts": ts - 30, "ts": ts}
+
+def write_state(path, saved_at: float, snapshots, analyses):
+    state = {
+        "version": bot.WarmState.VERSION, "ts": saved_at, "fiat": {},
+        "snapshots": snapshots, "ai_cache": analyses, "candles": {},
+    }
+    path.write_text(json.dumps(state), encoding="utf-8")
+
+def test_crash_restart_serves_saved_snapshots_and_analyses(tmp_path, fresh_state):
+    now = time.time()
+    saved = now - 200  # последний плановый снимок до падения
+    write_state(
+        tmp_path / "warm.json", saved,
+        {"BTC/USDT": snapshot("BTC/USDT", saved - 1), "ETH/USDT": snapshot("ETH/USDT", now - 3600)},
+        [["BTC/USDT", saved - 1, {"coin": "BTC/USDT", "ai_raw": "text"}],
+         ["ETH/USDT", now - 3600, {"coin": "ETH/USDT", "ai_raw": "old"}],
+         ["SOL/USDT", now - 10, {"coin": "SOL/USDT", "ai_raw": "fresh"}]],
+    )
+    assert bot.WarmState(str(tmp_path / "warm.json")).load()
+
+    # Снимок не выдаётся за свежий: время исходное, хендлер покажет его возраст и обновит
+    assert bot.snapshot_scheduler.get("BTC/USDT") is None
+    snap, state = bot.snapshot_scheduler.peek("BTC/USDT")
+    assert state == "stale" and snap["rsi"] == 55.0
+    assert snap["ts"] == pytest.approx(saved - 1)
+    assert snap["rsi_ts"] == pytest.approx(saved - 31)
+    # Слишком старое (старше WARM_STATE_STALE_MAX_AGE) не восстанавливаем
+    assert "ETH/USDT" not in bot.snapshot_scheduler.snapshots
+
+    value, state = bot.ai_cache.peek("BTC/USDT")
+    assert (value["ai_raw"], state) == ("text", "stale")
+    assert bot.ai_cache.peek("SOL/USDT")[1] == "fresh"
+    assert bot.ai_cache.peek("ETH/USDT")[1] == "miss"
+
+def test_dump_and_restore_round_trip(fresh_state):
+    bot.ai_cache.set("BTC/USDT", {"ai_raw": "x"}, time.time() - 120)
+    items = bot.ai_cache.dump(bot.WARM_STATE_STALE_MAX_AGE)
+    cache = bot.AnalysisCache(bot.AI_CACHE_TTL, bot.AI_CACHE_STALE_TTL, 10)
+    assert cache.restore(items, bot.WARM_STATE_STALE_MAX_AGE) == 1
+    assert cache.peek("BTC/USDT") == ({"ai_raw": "x"}, "stale")
+
+def test_snapshot_states_by_age(fresh_state):
+    now = time.time()
+    bot.snapshot_scheduler.snapshots.update({
+        "BTC/USDT": snapshot("BTC/USDT", now - 1),
+        "ETH/USDT": snapshot("ETH/USDT", now - bot.SNAPSHOT_MAX_AGE - 1),
+        "SOL/USDT": snapshot("SOL/USDT", now - bot.WARM_STATE_STALE_MAX_AGE - 1),
+    })
+    assert bot.snapshot_scheduler.peek("BTC/USDT")[1] == "fresh"
+    assert bot.snapshot_scheduler.peek("ETH/USDT")[1] == "stale"
+    assert bot.snapshot_scheduler.peek("SOL/USDT") == (None, "miss")
+    assert bot.snapshot_scheduler.peek("XRP/USDT") == (None, "miss")
+    assert "12 мин назад" in bot.render_data_age(now - 720, "обновляю...")